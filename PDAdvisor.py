@@ -0,0 +1,393 @@
+"""
+Index recommendations from the shapes of the queries PDSQL runs.
+
+Recording is opt-in. Start an IndexAdvisor, run the workload, then ask it
+for CREATE INDEX statements:
+
+    advisor = IndexAdvisor()
+    advisor.start()
+    ...
+    advisor.stop()
+    for recommendation in advisor.recommend(connection):
+        print(recommendation.sql)
+
+On sqlite, verify() checks the recommendations on an in-memory copy of
+the database by comparing the recorded queries' plans before and after
+each index is created.
+"""
+import sqlite3
+import threading
+
+from PDExplain import SqliteDialect, flag_joins
+from PDHooks import add_hook, remove_hook
+from PDOptimizer import (conjuncts, is_plain_column, optimizer, string_types,
+                         walk)
+
+
+# Comparisons an index can serve as a range scan
+range_ops = ('_lt', '_gt', '_le', '_ge', '_between', '_like')
+
+
+class ColumnUsage(object):
+    """
+    How a query uses the columns of one database table, each list in the
+    order the columns are first used.
+    """
+
+    def __init__(self):
+        self.equality = []
+        self.range = []
+        self.join = []
+        self.group = []
+        self.order = []
+        self.selected = []
+        # True if the query selects every column, e.g., SELECT *
+        self.all_selected = False
+
+    def add(self, kind, name):
+        columns = getattr(self, kind)
+        if name not in columns:
+            columns.append(name)
+
+    def columns(self):
+        """
+        Returns every column the query reads, in order of use.
+        """
+        columns = []
+        for kind in ('equality', 'join', 'range', 'group', 'order',
+                     'selected'):
+            for name in getattr(self, kind):
+                if name not in columns:
+                    columns.append(name)
+        return columns
+
+
+def column_usage(ast):
+    """
+    Returns a dict of ColumnUsage by database table name for the table ast
+    and its subqueries.
+    """
+    from PDColumn import PDColumn
+    from PDTable import PDTable
+
+    usage = {}
+
+    def add(col, kind):
+        if (is_plain_column(col) or (col.ops and not col._children)) \
+                and col.table is not None \
+                and isinstance(col.table._name, string_types) \
+                and col.name != '*':
+            usage.setdefault(col.table._name, ColumnUsage()).add(
+                kind, col.name)
+
+    def leaves(col):
+        if not isinstance(col, PDColumn) or col.subquery is not None:
+            return []
+        if not col._children:
+            return [col]
+        return leaves(col._children[0]) + leaves(col._children[1])
+
+    def condition(term):
+        op = getattr(term, '_binary_op', None)
+        if not isinstance(term, PDColumn) or op is None or term.ops:
+            for col in leaves(term):
+                add(col, 'selected')
+            return
+        left, right = term._children
+        if op == '_eq' and is_plain_column(left) and is_plain_column(right):
+            add(left, 'join')
+            add(right, 'join')
+        elif op in ('_eq', '_in') and is_plain_column(left):
+            add(left, 'equality')
+        elif op == '_eq' and is_plain_column(right):
+            add(right, 'equality')
+        elif op in range_ops and is_plain_column(left):
+            add(left, 'range')
+        else:
+            for col in leaves(term):
+                add(col, 'selected')
+
+    # Joined tables without operations, which are emitted as just their name
+    references = set()
+
+    def visit(node):
+        if (not isinstance(node, PDTable) or node._children
+                or id(node) in references):
+            return
+        tables = []
+        if isinstance(node._name, string_types):
+            tables.append(node._name)
+        has_select = False
+        for op, col in node._operation_ordering:
+            if op == '_select':
+                has_select = True
+                for select in col:
+                    for leaf in leaves(select['column']):
+                        add(leaf, 'selected')
+            elif op == '_join':
+                table = col['table']
+                if isinstance(table._name, string_types) \
+                        and not table._children:
+                    tables.append(table._name)
+                if len(table._operation_ordering) == 0:
+                    references.add(id(table))
+                if col['cond'] is not None:
+                    for term in conjuncts(col['cond']):
+                        condition(term)
+            elif op in ('_where', '_having'):
+                for term in conjuncts(col):
+                    condition(term)
+            elif op in ('_group', '_order'):
+                if is_plain_column(col):
+                    add(col, op[1:])
+        if not has_select and not node._is_write():
+            for name in tables:
+                usage.setdefault(name, ColumnUsage()).all_selected = True
+
+    walk(ast, visit)
+    return usage
+
+
+class IndexRecommendation(object):
+    """
+    A recommended index on columns of table, weighted by the executions
+    and latency of the queries it serves. covering is True if it holds
+    every column those queries read from the table.
+    """
+
+    def __init__(self, table, columns, weight, covering):
+        self.table = table
+        self.columns = tuple(columns)
+        self.weight = weight
+        self.covering = covering
+
+    @property
+    def name(self):
+        return 'pdsql_{}_{}'.format(self.table, '_'.join(self.columns))
+
+    @property
+    def sql(self):
+        return 'CREATE INDEX {} ON {} ( {} );'.format(
+            self.name, self.table, ' , '.join(self.columns))
+
+    def __repr__(self):
+        return 'IndexRecommendation({!r}, {!r}, weight={:.1f})'.format(
+            self.table, self.columns, self.weight)
+
+
+class IndexVerification(object):
+    """
+    Plans of the recorded queries on table before and after creating a
+    recommended index, as lists of PDExplain.QueryPlan.
+    """
+
+    def __init__(self, recommendation, before, after):
+        self.recommendation = recommendation
+        self.before = before
+        self.after = after
+
+    @property
+    def improved(self):
+        """
+        True if the index removed at least one flagged plan step without
+        adding any.
+        """
+        pairs = list(zip(self.before, self.after))
+        return (any(len(after.issues) < len(before.issues)
+                    for before, after in pairs)
+                and all(len(after.issues) <= len(before.issues)
+                        for before, after in pairs))
+
+
+class _Shape(object):
+    def __init__(self, table, usage):
+        self.table = table
+        self.usage = usage
+        self.executions = 0
+        self.elapsed = 0.0
+
+
+class IndexAdvisor(object):
+    """
+    Records the column usage of executed queries by query shape.
+
+    Each shape is weighted by its executions plus its total latency in
+    seconds times latency_weight, so by default a millisecond of database
+    time counts as much as one execution. Recommended indexes have at most
+    max_columns columns.
+    """
+
+    def __init__(self, latency_weight=1000.0, max_columns=6):
+        self.latency_weight = latency_weight
+        self.max_columns = max_columns
+        self._shapes = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts recording every query run through PDTable.
+        """
+        self.stop()
+        add_hook('on_execute_end', self._executed)
+
+    def stop(self):
+        remove_hook('on_execute_end', self._executed)
+
+    def _executed(self, event):
+        self.record(event.table, event.execute_time)
+
+    def clear(self):
+        with self._lock:
+            self._shapes.clear()
+
+    def record(self, table, elapsed=None):
+        """
+        Records one execution of table's query taking elapsed seconds.
+        """
+        try:
+            key = table.fingerprint()
+            with self._lock:
+                shape = self._shapes.get(key)
+        except TypeError:
+            # Unhashable literal in the query shape
+            return
+        if shape is None:
+            shape = _Shape(table, column_usage(optimizer.optimize(table)[0]))
+            with self._lock:
+                shape = self._shapes.setdefault(key, shape)
+        with self._lock:
+            shape.executions += 1
+            shape.elapsed += elapsed or 0.0
+
+    def weight(self, shape):
+        return shape.executions + shape.elapsed * self.latency_weight
+
+    def candidate(self, usage):
+        """
+        Returns (columns, covering) for an index serving a query's usage of
+        a table, or None if no index would help it. Equality and join
+        columns come first, then one range column or the GROUP BY or ORDER
+        BY columns, then the other columns read if they make it covering.
+        """
+        columns = []
+        for name in usage.equality + usage.join:
+            if name not in columns:
+                columns.append(name)
+        if usage.range:
+            if usage.range[0] not in columns:
+                columns.append(usage.range[0])
+        else:
+            for name in usage.group or usage.order:
+                if name not in columns:
+                    columns.append(name)
+        if not columns:
+            return None
+
+        read = usage.columns()
+        covering = not usage.all_selected and len(set(columns + read)) \
+            <= self.max_columns
+        if covering:
+            columns.extend(name for name in read if name not in columns)
+        return columns[:self.max_columns], covering
+
+    def recommend(self, connection=None, limit=None):
+        """
+        Returns IndexRecommendations by descending weight. Indexes that are
+        a prefix of another recommendation are merged into it. With a
+        sqlite3 connection, indexes that a prefix of an existing index
+        already provides are left out.
+        """
+        with self._lock:
+            shapes = list(self._shapes.values())
+
+        candidates = {}
+        for shape in shapes:
+            for table, usage in shape.usage.items():
+                candidate = self.candidate(usage)
+                if candidate is None:
+                    continue
+                columns, covering = candidate
+                entry = candidates.setdefault(
+                    (table, tuple(columns)), [0.0, covering])
+                entry[0] += self.weight(shape)
+
+        # Merge indexes into longer ones starting with the same columns
+        merged = []
+        for (table, columns), (weight, covering) in sorted(
+                candidates.items(), key=lambda item: -len(item[0][1])):
+            for recommendation in merged:
+                if (recommendation.table == table and
+                        recommendation.columns[:len(columns)] == columns):
+                    recommendation.weight += weight
+                    break
+            else:
+                merged.append(
+                    IndexRecommendation(table, columns, weight, covering))
+
+        if connection is not None:
+            merged = [recommendation for recommendation in merged
+                      if not any(index[:len(recommendation.columns)]
+                                 == recommendation.columns
+                                 for index in existing_indexes(
+                                     connection, recommendation.table))]
+
+        merged.sort(key=lambda recommendation: -recommendation.weight)
+        return merged[:limit] if limit is not None else merged
+
+    def verify(self, recommendations, connection):
+        """
+        Creates each of recommendations in turn on an in-memory copy of the
+        sqlite3 connection's database and returns an IndexVerification for
+        each, comparing the plans of the recorded queries on its table.
+        """
+        copy = sqlite3.connect(':memory:')
+        try:
+            if hasattr(connection, 'backup'):
+                connection.backup(copy)
+            else:
+                copy.executescript('\n'.join(connection.iterdump()))
+            cursor = copy.cursor()
+
+            with self._lock:
+                shapes = list(self._shapes.values())
+
+            def plans(table):
+                results = []
+                for shape in shapes:
+                    if table not in shape.usage:
+                        continue
+                    sql, params = shape.table.compile(params=True)
+                    plan = SqliteDialect().explain(cursor, sql, params, False)
+                    flag_joins(plan, optimizer.optimize(shape.table)[0])
+                    results.append(plan)
+                return results
+
+            verifications = []
+            for recommendation in recommendations:
+                before = plans(recommendation.table)
+                cursor.execute(recommendation.sql)
+                after = plans(recommendation.table)
+                verifications.append(
+                    IndexVerification(recommendation, before, after))
+            return verifications
+        finally:
+            copy.close()
+
+
+def existing_indexes(connection, table):
+    """
+    Returns a tuple of column names for each index on table in the sqlite3
+    connection's database.
+    """
+    cursor = connection.cursor()
+    try:
+        indexes = []
+        for row in cursor.execute(
+                'PRAGMA index_list("{}")'.format(table)).fetchall():
+            info = cursor.execute(
+                'PRAGMA index_info("{}")'.format(row[1])).fetchall()
+            indexes.append(tuple(column[2] for column in
+                                 sorted(info, key=lambda column: column[0])))
+        return indexes
+    finally:
+        cursor.close()
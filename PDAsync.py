@@ -0,0 +1,249 @@
+"""
+asyncio support for running PDTable queries without blocking the event loop.
+
+Requires Python 3.5+. Drivers return awaitables, and the default
+ThreadedDriver runs the blocking DB-API calls in an executor. With it,
+sqlite3 connections must be created with check_same_thread=False since
+they are used from executor threads.
+
+The helpers chain futures rather than use async/await, and only import
+asyncio when no event loop is given, so that they can be driven by any
+loop with create_future and run_in_executor methods.
+"""
+import functools
+from collections import deque
+
+from PDHooks import ObservedCursor, observe
+
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:
+    # Python 2 has no asynchronous iteration, but an AsyncRowIterator can
+    # still be advanced by hand with __anext__
+    class StopAsyncIteration(Exception):
+        pass
+
+
+def _get_loop(loop):
+    """
+    Returns loop, or the current asyncio event loop if it is None.
+    """
+    if loop is not None:
+        return loop
+    import asyncio
+    return asyncio.get_event_loop()
+
+
+def _ensure_future(awaitable, loop):
+    """
+    Returns awaitable as a future, scheduling it on loop if it is a
+    coroutine.
+    """
+    if hasattr(awaitable, 'add_done_callback'):
+        return awaitable
+    import asyncio
+    return asyncio.ensure_future(awaitable, loop=loop)
+
+
+class AsyncDriver(object):
+    """
+    Interface for executing queries asynchronously. Every method returns an
+    awaitable.
+    """
+
+    def fetchall(self, table, query, params):
+        """
+        Runs query with params for table and resolves to all result rows.
+        """
+        raise NotImplementedError
+
+    def execute(self, table, query, params):
+        """
+        Runs query with params for table and resolves to a handle for
+        fetching its results.
+        """
+        raise NotImplementedError
+
+    def fetchmany(self, handle, size):
+        """
+        Resolves to a list of at most size rows from handle, empty once the
+        results are exhausted.
+        """
+        raise NotImplementedError
+
+    def close(self, handle):
+        """
+        Releases the resources held by handle.
+        """
+        raise NotImplementedError
+
+
+class ThreadedDriver(AsyncDriver):
+    """
+    Driver running the table's blocking cursor or connection pool calls in
+    executor, or the event loop's default executor if None. Calls are
+    scheduled on loop, or the current event loop if None.
+    """
+
+    def __init__(self, executor=None, loop=None):
+        self._executor = executor
+        self._loop = loop
+
+    def _call(self, func, *args):
+        return _get_loop(self._loop).run_in_executor(
+            self._executor, functools.partial(func, *args))
+
+    def fetchall(self, table, query, params):
+        return self._call(_fetchall, table, query, params)
+
+    def execute(self, table, query, params):
+        return self._call(_execute, table, query, params)
+
+    def fetchmany(self, handle, size):
+        cursor, _ = handle
+        return self._call(cursor.fetchmany, size)
+
+    def close(self, handle):
+        _, release = handle
+        return self._call(release)
+
+
+def _execute(table, query, params):
+    cursor, release = table._open_cursor()
+    try:
+        with observe('execute', table, sql=query, params=params):
+            cursor.execute(query, params)
+    except Exception:
+        release()
+        raise
+    # Rows fetched from the cursor emit on_fetch, as for PDTable.run
+    return ObservedCursor(cursor, table, query, params), release
+
+
+def _fetchall(table, query, params):
+    cursor, release = _execute(table, query, params)
+    try:
+        return cursor.fetchall()
+    finally:
+        release()
+
+
+_default_driver = None
+
+
+def default_driver():
+    """
+    Returns the shared ThreadedDriver used when no driver is given.
+    """
+    global _default_driver
+    if _default_driver is None:
+        _default_driver = ThreadedDriver()
+    return _default_driver
+
+
+def _check_read(table):
+    table._check_cursor()
+    # Writes are committed by PDTable.run, which drivers cannot do
+    if table._is_write():
+        raise Exception(
+            'UPDATE and DELETE queries cannot be run asynchronously, use '
+            'run() instead')
+
+
+def fetchall_async(table, driver=None):
+    """
+    Returns an awaitable resolving to all result rows of table's query.
+    """
+    _check_read(table)
+    query, params = table.compile(params=True)
+    return (driver or default_driver()).fetchall(table, query, params)
+
+
+class AsyncRowIterator(object):
+    """
+    Asynchronous iterator over the result rows of a table's query, fetched
+    batch_size rows at a time. The query runs on the first iteration, and
+    its resources are released once the rows are exhausted or aclose() is
+    awaited. Futures are created on loop, or the current event loop if None.
+    """
+
+    def __init__(self, table, batch_size, driver=None, loop=None):
+        _check_read(table)
+        self._table = table
+        self._query, self._params = table.compile(params=True)
+        self._batch_size = batch_size
+        self._driver = driver or default_driver()
+        self._handle = None
+        self._rows = deque()
+        self._done = False
+        self._loop = loop
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = _get_loop(self._loop).create_future()
+        self._advance(future)
+        return future
+
+    def _advance(self, future):
+        """
+        Resolves future to the next row, running the query or fetching the
+        next batch first if needed.
+        """
+        if future.cancelled():
+            return
+        if self._rows:
+            future.set_result(self._rows.popleft())
+            return
+        if self._done:
+            future.set_exception(StopAsyncIteration())
+            return
+
+        if self._handle is None:
+            step = _ensure_future(self._driver.execute(
+                self._table, self._query, self._params), self._loop)
+        else:
+            step = _ensure_future(
+                self._driver.fetchmany(self._handle, self._batch_size),
+                self._loop)
+
+        def on_step(step):
+            if step.cancelled():
+                future.cancel()
+            elif step.exception() is not None:
+                self._finish(future, step.exception())
+            elif self._handle is None:
+                self._handle = step.result()
+                self._advance(future)
+            elif not step.result():
+                self._finish(future, StopAsyncIteration())
+            else:
+                self._rows.extend(step.result())
+                self._advance(future)
+
+        step.add_done_callback(on_step)
+
+    def _finish(self, future, exception):
+        """
+        Releases the query's resources, then fails future with exception.
+        """
+        def on_close(closed):
+            if not future.cancelled():
+                future.set_exception(exception)
+
+        _ensure_future(self.aclose(), self._loop).add_done_callback(on_close)
+
+    def aclose(self):
+        """
+        Returns an awaitable releasing the query's resources early.
+        """
+        self._done = True
+        self._rows.clear()
+        handle = self._handle
+        self._handle = None
+        if handle is not None:
+            return self._driver.close(handle)
+        future = _get_loop(self._loop).create_future()
+        future.set_result(None)
+        return future
@@ -0,0 +1,165 @@
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from PDHooks import fetched, observe
+
+
+class ScalarResult(object):
+    """
+    Placeholder for a value from the results of an earlier query in the same
+    execute_many batch, by default the first column of its first row.
+
+    It can be used anywhere a literal can, e.g., c.count() > ScalarResult(0),
+    and is bound as a parameter once that query has run.
+    """
+
+    def __init__(self, index, row=0, column=0):
+        self.index = index
+        self.row = row
+        self.column = column
+
+    def __repr__(self):
+        return 'ScalarResult({}, row={}, column={})'.format(
+            self.index, self.row, self.column)
+
+    def resolve(self, results):
+        """
+        Returns the value from results, the list of each query's rows, or
+        None if the query returned too few rows.
+        """
+        rows = results[self.index]
+        if self.row >= len(rows):
+            return None
+        return rows[self.row][self.column]
+
+
+def _param_values(params):
+    if isinstance(params, dict):
+        return params.values()
+    return params
+
+
+def _resolve_params(params, results):
+    def resolve(value):
+        if isinstance(value, ScalarResult):
+            return value.resolve(results)
+        return value
+
+    if isinstance(params, dict):
+        return dict((name, resolve(value)) for name, value in params.items())
+    return [resolve(value) for value in params]
+
+
+def _fetchall(table, query, params, pool):
+    cursor, release = table._open_cursor(pool)
+    try:
+        with observe('execute', table, sql=query, params=params):
+            cursor.execute(query, params)
+        rows = cursor.fetchall()
+        fetched(table, query, params, rows)
+        return rows
+    finally:
+        release()
+
+
+def execute_many(queries, workers=4, pool=None):
+    """
+    Runs each PDTable in queries and returns a list of each one's result
+    rows, in order.
+
+    Every query is compiled up front. Queries that use a ScalarResult of an
+    earlier query run once it has finished, and the others run concurrently
+    on up to workers threads. Each query checks out its own connection from
+    pool, a PDPool.ConnectionPool, or from its table's pool if pool is None.
+    Queries without a pool run one at a time on their table's cursor.
+
+    If a query fails, no further queries are started and its exception is
+    raised once the running ones have finished.
+    """
+    compiled = [query.compile(params=True) for query in queries]
+
+    dependencies = []
+    for idx, (_, params) in enumerate(compiled):
+        depends_on = set(value.index for value in _param_values(params)
+                         if isinstance(value, ScalarResult))
+        if any(dep < 0 or dep >= idx for dep in depends_on):
+            raise Exception(
+                'Query {} can only use results of earlier queries'.format(
+                    idx))
+        dependencies.append(depends_on)
+
+    results = [None] * len(queries)
+    concurrent = workers > 1 and all(
+        pool is not None or query._pool is not None for query in queries)
+
+    if not concurrent:
+        for idx, query in enumerate(queries):
+            sql, params = compiled[idx]
+            results[idx] = _fetchall(
+                query, sql, _resolve_params(params, results), pool)
+        return results
+
+    tasks = queue.Queue()
+    finished = queue.Queue()
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            idx, params = task
+            try:
+                rows = _fetchall(queries[idx], compiled[idx][0], params, pool)
+                finished.put((idx, rows, None))
+            except Exception as e:
+                finished.put((idx, None, e))
+
+    threads = [threading.Thread(target=work)
+               for _ in range(min(workers, len(queries)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    def submit(idx):
+        tasks.put((idx, _resolve_params(compiled[idx][1], results)))
+
+    remaining = [len(depends_on) for depends_on in dependencies]
+    dependents = [[] for _ in queries]
+    for idx, depends_on in enumerate(dependencies):
+        for dep in depends_on:
+            dependents[dep].append(idx)
+
+    running = 0
+    for idx, count in enumerate(remaining):
+        if count == 0:
+            submit(idx)
+            running += 1
+
+    error = None
+    while running:
+        idx, rows, exception = finished.get()
+        running -= 1
+        if exception is not None:
+            error = error or exception
+            continue
+        results[idx] = rows
+        if error is not None:
+            continue
+        for dependent in dependents[idx]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                submit(dependent)
+                running += 1
+
+    for thread in threads:
+        tasks.put(None)
+    for thread in threads:
+        thread.join()
+
+    if error is not None:
+        raise error
+    return results
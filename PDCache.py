@@ -0,0 +1,269 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe, size-bounded cache that evicts the least recently used
+    entry first and counts hits, misses and evictions.
+    """
+
+    def __init__(self, max_size=1024):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for key, marking it as most recently used,
+        or default if key is not cached.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Caches value for key, evicting the least recently used entries if the
+        cache is full.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            self._evict()
+
+    def resize(self, max_size):
+        """
+        Sets the maximum number of entries, evicting entries if the cache is
+        now over it. A max_size of 0 disables caching.
+        """
+        with self._lock:
+            self.max_size = max_size
+            self._evict()
+
+    def clear(self):
+        """
+        Removes every entry and resets the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """
+        Returns a dict of the cache counters and current size.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+        }
+
+    def _evict(self):
+        while len(self._entries) > max(self.max_size, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+class ResultCache(object):
+    """
+    Thread-safe cache of query results bounded by their approximate size in
+    bytes, evicting the least recently used results first.
+
+    Each result expires ttl seconds after it is cached (the cache's
+    default_ttl if None, never if that is None too) and is invalidated as
+    soon as one of the tables it was read from is written to, see
+    invalidate.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_ttl=None):
+        # key -> (value, size, expiry time or None, table names)
+        self._entries = OrderedDict()
+        # table name -> set of keys of the results read from it
+        self._tables = {}
+        self._lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.bytes = 0
+        # Incremented by every invalidation, see put
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for key, marking it as most recently used,
+        or default if key is not cached or has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None \
+                    and entry[2] <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size, tables=(), ttl=None, generation=None):
+        """
+        Caches value, of size bytes and read from the tables named in
+        tables, for key. Values larger than max_bytes are not cached.
+
+        generation is the cache's generation from before the value was
+        read. If a table has been invalidated since, the value may be stale
+        and is not cached.
+        """
+        if ttl is None:
+            ttl = self.default_ttl
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            expires = time.time() + ttl if ttl is not None else None
+            tables = frozenset(tables)
+            self._entries[key] = (value, size, expires, tables)
+            self.bytes += size
+            for table in tables:
+                self._tables.setdefault(table, set()).add(key)
+            self._evict()
+
+    def invalidate(self, tables):
+        """
+        Removes the results read from any of the tables named in tables and
+        returns how many were removed.
+        """
+        with self._lock:
+            self.generation += 1
+            keys = set()
+            for table in tables:
+                keys.update(self._tables.get(table, ()))
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def resize(self, max_bytes):
+        """
+        Sets the maximum total size, evicting results if the cache is now
+        over it. A max_bytes of 0 disables caching.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """
+        Removes every result and resets the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._tables.clear()
+            self.bytes = 0
+            self.generation += 1
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+            self.invalidations = 0
+
+    def stats(self):
+        """
+        Returns a dict of the cache counters and current size.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+            'size': len(self._entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def _remove(self, key):
+        _, size, _, tables = self._entries.pop(key)
+        self.bytes -= size
+        for table in tables:
+            keys = self._tables[table]
+            keys.discard(key)
+            if not keys:
+                del self._tables[table]
+
+    def _evict(self):
+        while self._entries and self.bytes > max(self.max_bytes, 0):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+
+class CachedResult(object):
+    """
+    Cursor-like access to a cached result's rows, returned by PDTable.run
+    for cached queries.
+    """
+
+    arraysize = 1
+    rowcount = -1
+
+    def __init__(self, rows, description):
+        self._rows = rows
+        self._position = 0
+        self.description = description
+
+    def __iter__(self):
+        while self._position < len(self._rows):
+            self._position += 1
+            yield self._rows[self._position - 1]
+
+    def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        self._position += 1
+        return self._rows[self._position - 1]
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        rows = self._rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+    def close(self):
+        self._position = len(self._rows)
@@ -1,8 +1,81 @@
 import copy
+import threading
+import weakref
+
+from PDCache import LRUCache
+
+
+# Scalar subquery values memoized with PDColumn.value(memoize=True), in an
+# LRUCache per connection. Connections are held weakly where the driver
+# allows it, and otherwise only the most recently used few are kept, so
+# that a connection's values are never read for another one.
+scalar_cache = weakref.WeakKeyDictionary()
+_strong_scalar_cache = LRUCache(max_size=8)
+_scalar_lock = threading.Lock()
+
+
+def scalar_values(connection):
+    """
+    Returns the LRUCache of scalar subquery values memoized for connection.
+    """
+    with _scalar_lock:
+        try:
+            values = scalar_cache.get(connection)
+            weak = True
+        except TypeError:
+            # The connection cannot be weakly referenced
+            values = _strong_scalar_cache.get(connection)
+            weak = False
+        if values is None:
+            values = LRUCache(max_size=256)
+            if weak:
+                scalar_cache[connection] = values
+            else:
+                _strong_scalar_cache.put(connection, values)
+        return values
+
+# Columns built by PDTable and PDColumn methods, so that building the same
+# expression again returns the same column. Keys hold the operator and the
+# ids of the table and operands, which the column keeps alive, and entries
+# go away with the last reference to their column.
+interned = weakref.WeakValueDictionary()
+
+
+def column(name, table):
+    """
+    Returns the interned column name of table.
+    """
+    key = ('c', name, id(table))
+    col = interned.get(key)
+    if col is None:
+        col = interned[key] = PDColumn(name, table)
+    return col
+
+
+def scalar_column(subquery):
+    """
+    Returns the interned column equal to the single value subquery returns.
+    """
+    key = ('s', id(subquery))
+    col = interned.get(key)
+    if col is None:
+        col = interned[key] = PDColumn(name='scalar', subquery=subquery)
+    return col
 
 
 class PDColumn(object):
 
+    # Columns are built in large numbers for long predicates, so they have
+    # fixed attributes. Operators are stored by name in agg, unary_op and
+    # _binary_op, and columns are never changed once built: every method
+    # returns a new column, and ops and _children are tuples. Methods
+    # return interned columns, so building the same expression twice
+    # shares one column.
+    __slots__ = (
+        'agg', 'unary_op', '_binary_op', 'null', 'table', 'name',
+        '_children', 'ops', 'subquery', '_shape', '__weakref__'
+    )
+
     # General list available to all PDColumn instances
     aggregate_list = (
         '_sum', '_avg', '_count', '_first', '_last', '_max', '_min'
@@ -26,25 +99,61 @@ class PDColumn(object):
         '_eq', '_ne', '_lt', '_gt', '_le', '_ge', '_in', '_between', '_like'
     )
 
-    def __init__(self, name='Column', table=None):
+    def __init__(self, name='Column', table=None, subquery=None):
         """
         Initializes column to be empty. Optional table argument allows
-        creator to specify the base table if necessary.
+        creator to specify the base table if necessary, and subquery the
+        PDTable whose single value the column is.
         """
         self.agg = None
         self.unary_op = None
         self._binary_op = None
         self.null = None
 
-        if name == '*':
-            self._count = True
-        else:
-            self._count = False
-
         self.table = table
         self.name = name
-        self._children = []
-        self.ops = []
+        self._children = ()
+        self.ops = ()
+
+        # PDTable whose single value this column is, see PDTable.scalar
+        self.subquery = subquery
+
+        # Memoized (key, literals) of this expression, see
+        # PDCompiler.walk_shape
+        self._shape = None
+
+    @property
+    def _count(self):
+        """
+        True for * and COUNT aggregates, whose column is emitted without
+        its table.
+        """
+        return self.name == '*' or self.agg == '_count'
+
+    def _copy_key(self, marker, value):
+        """
+        Returns the interning key of a copy of this column with one more
+        operator or null check. The copy does not keep this column alive,
+        so the key refers to the table, operands and subquery it shares
+        with this column instead.
+        """
+        return (marker, value, self.name, id(self.table), id(self._children),
+                self.ops, self.null, id(self.subquery))
+
+    def __copy__(self):
+        new_col = object.__new__(type(self))
+        new_col.agg = self.agg
+        new_col.unary_op = self.unary_op
+        new_col._binary_op = self._binary_op
+        new_col.null = self.null
+        new_col.table = self.table
+        new_col.name = self.name
+        new_col._children = self._children
+        new_col.ops = self.ops
+        new_col.subquery = self.subquery
+        # Copies are made to be changed, so the shape is recomputed
+        new_col._shape = None
+        return new_col
 
     ################################################################
     # Evaluation methods
@@ -116,10 +225,13 @@ class PDColumn(object):
             raise Exception('Attempting to assign invalid aggregate function')
 
         else:
-            new_col = copy.copy(self)
-            new_col.agg = agg
-            setattr(new_col, agg, True)
-            new_col.ops.append(agg)
+            key = self._copy_key('u', agg)
+            new_col = interned.get(key)
+            if new_col is None:
+                new_col = copy.copy(self)
+                new_col.agg = agg
+                new_col.ops = self.ops + (agg,)
+                interned[key] = new_col
             return new_col
 
     def sum(self):
@@ -162,10 +274,13 @@ class PDColumn(object):
             raise Exception('Attempting to assign invalid unary function')
 
         else:
-            new_col = copy.copy(self)
-            new_col.unary_op = op
-            setattr(new_col, op, True)
-            new_col.ops.append(op)
+            key = self._copy_key('u', op)
+            new_col = interned.get(key)
+            if new_col is None:
+                new_col = copy.copy(self)
+                new_col.unary_op = op
+                new_col.ops = self.ops + (op,)
+                interned[key] = new_col
             return new_col
 
     def __abs__(self):
@@ -220,15 +335,27 @@ class PDColumn(object):
             raise Exception('Attempting to assign invalid binary function')
 
         else:
+            # Columns are immutable and shared, but other values (e.g., a
+            # list for IN) are copied in case the caller changes them.
+            #
+            # Only operations between two columns are interned. Long
+            # generated predicates are mostly comparisons with literals and
+            # chains of AND or OR that are never built twice, and interning
+            # them would only add work for the garbage collector.
+            key = None
+            if not isinstance(other, PDColumn):
+                other = copy.copy(other)
+            elif op not in ('_and', '_or'):
+                key = ('b', op, id(self), id(other))
+                new_col = interned.get(key)
+                if new_col is not None:
+                    return new_col
+
             new_col = PDColumn()
             new_col._binary_op = op
-            setattr(new_col, op, True)
-
-            c1 = copy.copy(self)
-            c2 = copy.copy(other)
-
-            new_col._children.append(c1)
-            new_col._children.append(c2)
+            new_col._children = (self, other)
+            if key is not None:
+                interned[key] = new_col
             return new_col
 
     def __add__(self, other):
@@ -304,8 +431,12 @@ class PDColumn(object):
         if self.has_null():
             raise Exception('Already checking column for null values')
 
-        new_col = copy.copy(self)
-        new_col.null = null
+        key = self._copy_key('n', null)
+        new_col = interned.get(key)
+        if new_col is None:
+            new_col = copy.copy(self)
+            new_col.null = null
+            interned[key] = new_col
         return new_col
 
     def is_null(self):
@@ -313,3 +444,53 @@ class PDColumn(object):
 
     def not_null(self):
         return self._set_is_null(False)
+
+    ################################################################
+    # Scalar Subquery Methods
+    ################################################################
+
+    def value(self, memoize=False):
+        """
+        For columns returned by PDTable.scalar(), runs the subquery and
+        returns the first column of its first row, or None if it returns no
+        rows, for when the value is needed in Python.
+
+        If memoize is True, the value is memoized for the connection the
+        subquery runs on (see scalar_values) and read from there by later
+        calls. Memoized values are only discarded once the connection
+        itself writes, for drivers that count its changes (like sqlite3's
+        total_changes), so only memoize values of data that other
+        connections do not change.
+        """
+        if self.subquery is None:
+            raise Exception('Only scalar subquery columns have a value')
+
+        query, params = self.subquery.compile(params=True)
+        cursor, release = self.subquery._open_cursor()
+        try:
+            values = key = None
+            if memoize:
+                connection = getattr(cursor, 'connection', cursor)
+                if isinstance(params, dict):
+                    params_key = tuple(sorted(params.items()))
+                else:
+                    params_key = tuple(params)
+                values = scalar_values(connection)
+                key = (getattr(connection, 'total_changes', None), query,
+                       params_key)
+                try:
+                    value = values.get(key, self)
+                except TypeError:
+                    key = None
+                # self marks a miss, since None is a valid value
+                if key is not None and value is not self:
+                    return value
+
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+            value = row[0] if row else None
+            if key is not None:
+                values.put(key, value)
+            return value
+        finally:
+            release()
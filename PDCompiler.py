@@ -1,5 +1,8 @@
 import copy
 
+from PDCache import LRUCache
+from PDOptimizer import optimizer, string_types
+
 
 # Does not have not -- must be desugared down.
 unary_map = {
@@ -46,301 +49,617 @@ binary_set_map = {
     '_except': 'EXCEPT',
 }
 
-_uniquegen_counter = 0
+# Placeholder formats for the DB-API paramstyles, given the parameter's
+# position (starting at 1) or name.
+paramstyle_map = {
+    'qmark': '?',
+    'format': '%s',
+    'numeric': ':{}',
+    'named': ':{}',
+    'pyformat': '%({})s',
+}
+
+# Process-wide cache of parameterized SQL keyed on query shape, see
+# fingerprint, and of SQL with inlined literals keyed on query shape and
+# literals. Resize it with sql_cache.resize(max_size).
+sql_cache = LRUCache(max_size=1024)
 
 
 # Structure taken from Berkeley's Fall 2014 CS164 projects
-def compile_to_sql(ast):
+def compile_to_sql(ast, paramstyle=None):
+    """
+    Compiles the table ast to a SQL query string.
+
+    If paramstyle is one of the DB-API paramstyles in paramstyle_map,
+    literals are replaced by placeholders and (query, params) is returned
+    instead, where params is a dict for the named styles and a list
+    otherwise.
+    """
     # Import here to avoid circular imports
     from PDColumn import PDColumn
-    from PDTable import PDTable
-
-    def uniquegen():
-        global _uniquegen_counter
-        _uniquegen_counter += 1
-        return '#reg-' + str(_uniquegen_counter)
-
-    def apply_children(node, func):
-        if isinstance(node, PDColumn):
-            func(node)
-            for child in node._children:
-                apply_children(child, func)
-
-        elif isinstance(node, PDTable):
-            func(node)
-            ops = node._operation_ordering
-            for op in ops:
-                if op[0] == '_select':
-                    for col in op[1]:
-                        apply_children(col['column'], func)
-                else:
-                    apply_children(op[1], func)
-
-        elif hasattr(node, '__iter__'):
-            for child in node:
-                apply_children(child, func)
-
-    def rewrite_select(node):
-        if isinstance(node, PDTable):
-            ops = node._operation_ordering
-            if len([i[1] for i in ops if i[0] == '_select']) == 0:
-                node._operation_ordering.append(
-                    ('_select', [{'column': PDColumn(name='*')}]))
-
-
-    def rewrite_exists(node):
-        """
-        Rewrite EXISTS to IN when the following conditions are met:
-            * There is at least one restrictive equality condition on
-              the subquery. E.g., where(subtable.col = 123)
-            * There is an equality correlation between the queries.
-
-        This currently only rewrites the base node, and does not attempt
-        to convert multiple exists in the same query.
-        """
-        if isinstance(node, PDTable):
-            parent_name = node._name
-            ops = node._operation_ordering
-            exist_list = []
-            exist_child = None
-            exist_index = None
-
-            for idx, op in enumerate(ops):
-                if op[0] == '_where_exists':
-                    exist_list.append((idx, op[1]))
-
-            for p_idx, child in exist_list:
-                selective = False
-                correlation_pair = None
-                ops = child._operation_ordering
-                for idx, op in enumerate(ops):
-                    if op[0] == '_where':
-                        col = op[1]
-                        # Equality clauses
-                        if isinstance(col, PDColumn) and col._binary_op == '_eq':
-                            # Check for selectivity
-                            selective = (len([i for i in col._children if \
-                                    isinstance(i, PDColumn) and \
-                                    i.table._name == child._name]) > 0) and \
-                                    (len([i for i in col._children if not \
-                                    (isinstance(i, PDTable)\
-                                    or isinstance(i, PDColumn))]) > 0)
-
-                            # Check for correlation
-                            c1 = col._children[0]
-                            c2 = col._children[1]
-                            if isinstance(c1, PDColumn) and isinstance(c2, PDColumn):
-                                name1 = c1.table._name
-                                name2 = c2.table._name
-                                if name1 == parent_name and name2 == child._name:
-                                    correlation_pair = (idx, c1, c2)
-                                elif name1 == child._name and name2 == parent_name:
-                                    correlation_pair = (idx, c2, c1)
-
-                # Here, we know if a rewrite for this child is necessary
-                # if it is selective and a correlation_pair exists.
-                if selective and correlation_pair:
-                    # Remove old where clause for correlation
-                    child._operation_ordering.pop(correlation_pair[0])
-
-                    # Select the correlation.
-                    child._operation_ordering = \
-                        [i for i in child._operation_ordering if i[0] != '_select']
-                    child._operation_ordering.append(("_select",\
-                         [{'column':correlation_pair[2]}]))
-
-                    exist_child = child
-                    exist_index = p_idx
-                    # Currently only supports rewriting one.
-                    break
-
-            if exist_index and exist_child:
-                node._operation_ordering.pop(exist_index)
-                in_col = correlation_pair[1].in_(exist_child)
-                node._operation_ordering.append(('_where', in_col))
-
-        return node
-
-    def strip_parens(strings):
-        if strings[0] == '(' and strings[-1] == ')':
-            return strings[1:-1]
-        return strings
+    from PDTable import OperationList, PDTable
 
     def get_table_name(node):
         if node._alias:
-            return ['{} {}'.format(node._name, node._alias)]
-        return [node._name]
+            return '{} {}'.format(node._name, node._alias)
+        return node._name
 
-    def get_binary_op_strings(node):
-        children = [compilenode(child) for child in node._children]
+    def emit_clause(out, keyword, items, emit_item, separator):
+        """
+        Emits keyword followed by each item joined by separator, or nothing
+        if there are no items.
+        """
+        if not items:
+            return
+        out.append(keyword)
+        for idx, item in enumerate(items):
+            if idx:
+                out.append(separator)
+            emit_item(item)
+
+    def emit_binary_op(node, out, bare):
+        children = node._children
+        op = node._binary_op
 
         # Switch on all binary ops
 
-        if node._binary_op in binary_middle_map:
-            strings = ['('] + children[0] + \
-                [binary_middle_map[node._binary_op]] + \
-                children[1] + [')']
-
-        elif node._binary_op in binary_function_map:
-            strings = [binary_function_map[node._binary_op] + '('] + \
-                children[0] + [','] + children[1] + [')']
-
-        elif node._binary_op in binary_set_map:
-            strings = strip_parens(children[0]) + \
-                [binary_set_map[node._binary_op]] + \
-                strip_parens(children[1])
+        if op in binary_middle_map:
+            if not bare:
+                out.append('(')
+            emit(children[0], out)
+            out.append(binary_middle_map[op])
+            emit(children[1], out)
+            if not bare:
+                out.append(')')
+
+        elif op in binary_function_map:
+            out.append(binary_function_map[op] + '(')
+            emit(children[0], out)
+            out.append(',')
+            emit(children[1], out)
+            out.append(')')
+
+        elif op in binary_set_map:
+            emit(children[0], out, bare=True)
+            out.append(binary_set_map[op])
+            emit(children[1], out, bare=True)
 
         else:
             raise Exception(
-                "AST column contains unrecognized binary op: "
-                + node._binary_op)
-        return strings
-
-    def compilenode(node):
-        node = copy.deepcopy(node)
-        apply_children(node, rewrite_select)
-        strings = []
-
-        if isinstance(node, PDColumn):
-
-            if len(node._children) > 0:
-                strings = get_binary_op_strings(node)
-
-            # In the case where no children, fill strings with basic
-            # information about the column.
+                "AST column contains unrecognized binary op: " + op)
+
+    def emit_column(node, out):
+        # Unary operators wrap the column, innermost first, so their
+        # prefixes are emitted outermost first.
+        for op in node.ops:
+            if op not in unary_map:
+                raise Exception(
+                    "AST column contains unrecognized unary op: " + op)
+        for op in reversed(node.ops):
+            out.append(unary_map[op] + '(')
+
+        if len(node._children) > 0:
+            emit_binary_op(node, out, False)
+
+        # Scalar subquery
+        elif node.subquery is not None:
+            emit(node.subquery, out)
+
+        # In the case where no children, emit basic information about the
+        # column.
+        elif (node.table is not None
+                and not isinstance(node.table._name, PDTable)
+                and not node._count):
+            if node.table._alias:
+                out.append(node.table._alias + '.' + node.name)
             else:
-                if (hasattr(node.table, '_name')
-                        and not isinstance(node.table._name, PDTable)
-                        and not node._count):
-                    if node.table._alias:
-                        strings = [node.table._alias + '.' + node.name]
-                    else:
-                        strings = [node.table._name + '.' + node.name]
-                else:
-                    strings = [node.name]
+                out.append(node.table._name + '.' + node.name)
+        else:
+            out.append(node.name)
+
+        out.extend([')'] * len(node.ops))
+
+        if node.null is True:
+            out.append('IS NULL')
+        elif node.null is False:
+            out.append('IS NOT NULL')
+
+    def emit_table(node, out, bare):
+        if len(node._children) > 0:
+            emit_binary_op(node, out, bare)
+            return
+
+        selects = []
+        joins = []
+        where_exists = []
+        wheres = []
+        group = []
+        having = []
+        order = []
+        updates = []
+        deletes = []
+        clauses = {
+            '_select': selects, '_join': joins, '_where': wheres,
+            '_where_exists': where_exists, '_group': group,
+            '_having': having, '_order': order, '_delete': deletes,
+        }
+        for op, col in node._operation_ordering:
+            if op == '_select':
+                selects.extend(col)
+            elif op == '_update':
+                updates.extend(col)
+            elif op in clauses:
+                clauses[op].append(col)
+
+        # Must have a GROUP BY clause for HAVING
+        if having and not group:
+            raise Exception('Must have a GROUP BY clause if using HAVING')
+
+        def emit_select(col):
+            emit(col['column'], out)
+            if 'name' in col:
+                out.append('AS \"' + col['name'] + '\"')
+
+        def emit_condition(col):
+            out.append('(')
+            emit(col, out)
+            out.append(')')
+
+        def emit_exists(table):
+            out.append('EXISTS')
+            emit_condition(table)
+
+        def emit_grouping(col):
+            # A bound parameter here would be a constant rather than a
+            # column position, so bare literals are always inlined.
+            if isinstance(col, (PDColumn, PDTable)):
+                emit(col, out)
+            else:
+                out.append(inline_literal(col))
 
-            # At this point, we have either a base column or some composition
-            # of columns in 'strings'. Now we apply unary operators.
+        def emit_where():
+            # WHERE and WHERE EXISTS
+            if not where_exists and not wheres:
+                return
+            out.append('WHERE')
+            for idx, table in enumerate(where_exists):
+                if idx:
+                    out.append('AND')
+                emit_exists(table)
+            for idx, col in enumerate(wheres):
+                if idx or where_exists:
+                    out.append('AND')
+                emit_condition(col)
+
+        def emit_assignment(assignment):
+            out.append(assignment[0])
+            out.append('=')
+            emit(assignment[1], out)
+
+        # UPDATE and DELETE, which are only allowed at the top level
+        if updates or deletes:
+            if not bare:
+                raise Exception('UPDATE and DELETE cannot be subqueries')
+            if updates and deletes:
+                raise Exception('Cannot both UPDATE and DELETE in a query')
+            if (selects or joins or group or having or order or node._distinct
+                    or node._limit is not None):
+                raise Exception(
+                    'Only WHERE clauses are allowed in UPDATE and DELETE')
+            if updates:
+                out.append('UPDATE')
+                out.append(get_table_name(node))
+                emit_clause(out, 'SET', updates, emit_assignment, ',')
+            else:
+                out.append('DELETE FROM')
+                out.append(get_table_name(node))
+            emit_where()
+            return
+
+        if not bare:
+            out.append('(')
+
+        # SELECT, defaulting to every column
+        out.append('SELECT')
+        if node._distinct:
+            out.append('DISTINCT')
+        if selects:
+            for idx, col in enumerate(selects):
+                if idx:
+                    out.append(',')
+                emit_select(col)
+        else:
+            out.append('*')
 
-            for op in node.ops:
-                if op in unary_map:
-                    strings = [unary_map[op] + '('] + strings + [')']
+        # FROM + JOIN
+        out.append('FROM')
+        if not joins:
+            if not isinstance(node._name, PDTable):
+                out.append(get_table_name(node))
+            else:
+                emit_condition(node._name)
+        else:
+            out.append('(')
+            out.append(get_table_name(node))
+            for join in joins:
+                table = join['table']
+                out.append('INNER JOIN')
+                # No operations on the table, so just use the name
+                if len(table._operation_ordering) == 0:
+                    out.append(get_table_name(table))
                 else:
-                    raise Exception(
-                        "AST column contains unrecognized unary op: "
-                        + op)
-
-            if node.null is True:
-                strings.append('IS NULL')
-            elif node.null is False:
-                strings.append('IS NOT NULL')
+                    emit(table, out)
+                    # Name a subquery of a single table after it so that
+                    # columns of the table in ON and WHERE refer to its
+                    # results.
+                    if (isinstance(table._name, string_types)
+                            and not table._children
+                            and not table.has_query('_join')):
+                        out.append(table._alias or table._name)
+                if join['cond']:
+                    out.append('ON')
+                    emit(join['cond'], out)
+            out.append(')')
+
+        emit_where()
+        emit_clause(out, 'GROUP BY', group, emit_grouping, ',')
+        emit_clause(out, 'HAVING', having, emit_condition, 'AND')
+
+        # ORDER
+        if order:
+            emit_clause(out, 'ORDER BY', order, emit_grouping, ',')
+            out.append('DESC' if node._reverse_val else 'ASC')
+
+        if node._limit is not None:
+            out.append('LIMIT')
+            out.append(str(node._limit))
+
+        if not bare:
+            out.append(')')
+
+    def emit(node, out, bare=False):
+        """
+        Appends the SQL tokens for node to out. If bare is True, a table or
+        binary expression is emitted without its enclosing parentheses.
+        """
+        if isinstance(node, PDColumn):
+            emit_column(node, out)
 
         elif isinstance(node, PDTable):
+            emit_table(node, out, bare)
 
-            if len(node._children) > 0:
-                return get_binary_op_strings(node)
-
-            ops = node._operation_ordering
-
-            # SELECT
-            select_list = ['SELECT']
-            if node._distinct:
-                select_list.append('DISTINCT')
+        elif isinstance(node, tuple):
+            out.append('(' + ','.join([literal(item) for item in node]) + ')')
 
-            for col_list in [i[1] for i in ops if i[0] == '_select']:
-                for col in col_list:
-                    s = []
-                    if 'name' in col:
-                        s += ['AS \"' + col['name'] + '\"']
-                    s = compilenode(col['column']) + s
-                    select_list += s + [',']
-            select_list.pop()
+        else:
+            out.append(literal(node))
+
+    def inline_literal(value):
+        if isinstance(value, string_types):
+            return '"' + value + '"'
+        return str(value)
+
+    def bind_literal(value):
+        params.append(value)
+        return placeholder(paramstyle, len(params))
+
+    def compile_tree(ast):
+        # Rewrites never modify the caller's tables, they return new nodes
+        # sharing the unchanged parts of the tree.
+        ast, rewrites = optimizer.optimize(ast)
+        if optimizer.debug:
+            optimizer.report(rewrites)
+        out = []
+        emit(ast, out, bare=True)
+        return ' '.join(out) + ';'
+
+    if paramstyle is None:
+        literal = inline_literal
+        # Literals are keyed with their types, since, e.g., 1 == 1.0 but
+        # they are inlined differently.
+        key, literals, _ = walk_shape(ast)
+        try:
+            key = (None, optimizer.enabled, key,
+                   tuple((type(value), value) for value in literals))
+            sql = None if optimizer.debug else sql_cache.get(key)
+        except TypeError:
+            sql = key = None
+        if sql is None:
+            sql = compile_tree(ast)
+            if key is not None and not optimizer.debug:
+                sql_cache.put(key, sql)
+        return sql
+
+    if paramstyle not in paramstyle_map:
+        raise Exception('Unsupported paramstyle: ' + str(paramstyle))
+    literal = bind_literal
+    params = []
+
+    # Queries with the same shape compile to the same parameterized SQL, so
+    # on a cache hit only the literals need to be collected. In debug mode
+    # the cache is bypassed so that every compile reports its rewrites.
+    key, literals, _ = walk_shape(ast)
+    key = (paramstyle, optimizer.enabled, key)
+    try:
+        entry = None if optimizer.debug else sql_cache.get(key)
+    except TypeError:
+        # Unhashable literal inlined into the query, e.g., in ORDER BY
+        entry = key = None
+
+    if entry is not None:
+        sql, order = entry
+        params = [literals[idx] for idx in order]
+    elif key is None:
+        sql = compile_tree(ast)
+    else:
+        # Compile a copy with each literal replaced by its slot, recording
+        # which slot each bound parameter comes from after rewrites.
+        _, _, slotted = walk_shape(ast, rebuild=True)
+        sql = compile_tree(slotted)
+        order = tuple(slot.index for slot in params)
+        if not optimizer.debug:
+            sql_cache.put(key, (sql, order))
+        params = [literals[idx] for idx in order]
+
+    if paramstyle in ('named', 'pyformat'):
+        params = dict(
+            (placeholder_name(idx + 1), value)
+            for idx, value in enumerate(params))
+    return sql, params
+
+
+def compile_insert(table, columns, paramstyle):
+    """
+    Compiles an INSERT of one row of values for columns into table, with a
+    placeholder in paramstyle for each value.
+    """
+    if paramstyle not in paramstyle_map:
+        raise Exception('Unsupported paramstyle: ' + str(paramstyle))
+    placeholders = [placeholder(paramstyle, idx + 1)
+                    for idx in range(len(columns))]
+    return 'INSERT INTO {} ( {} ) VALUES ( {} );'.format(
+        table._name, ' , '.join(columns), ' , '.join(placeholders))
+
+
+def placeholder_name(position):
+    return 'p' + str(position)
+
+
+def placeholder(paramstyle, position):
+    """
+    Returns the placeholder for the parameter at position (starting at 1).
+    """
+    if paramstyle in ('named', 'pyformat'):
+        return paramstyle_map[paramstyle].format(placeholder_name(position))
+    return paramstyle_map[paramstyle].format(position)
+
+
+class ParameterSlot(object):
+    """
+    Stands in for the literal at index in a fingerprint's literals while
+    compiling a query's shape.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __repr__(self):
+        return 'ParameterSlot({})'.format(self.index)
+
+
+def fingerprint(ast):
+    """
+    Returns (key, literals) for the table or column ast.
+
+    key is a hashable description of the query's shape: its operations,
+    column references and operator tree, with literals that the compiler
+    binds as parameters abstracted to slots. literals holds those values in
+    the order they are found.
+    """
+    key, literals, _ = walk_shape(ast)
+    return key, literals
+
+
+def walk_shape(ast, rebuild=False):
+    """
+    Walks ast and returns (key, literals, node) as in fingerprint. If
+    rebuild is True, node is a copy of ast with each bound literal replaced
+    by its ParameterSlot, otherwise it is ast.
+    """
+    # Import here to avoid circular imports
+    from PDColumn import PDColumn
+    from PDTable import OperationList, PDTable
 
-            # FROM + JOIN
-            joins = [i[1] for i in ops if i[0] == '_join']
+    # The key is built as one flat sequence of markers and attributes in
+    # prefix order, which is cheaper to build and hash than nested tuples.
+    key = []
+    literals = []
 
-            from_list = ['FROM']
+    # Rebuilt subqueries in FROM, by the id of the original, so columns of
+    # the derived table can refer to the rebuilt one instead.
+    derived = {}
 
-            if not joins:
-                if not isinstance(node._name, PDTable):
-                    from_list += get_table_name(node)
-                else:
-                    from_list += ['('] + compilenode(node._name) + [')']
-            else:
-                from_list += ['('] + get_table_name(node)
-                for join in joins:
-                    table = join['table']
-                    # No operations on the table, so just use the name
-                    if len(table._operation_ordering) == 0:
-                        from_list += ['INNER JOIN'] + get_table_name(table)
-                    else:
-                        from_list += ['INNER JOIN'] + compilenode(table)
-                    if join['cond']:
-                        from_list += ['ON'] + compilenode(join['cond'])
-                from_list += [')']
+    # Tables walked so far, and whether a column is being walked, to tell
+    # which column expressions can memoize their shape.
+    state = {'tables': 0, 'in_column': False}
 
-            # WHERE and WHERE EXISTS
-            where_list = ['WHERE']
-            for col in [i[1] for i in ops if i[0] == '_where_exists']:
-                where_list += ['EXISTS'] + ['('] + compilenode(col) + [')'] + ['AND']
-            for col in [i[1] for i in ops if i[0] == '_where']:
-                where_list += ['('] + compilenode(col) + [')'] + ['AND']
-            where_list.pop()
-
-            # GROUP BY
-            group_list = ['GROUP BY']
-            group = [i[1] for i in ops if i[0] == '_group']
-            for col in group:
-                group_list += compilenode(col) + [',']
-            group_list.pop()
-
-            # HAVING
-            having_list = ['HAVING']
-            having = [i[1] for i in ops if i[0] == '_having']
-            # Must have a GROUP BY clause for HAVING
-            if having and not group:
-                raise Exception('Must have a GROUP BY clause if using HAVING')
-            for col in having:
-                having_list += ['('] + compilenode(col) + [')'] + ['AND']
-            having_list.pop()
-
-            # ORDER
-            order_list = ['ORDER BY']
-            for col in [i[1] for i in ops if i[0] == '_order']:
-                order_list += compilenode(col) + [',']
-            order_list.pop()
-            if len(order_list) > 0:
-                if node._reverse_val:
-                    order_list += ['DESC']
-                else:
-                    order_list += ['ASC']
-
-            limit_list = []
-            if node._limit is not None:
-                limit_list += ['LIMIT', str(node._limit)]
+    def walk(node):
+        if isinstance(node, PDColumn):
+            if rebuild or state['in_column']:
+                return walk_column(node)
+            return walk_expression(node)
 
-            strings = ['('] + select_list + from_list + where_list + group_list + \
-                having_list + order_list + limit_list + [')']
+        elif isinstance(node, PDTable):
+            return walk_table(node)
 
         elif isinstance(node, tuple):
-            new_elements = []
-            for item in node:
-                if isinstance(item, basestring):
-                    new_elements += ['"' + item + '"']
-                else:
-                    new_elements += [str(item)]
-            new_elements = ','.join(new_elements)
-            strings = ['(' + new_elements + ')']
+            key.append(('?', len(node)))
+            start = len(literals)
+            literals.extend(node)
+            if rebuild:
+                return tuple(ParameterSlot(idx)
+                             for idx in range(start, len(literals)))
 
-        elif isinstance(node, basestring):
-            strings = ['"' + node + '"']
+        else:
+            key.append('?')
+            literals.append(node)
+            if rebuild:
+                return ParameterSlot(len(literals) - 1)
+        return node
 
+    def walk_expression(node):
+        # Columns are immutable, so the key and literals of a whole column
+        # expression without subqueries are memoized on it. Only the top
+        # of each expression is memoized, since memoizing every column in
+        # a long chain of ANDs would take quadratic space.
+        if node._shape is not None:
+            key.extend(node._shape[0])
+            literals.extend(node._shape[1])
+            return node
+
+        key_start, literals_start = len(key), len(literals)
+        tables = state['tables']
+        state['in_column'] = True
+        try:
+            walk_column(node)
+        finally:
+            state['in_column'] = False
+        if state['tables'] == tables:
+            node._shape = (tuple(key[key_start:]),
+                           tuple(literals[literals_start:]))
+        return node
+
+    def walk_column(node):
+        table = node.table
+        if table is None:
+            table_ref = None
+        elif isinstance(table._name, PDTable):
+            table_ref = True
+            if rebuild and id(table._name) in derived:
+                node = copy.copy(node)
+                node.table = copy.copy(table)
+                node.table._name = derived[id(table._name)][1]
         else:
-            strings = [str(node)]
+            table_ref = (table._name, table._alias)
+
+        key.extend(('c', node.name, table_ref, node._count, len(node.ops)))
+        key.extend(node.ops)
+        key.append(node.null)
+        if node.subquery is not None:
+            key.append('scalar')
+            subquery = walk(node.subquery)
+            if rebuild:
+                node = copy.copy(node)
+                node.subquery = subquery
+            return node
+        if len(node._children) == 0:
+            key.append(None)
+            return node
+
+        key.append(node._binary_op)
+        children = (walk(node._children[0]), walk(node._children[1]))
+        if rebuild:
+            node = copy.copy(node)
+            node._children = children
+        return node
 
-        return strings
+    def walk_grouping(col):
+        # Bare literals are inlined rather than bound
+        if isinstance(col, (PDColumn, PDTable)):
+            return walk(col)
+        key.append(('lit', col))
+        return col
+
+    def walk_select(cols):
+        key.append(len(cols))
+        new_cols = []
+        for col in cols:
+            new_col = dict(col)
+            new_col['column'] = walk(col['column'])
+            key.append(col.get('name'))
+            new_cols.append(new_col)
+        return new_cols
+
+    def walk_update(assignments):
+        key.append(len(assignments))
+        new_assignments = []
+        for name, value in assignments:
+            key.append(name)
+            new_assignments.append((name, walk(value)))
+        return new_assignments
+
+    def walk_join(join):
+        table = join['table']
+        if len(table._operation_ordering) == 0:
+            key.append(('name', table._name, table._alias))
+        else:
+            table = walk(table)
+        if join['cond']:
+            cond = walk(join['cond'])
+        else:
+            key.append(None)
+            cond = join['cond']
+        return {'table': table, 'cond': cond}
+
+    def walk_table(node):
+        state['tables'] += 1
+        in_column = state['in_column']
+        state['in_column'] = False
+        try:
+            return walk_table_clauses(node)
+        finally:
+            state['in_column'] = in_column
+
+    def walk_table_clauses(node):
+        if len(node._children) > 0:
+            key.extend(('t', node._binary_op))
+            children = (walk(node._children[0]), walk(node._children[1]))
+            if rebuild:
+                node = node._derive()
+                node._children = children
+            return node
+
+        ops = list(node._operation_ordering)
+        clauses = {}
+        for idx, (op, col) in enumerate(ops):
+            clauses.setdefault(op, []).append(idx)
+
+        def walk_clause(op, func):
+            indices = clauses.get(op, ())
+            key.append((op, len(indices)))
+            for idx in indices:
+                ops[idx] = (op, func(ops[idx][1]))
+
+        key.extend(('t', node._alias, node._distinct, node._reverse_val,
+                    node._limit))
+
+        # A subquery is only emitted in FROM when there are no joins. It is
+        # walked first so the clauses referring to it see the rebuilt copy.
+        name = node._name
+        if isinstance(name, PDTable) and '_join' not in clauses:
+            key.append('from')
+            name = walk(name)
+            if rebuild:
+                derived[id(node._name)] = (node._name, name)
+        else:
+            key.append(name)
+
+        # Walk the remaining clauses in the order they are emitted
+        walk_clause('_update', walk_update)
+        walk_clause('_delete', lambda col: col)
+        walk_clause('_select', walk_select)
+        walk_clause('_join', walk_join)
+        walk_clause('_where_exists', walk)
+        walk_clause('_where', walk)
+        walk_clause('_group', walk_grouping)
+        walk_clause('_having', walk)
+        walk_clause('_order', walk_grouping)
+
+        if rebuild:
+            node = node._derive()
+            node._name = name
+            node._operation_ordering = OperationList.from_iterable(ops)
+        return node
 
-    ast = copy.deepcopy(ast)
-    ast = rewrite_exists(ast)
-    strings = strip_parens(compilenode(ast))
-    return ' '.join(strings) + ';'
+    node = walk(ast)
+    return tuple(key), literals, node
@@ -0,0 +1,330 @@
+"""
+Query plan introspection for PDTable.explain.
+
+Plans are read with the database's EXPLAIN statement, chosen from the
+module of the cursor's class: EXPLAIN QUERY PLAN on sqlite3, and EXPLAIN
+(ANALYZE) on PostgreSQL through psycopg2 or psycopg.
+"""
+import re
+import time
+
+from PDOptimizer import (conjuncts, is_plain_column, optimizer,
+                         string_types, walk)
+
+
+class PlanNode(object):
+    """
+    A step of a query plan, with the steps it runs as its children.
+
+    For steps reading a table, table is the table's name (or alias) in the
+    query, access is 'scan' or 'search', and index is the name of the index
+    used, if any. flags lists the problems found with the step, see
+    QueryPlan.
+    """
+
+    def __init__(self, detail):
+        self.detail = detail
+        self.children = []
+        self.flags = []
+        self.table = None
+        self.access = None
+        self.index = None
+
+    def walk(self):
+        """
+        Iterates over this node and every node below it, in plan order.
+        """
+        yield self
+        for child in self.children:
+            for node in child.walk():
+                yield node
+
+    def flag(self, name):
+        if name not in self.flags:
+            self.flags.append(name)
+
+    def __repr__(self):
+        return 'PlanNode({!r})'.format(self.detail)
+
+
+class QueryPlan(object):
+    """
+    Plan tree of a query, returned by PDTable.explain. nodes holds the
+    top-level steps in the order the database runs them.
+
+    Steps are flagged with:
+        full_scan: reads every row of a table
+        temp_btree: sorts into a temporary B-tree (or sorts, on databases
+            without them) for ORDER BY, GROUP BY or DISTINCT
+        missing_join_index: reads a table of a join(cond=...) equality
+            without using an index on its columns
+
+    issues lists (flag, node, message) for each flag. With analyze, rows is
+    the number of rows the query returned and elapsed the seconds it took.
+    """
+
+    def __init__(self, sql, params, nodes, dialect):
+        self.sql = sql
+        self.params = params
+        self.nodes = nodes
+        self.dialect = dialect
+        self.issues = []
+        self.rows = None
+        self.elapsed = None
+
+    def walk(self):
+        """
+        Iterates over every node in the plan, in plan order.
+        """
+        for node in self.nodes:
+            for child in node.walk():
+                yield child
+
+    def flagged(self, flag):
+        """
+        Returns the nodes flagged with flag.
+        """
+        return [node for node in self.walk() if flag in node.flags]
+
+    def add_issue(self, flag, node, message):
+        node.flag(flag)
+        self.issues.append((flag, node, message))
+
+    def __str__(self):
+        lines = []
+
+        def add(node, level):
+            line = '  ' * level + node.detail
+            if node.flags:
+                line += '  [' + ', '.join(node.flags) + ']'
+            lines.append(line)
+            for child in node.children:
+                add(child, level + 1)
+
+        for node in self.nodes:
+            add(node, 0)
+        if self.elapsed is not None:
+            lines.append('rows: {}, elapsed: {:.6f}s'.format(
+                self.rows, self.elapsed))
+        return '\n'.join(lines)
+
+
+class SqliteDialect(object):
+    """
+    Reads plans with EXPLAIN QUERY PLAN. sqlite has no EXPLAIN ANALYZE, so
+    with analyze the query is also run and timed.
+    """
+
+    name = 'sqlite'
+
+    # SCAN CONSTANT ROW reads no table, for queries without FROM
+    access_re = re.compile(
+        r'(SCAN|SEARCH)(?: TABLE)? (?!CONSTANT ROW)(\S+)(?: AS (\S+))?')
+    index_re = re.compile(r'USING (?:COVERING )?INDEX (\S+)')
+
+    def explain(self, cursor, sql, params, analyze):
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        rows = cursor.fetchall()
+
+        nodes = {}
+        top = []
+        for row in rows:
+            node_id, parent, detail = row[0], row[1], row[-1]
+            node = self.parse(detail)
+            nodes[node_id] = node
+            if parent in nodes:
+                nodes[parent].children.append(node)
+            else:
+                top.append(node)
+        plan = QueryPlan(sql, params, top, self.name)
+
+        for node in plan.walk():
+            if (node.access == 'scan' and node.index is None
+                    and not node.table.startswith('(')):
+                plan.add_issue('full_scan', node,
+                               'full scan of ' + node.table)
+            elif node.detail.startswith('USE TEMP B-TREE FOR '):
+                plan.add_issue('temp_btree', node, 'temporary B-tree for '
+                               + node.detail[len('USE TEMP B-TREE FOR '):])
+
+        if analyze:
+            start = time.time()
+            cursor.execute(sql, params)
+            plan.rows = len(cursor.fetchall())
+            plan.elapsed = time.time() - start
+        return plan
+
+    def parse(self, detail):
+        node = PlanNode(detail)
+        match = self.access_re.match(detail)
+        if match:
+            node.access = match.group(1).lower()
+            node.table = match.group(3) or match.group(2)
+            index = self.index_re.search(detail)
+            if 'AUTOMATIC' in detail:
+                # Built for this query because no index exists
+                node.index = None
+            elif 'INTEGER PRIMARY KEY' in detail:
+                node.index = 'INTEGER PRIMARY KEY'
+            elif index:
+                node.index = index.group(1)
+        return node
+
+
+class PostgresDialect(object):
+    """
+    Reads plans with EXPLAIN, or EXPLAIN ANALYZE with analyze, which runs
+    the query and reports actual row counts and timings in each step.
+    """
+
+    name = 'postgresql'
+
+    scan_re = re.compile(
+        r'(Seq Scan|Index Scan|Index Only Scan|Bitmap Heap Scan)'
+        r'(?: Backward)?(?: using (\S+))? on (\S+)(?: (\S+))?')
+    rows_re = re.compile(r'actual time=\S+ rows=(\d+)')
+
+    def explain(self, cursor, sql, params, analyze):
+        prefix = 'EXPLAIN ANALYZE ' if analyze else 'EXPLAIN '
+        start = time.time()
+        cursor.execute(prefix + sql, params)
+        lines = [row[0] for row in cursor.fetchall()]
+        elapsed = time.time() - start
+
+        top = []
+        # (indent, node) of the steps enclosing the current line
+        stack = []
+        for line in lines:
+            stripped = line.lstrip()
+            indent = len(line) - len(stripped)
+            is_step = stripped.startswith('->') or not stack
+            if not is_step:
+                # Step property, e.g., "Filter: (x > 5)"
+                stack[-1][1].detail += '\n' + stripped
+                continue
+            node = self.parse(stripped.lstrip('-> '))
+            while stack and stack[-1][0] >= indent:
+                stack.pop()
+            if stack:
+                stack[-1][1].children.append(node)
+            else:
+                top.append(node)
+            stack.append((indent, node))
+
+        plan = QueryPlan(sql, params, top, self.name)
+        for node in plan.walk():
+            if node.access == 'scan' and node.index is None:
+                plan.add_issue('full_scan', node,
+                               'full scan of ' + node.table)
+            elif node.detail.startswith('Sort'):
+                plan.add_issue('temp_btree', node, 'sort')
+
+        if analyze:
+            plan.elapsed = elapsed
+            match = self.rows_re.search(lines[0]) if lines else None
+            if match:
+                plan.rows = int(match.group(1))
+        return plan
+
+    def parse(self, detail):
+        node = PlanNode(detail)
+        match = self.scan_re.match(detail)
+        if match:
+            node.access = 'scan' if match.group(1) == 'Seq Scan' \
+                else 'search'
+            node.index = match.group(2)
+            node.table = match.group(4) or match.group(3)
+        return node
+
+
+# Dialects by the top-level module of the cursor's class
+dialects = {
+    'sqlite3': SqliteDialect(),
+    'psycopg2': PostgresDialect(),
+    'psycopg': PostgresDialect(),
+}
+
+
+def dialect_for(cursor):
+    """
+    Returns the dialect for cursor's database.
+    """
+    module = type(cursor).__module__.split('.')[0]
+    if module not in dialects:
+        raise Exception('EXPLAIN is not supported for ' + module + ' cursors')
+    return dialects[module]
+
+
+def join_conditions(ast):
+    """
+    Returns (column, column) for each equality between two columns of
+    database tables in the join(cond=...) conditions of ast and its
+    subqueries.
+    """
+    from PDTable import PDTable
+
+    pairs = []
+
+    def collect(node):
+        if not isinstance(node, PDTable):
+            return
+        for op, col in node._operation_ordering:
+            if op != '_join' or col['cond'] is None:
+                continue
+            for term in conjuncts(col['cond']):
+                if getattr(term, '_binary_op', None) != '_eq' or term.ops:
+                    continue
+                left, right = term._children
+                if all(is_plain_column(side) and side.table is not None
+                       and isinstance(side.table._name, string_types)
+                       for side in (left, right)):
+                    pairs.append((left, right))
+
+    walk(ast, collect)
+    return pairs
+
+
+def flag_joins(plan, ast):
+    """
+    Flags the steps reading tables of join conditions in ast when neither
+    table is searched with an index.
+    """
+    def label(col):
+        return col.table._alias or col.table._name
+
+    for left, right in join_conditions(ast):
+        labels = (label(left), label(right))
+        steps = [node for node in plan.walk() if node.table in labels]
+        if not steps or any(node.access == 'search' and node.index
+                            for node in steps):
+            continue
+        # The last step to read a table is the innermost loop, which is the
+        # one an index would speed up.
+        node = steps[-1]
+        col = left if node.table == labels[0] else right
+        plan.add_issue(
+            'missing_join_index', node,
+            'no index used for join on {}.{} = {}.{}, consider an index on '
+            '{}({})'.format(labels[0], left.name, labels[1], right.name,
+                            col.table._name, col.name))
+
+
+def explain(table, analyze=False, dialect=None):
+    """
+    Returns the QueryPlan of table's query, see PDTable.explain.
+    """
+    if analyze and table._is_write():
+        raise Exception('Cannot EXPLAIN ANALYZE UPDATE or DELETE queries')
+    if isinstance(dialect, string_types):
+        if dialect not in dialects:
+            raise Exception('Unknown EXPLAIN dialect: ' + dialect)
+        dialect = dialects[dialect]
+    sql, params = table.compile(params=True)
+    cursor, release = table._open_cursor()
+    try:
+        plan = (dialect or dialect_for(cursor)).explain(
+            cursor, sql, params, analyze)
+    finally:
+        release()
+    flag_joins(plan, optimizer.optimize(table)[0])
+    return plan
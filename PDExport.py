@@ -0,0 +1,395 @@
+"""
+Streaming export of PDTable query results to files, see PDTable.export.
+
+Results are fetched with fetchmany and each batch is written before the
+next is fetched, so memory use is bounded by the batch size however large
+the results are. Formats:
+
+    csv: a header row and one row per result row, with NULL as an empty
+        field, encoded as UTF-8
+    columnar: the built-in binary columnar format described below
+    arrow: the Arrow IPC file format, one record batch per batch
+    parquet: Parquet, one row group per batch
+
+arrow and parquet require pyarrow, and their column types are those
+pyarrow infers from the first batch with values in the column. Batches are
+held back until every column has a value, or null_lookahead batches have
+been fetched, after which a column that only had NULLs keeps Arrow's null
+type and a later value in it fails the export.
+
+The columnar format stores each batch's columns as contiguous
+little-endian buffers, each starting at a multiple of 8 bytes, so that
+readers can memory-map the file and use the buffers in place:
+
+    int64 and float64: 8 bytes per value, NULL as 0 and NaN
+    utf8 and binary: n + 1 int64 offsets into the bytes that follow
+    nulls, for any column with NULLs: one byte per value, 1 for NULL
+
+A column's type is chosen per batch, from its values: int64 if they are
+all integers, float64 if they are all numbers, binary for bytes, and utf8
+(of the value's text) otherwise. The file starts with MAGIC and ends with
+a JSON footer listing the columns and each batch's buffers, its length as
+an int64, and MAGIC. iter_columnar and read_columnar read it back.
+"""
+import csv
+import json
+import mmap
+import struct
+from collections import OrderedDict
+from itertools import chain
+
+from PDOptimizer import integer_types, text_type
+
+MAGIC = b'PDCOLv1\0'
+
+formats = ('csv', 'columnar', 'arrow', 'parquet')
+
+# Most batches held back for arrow and parquet while a column has only
+# NULLs, to find its type.
+null_lookahead = 16
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise Exception(
+            'Exporting to Arrow or Parquet requires pyarrow, the csv and '
+            'columnar formats do not')
+    return pyarrow
+
+
+def export(table, path, format, batch_size):
+    """
+    Runs the query table and writes its results to path in format,
+    fetching batch_size rows at a time. Returns the number of rows written.
+
+    For arrow and parquet, a column with only NULLs in the first
+    null_lookahead batches cannot have values in later ones.
+    """
+    if format not in formats:
+        raise Exception('Unsupported export format: ' + str(format))
+    if format in ('arrow', 'parquet'):
+        _pyarrow()
+
+    names = []
+    table._check_cursor()
+    batches = table._fetch_batches(
+        batch_size, lambda description: names.extend(
+            column[0] for column in description))
+    writers = {
+        'csv': _write_csv,
+        'columnar': _write_columnar,
+        'arrow': _write_arrow,
+        'parquet': _write_parquet,
+    }
+    try:
+        return writers[format](path, names, batches)
+    finally:
+        batches.close()
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if str is bytes and isinstance(value, text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def _write_csv(path, names, batches):
+    count = 0
+    if str is bytes:
+        csv_file = open(path, 'wb')
+    else:
+        csv_file = open(path, 'w', newline='', encoding='utf-8')
+    with csv_file:
+        writer = csv.writer(csv_file)
+        header = False
+        for rows in batches:
+            if not header:
+                writer.writerow([_csv_value(name) for name in names])
+                header = True
+            writer.writerows([_csv_value(value) for value in row]
+                             for row in rows)
+            count += len(rows)
+        if not header:
+            writer.writerow([_csv_value(name) for name in names])
+    return count
+
+
+def _column_type(values):
+    """
+    Returns the columnar format type of the non-NULL values.
+    """
+    if all(isinstance(value, integer_types) for value in values):
+        return 'int64'
+    if all(isinstance(value, integer_types + (float,)) for value in values):
+        return 'float64'
+    if all(isinstance(value, (bytearray, memoryview)) or (
+            str is not bytes and isinstance(value, bytes))
+            or type(value).__name__ == 'buffer' for value in values):
+        return 'binary'
+    return 'utf8'
+
+
+def _pad(size):
+    return -size % 8
+
+
+class _ColumnarWriter(object):
+    """
+    Appends buffers to a columnar format file, recording where each is.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.offset = 0
+        self.write(MAGIC)
+
+    def write(self, data):
+        self.out.write(data)
+        self.offset += len(data)
+        padding = _pad(len(data))
+        if padding:
+            self.out.write(b'\0' * padding)
+            self.offset += padding
+
+    def buffer(self, data):
+        """
+        Writes data as a buffer and returns its [offset, length].
+        """
+        offset = self.offset
+        self.write(data)
+        return [offset, len(data)]
+
+    def column(self, values):
+        """
+        Writes the buffers of a batch's values of a column and returns their
+        description for the footer.
+        """
+        count = len(values)
+        nulls = [value is None for value in values]
+        present = [value for value in values if value is not None]
+        kind = _column_type(present)
+        chunk = {'type': kind}
+
+        if kind == 'int64':
+            chunk['values'] = self.buffer(struct.pack(
+                '<{}q'.format(count),
+                *[0 if value is None else value for value in values]))
+        elif kind == 'float64':
+            chunk['values'] = self.buffer(struct.pack(
+                '<{}d'.format(count),
+                *[float('nan') if value is None else value
+                  for value in values]))
+        else:
+            if kind == 'utf8':
+                encoded = [b'' if value is None else
+                           value.encode('utf-8')
+                           if isinstance(value, text_type) else
+                           value if isinstance(value, bytes) else
+                           text_type(value).encode('utf-8')
+                           for value in values]
+            else:
+                encoded = [b'' if value is None else bytes(value)
+                           for value in values]
+            offsets = [0]
+            for data in encoded:
+                offsets.append(offsets[-1] + len(data))
+            chunk['offsets'] = self.buffer(
+                struct.pack('<{}q'.format(count + 1), *offsets))
+            chunk['values'] = self.buffer(b''.join(encoded))
+
+        if any(nulls):
+            chunk['nulls'] = self.buffer(bytearray(nulls))
+        return chunk
+
+    def footer(self, names, batches):
+        footer = json.dumps({'columns': names, 'batches': batches})
+        footer = footer.encode('utf-8')
+        self.out.write(footer)
+        self.out.write(struct.pack('<q', len(footer)))
+        self.out.write(MAGIC)
+
+
+def _write_columnar(path, names, batches):
+    count = 0
+    footer_batches = []
+    with open(path, 'wb') as out:
+        writer = _ColumnarWriter(out)
+        for rows in batches:
+            columns = zip(*rows)
+            footer_batches.append({
+                'rows': len(rows),
+                'columns': [writer.column(values) for values in columns],
+            })
+            count += len(rows)
+        writer.footer(names, footer_batches)
+    return count
+
+
+def _arrow_batch(pyarrow, names, rows, schema):
+    arrays = [pyarrow.array(list(values), type=field.type)
+              for values, field in zip(zip(*rows), schema)]
+    return pyarrow.RecordBatch.from_arrays(arrays, names)
+
+
+def _arrow_schema(pyarrow, names, batches):
+    """
+    Returns the Arrow schema of the results and the batches fetched to
+    find it, which are those until every column has a value, or at most
+    null_lookahead batches.
+    """
+    fetched = []
+    types = None
+    for rows in batches:
+        # names is filled in once the query has run
+        if types is None:
+            types = [pyarrow.null()] * len(names)
+        fetched.append(rows)
+        for idx, values in enumerate(zip(*rows)):
+            if pyarrow.types.is_null(types[idx]):
+                types[idx] = pyarrow.array(list(values)).type
+        if len(fetched) >= null_lookahead or not any(
+                pyarrow.types.is_null(kind) for kind in types):
+            break
+    if types is None:
+        types = [pyarrow.null()] * len(names)
+    return pyarrow.schema(list(zip(names, types))), fetched
+
+
+def _write_arrow(path, names, batches):
+    pyarrow = _pyarrow()
+    count = 0
+    schema, fetched = _arrow_schema(pyarrow, names, batches)
+    writer = pyarrow.RecordBatchFileWriter(path, schema)
+    try:
+        for rows in chain(fetched, batches):
+            writer.write_batch(_arrow_batch(pyarrow, names, rows, schema))
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+
+def _write_parquet(path, names, batches):
+    pyarrow = _pyarrow()
+    import pyarrow.parquet as parquet
+    count = 0
+    schema, fetched = _arrow_schema(pyarrow, names, batches)
+    writer = parquet.ParquetWriter(path, schema)
+    try:
+        for rows in chain(fetched, batches):
+            writer.write_table(pyarrow.Table.from_batches(
+                [_arrow_batch(pyarrow, names, rows, schema)]))
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+
+def _read_footer(data):
+    size = len(data)
+    if size < 2 * len(MAGIC) + 8 or data[:len(MAGIC)] != MAGIC \
+            or data[size - len(MAGIC):] != MAGIC:
+        raise Exception('Not a columnar format file')
+    end = size - len(MAGIC) - 8
+    length = struct.unpack('<q', data[end:end + 8])[0]
+    return json.loads(data[end - length:end].decode('utf-8'))
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _read_chunk(data, chunk, count, np):
+    """
+    Returns the values of a column chunk, as an array if np (NumPy) is
+    given, viewing data in place for numbers without NULLs.
+    """
+    kind = chunk['type']
+    nulls = None
+    if 'nulls' in chunk:
+        offset, length = chunk['nulls']
+        nulls = bytearray(data[offset:offset + length])
+
+    if kind in ('int64', 'float64'):
+        offset = chunk['values'][0]
+        code = '<q' if kind == 'int64' else '<d'
+        if np is not None:
+            values = np.frombuffer(data, dtype=np.dtype(code), count=count,
+                                   offset=offset)
+            if nulls is not None:
+                # NULL integers are NaN, as in PDVector
+                values = values.astype(np.float64)
+                values[np.frombuffer(bytes(nulls), dtype=bool)] = np.nan
+            return values
+        values = list(struct.unpack_from(
+            '<{}{}'.format(count, code[1]), data, offset))
+    else:
+        offset = chunk['offsets'][0]
+        offsets = struct.unpack_from('<{}q'.format(count + 1), data, offset)
+        start = chunk['values'][0]
+        values = [data[start + offsets[idx]:start + offsets[idx + 1]]
+                  for idx in range(count)]
+        if kind == 'utf8':
+            values = [value.decode('utf-8') for value in values]
+        else:
+            values = [bytearray(value) for value in values]
+
+    if nulls is not None:
+        values = [None if null else value
+                  for null, value in zip(nulls, values)]
+    if np is not None:
+        array = np.empty(count, dtype=object)
+        array[:] = values
+        return array
+    return values
+
+
+def iter_columnar(path, arrays=True):
+    """
+    Iterates over the batches of the columnar format file at path, as
+    OrderedDicts of each column's values by name. The file is
+    memory-mapped, and if arrays is True and NumPy is available, values
+    are arrays, with int64 and float64 columns without NULLs viewing the
+    mapped file in place. Otherwise they are lists.
+    """
+    np = _numpy() if arrays else None
+    with open(path, 'rb') as in_file:
+        data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+    footer = _read_footer(data)
+    names = footer['columns']
+    for batch in footer['batches']:
+        yield OrderedDict(
+            (name, _read_chunk(data, chunk, batch['rows'], np))
+            for name, chunk in zip(names, batch['columns']))
+
+
+def read_columnar(path, arrays=True):
+    """
+    Returns all the values in the columnar format file at path, as an
+    OrderedDict of each column's values by name, which are arrays or lists
+    as in iter_columnar.
+    """
+    np = _numpy() if arrays else None
+    chunks = OrderedDict()
+    for batch in iter_columnar(path, arrays):
+        for name, values in batch.items():
+            chunks.setdefault(name, []).append(values)
+    if not chunks:
+        with open(path, 'rb') as in_file:
+            names = _read_footer(in_file.read())['columns']
+        empty = np.empty(0, dtype=object) if np is not None else []
+        return OrderedDict((name, empty) for name in names)
+    if np is not None:
+        return OrderedDict((name, values[0] if len(values) == 1 else
+                            np.concatenate(values))
+                           for name, values in chunks.items())
+    return OrderedDict((name, sum(values, []))
+                       for name, values in chunks.items())
@@ -0,0 +1,307 @@
+"""
+Instrumentation hooks for compiling and running PDTable queries.
+
+Register a function with add_hook(event, func) to have it called with a
+QueryEvent each time the event happens. Events:
+
+    on_compile_start, on_compile_end: compiling a query to SQL
+    on_execute_start, on_execute_end: running the compiled SQL
+    on_fetch: fetching a batch of result rows
+    on_error: compiling or running a query raised an exception
+
+Hooks are called on the thread running the query, and exceptions they raise
+propagate to the caller. QueryStats is a built-in hook aggregating
+execution time percentiles per query fingerprint.
+"""
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from PDOptimizer import PY3
+
+
+# Values counted by their length in row_bytes
+if PY3:
+    sized_types = (str, bytes, bytearray, memoryview)
+else:
+    sized_types = (basestring, bytearray, buffer)
+
+
+events = (
+    'on_compile_start', 'on_compile_end', 'on_execute_start',
+    'on_execute_end', 'on_fetch', 'on_error'
+)
+
+hooks = dict((event, []) for event in events)
+
+
+def _check_event(event):
+    if event not in hooks:
+        raise Exception('Unknown hook event: ' + str(event))
+
+
+def add_hook(event, func):
+    """
+    Calls func with a QueryEvent every time event happens.
+    """
+    _check_event(event)
+    hooks[event].append(func)
+
+
+def remove_hook(event, func):
+    _check_event(event)
+    if func in hooks[event]:
+        hooks[event].remove(func)
+
+
+def clear_hooks():
+    for funcs in hooks.values():
+        del funcs[:]
+
+
+class QueryEvent(object):
+    """
+    Details of a query at one event. Fields that do not apply to the event
+    are None: sql and params once compiled, compile_time and execute_time
+    in seconds at the end of each, rows and bytes (the approximate size of
+    the rows' values) for on_fetch, rows for UPDATE and DELETE, and error
+    for on_error.
+    """
+
+    fields = ('sql', 'params', 'compile_time', 'execute_time', 'rows',
+              'bytes', 'error')
+
+    def __init__(self, event, table, **values):
+        self.event = event
+        self.table = table
+        for field in self.fields:
+            setattr(self, field, values.pop(field, None))
+        if values:
+            raise Exception('Unknown event fields: ' + ', '.join(values))
+
+    @property
+    def fingerprint(self):
+        """
+        Shape of the query, as in PDTable.fingerprint.
+        """
+        return self.table.fingerprint()
+
+    def copy(self, event):
+        return QueryEvent(event, self.table, **dict(
+            (field, getattr(self, field)) for field in self.fields))
+
+    def __repr__(self):
+        return 'QueryEvent({!r}, {!r})'.format(self.event, self.sql)
+
+
+def emit(event, table, **values):
+    """
+    Calls the hooks for event with a QueryEvent holding values.
+    """
+    if hooks[event]:
+        _send(event, QueryEvent(event, table, **values))
+
+
+def _send(event, query_event):
+    funcs = hooks[event]
+    if funcs:
+        if query_event.event != event:
+            query_event = query_event.copy(event)
+        for func in list(funcs):
+            func(query_event)
+
+
+@contextmanager
+def observe(phase, table, **values):
+    """
+    Emits on_<phase>_start before the block and on_<phase>_end after it
+    with <phase>_time set to how long it took, or on_error if it raises.
+    Yields the QueryEvent for the end event, which the block can fill in.
+    """
+    event = QueryEvent(None, table, **values)
+    _send('on_{}_start'.format(phase), event)
+    start = time.time()
+    try:
+        yield event
+    except Exception as e:
+        setattr(event, phase + '_time', time.time() - start)
+        event.error = e
+        _send('on_error', event)
+        raise
+    setattr(event, phase + '_time', time.time() - start)
+    _send('on_{}_end'.format(phase), event)
+
+
+def row_bytes(rows):
+    """
+    Returns the approximate size in bytes of the values in rows, counting
+    strings by length and other values as 8 bytes.
+    """
+    size = 0
+    for row in rows:
+        for value in row:
+            if value is None:
+                continue
+            if isinstance(value, sized_types):
+                size += len(value)
+            else:
+                size += 8
+    return size
+
+
+def fetched(table, sql, params, rows):
+    """
+    Emits on_fetch for rows fetched for table's query.
+    """
+    if hooks['on_fetch']:
+        emit('on_fetch', table, sql=sql, params=params, rows=len(rows),
+             bytes=row_bytes(rows))
+
+
+class ObservedCursor(object):
+    """
+    Wraps a cursor with the results of table's query, emitting on_fetch for
+    the rows fetched from it.
+    """
+
+    def __init__(self, cursor, table, sql, params):
+        self._cursor = cursor
+        self._table = table
+        self._sql = sql
+        self._params = params
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _fetched(self, rows):
+        fetched(self._table, self._sql, self._params, rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(max(self._cursor.arraysize, 100))
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._fetched([row])
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self._cursor.arraysize
+        return self._fetched(self._cursor.fetchmany(size))
+
+    def fetchall(self):
+        return self._fetched(self._cursor.fetchall())
+
+
+def percentile(samples, percent):
+    """
+    Returns the nearest-rank percentile of the sorted list samples.
+    """
+    if not samples:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(samples)))
+    return samples[max(rank, 1) - 1]
+
+
+class QueryStats(object):
+    """
+    In-memory aggregate of query executions per fingerprint. The latest
+    max_samples execution times of each are kept for percentiles.
+    """
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self._queries = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts recording every query run through PDTable.
+        """
+        self.stop()
+        add_hook('on_execute_end', self._executed)
+        add_hook('on_fetch', self._fetched)
+        add_hook('on_error', self._error)
+
+    def stop(self):
+        remove_hook('on_execute_end', self._executed)
+        remove_hook('on_fetch', self._fetched)
+        remove_hook('on_error', self._error)
+
+    def clear(self):
+        with self._lock:
+            self._queries.clear()
+
+    def _entry(self, event):
+        try:
+            key = event.fingerprint
+            entry = self._queries.get(key)
+        except TypeError:
+            # Unhashable literal in the query shape
+            return None
+        if entry is None:
+            entry = self._queries[key] = {
+                'fingerprint': key,
+                'sql': event.sql,
+                'count': 0,
+                'errors': 0,
+                'total_time': 0.0,
+                'rows': 0,
+                'bytes': 0,
+                'samples': deque(maxlen=self.max_samples),
+            }
+        return entry
+
+    def _executed(self, event):
+        with self._lock:
+            entry = self._entry(event)
+            if entry is not None:
+                entry['count'] += 1
+                entry['total_time'] += event.execute_time
+                entry['samples'].append(event.execute_time)
+
+    def _fetched(self, event):
+        with self._lock:
+            entry = self._entry(event)
+            if entry is not None:
+                entry['rows'] += event.rows
+                entry['bytes'] += event.bytes
+
+    def _error(self, event):
+        with self._lock:
+            entry = self._entry(event)
+            if entry is not None:
+                entry['errors'] += 1
+
+    def summary(self):
+        """
+        Returns a dict for each fingerprint with its SQL, execution count,
+        errors, total rows and bytes fetched, and mean, p50, p95, p99 and
+        max execution time in seconds, slowest p99 first.
+        """
+        with self._lock:
+            entries = [dict(entry, samples=sorted(entry['samples']))
+                       for entry in self._queries.values()]
+
+        summary = []
+        for entry in entries:
+            samples = entry.pop('samples')
+            entry['mean'] = (entry['total_time'] / entry['count']
+                             if entry['count'] else None)
+            for percent in (50, 95, 99):
+                entry['p{}'.format(percent)] = percentile(samples, percent)
+            entry['max'] = samples[-1] if samples else None
+            summary.append(entry)
+        # Fingerprints without timed executions have no p99 and go last
+        summary.sort(key=lambda entry: (entry['p99'] is not None,
+                                        entry['p99'] or 0), reverse=True)
+        return summary
@@ -0,0 +1,397 @@
+"""
+Materialized views of PDTable queries, see PDTable.materialize.
+
+    nc = c.group(c.statecode).select(('num_counties', c.count())) \
+          .materialize('num_counties')
+    nc.select(nc.num_counties.avg())
+
+A view stores its query's results in a temporary table on the connection
+of the query's cursor, and materialize returns a PDTable reading from it,
+which is used like PDTable(query) but no longer recomputes the query.
+
+Views are brought up to date by refresh(), or, with refresh='on_write',
+whenever PDTable writes through the view's connection to a table the view
+reads from: after insert_many incrementally when possible, and after
+UPDATE and DELETE in full.
+
+A refresh is incremental for SQLite views of one table with rowids that
+group by plain columns (or not at all) and select those and SUM, COUNT,
+MIN and MAX aggregates, optionally with WHERE clauses. The source must
+only be appended to: rows are found by their rowid being past the largest
+one already aggregated, and their aggregates are merged into the view's
+rows for the same groups. Other views are recomputed in full.
+"""
+import threading
+import weakref
+
+from PDColumn import PDColumn
+from PDExplain import SqliteDialect, dialects
+from PDOptimizer import (is_plain_column, same_column, string_types,
+                         table_refs, walk)
+
+# Views by (their connection, name), see _view_key
+views = {}
+_lock = threading.Lock()
+
+refresh_modes = ('manual', 'on_write')
+
+# How to merge a view's value for a group with that of appended rows
+merge_map = {
+    '_sum': 'SUM',
+    '_count': 'SUM',
+    '_min': 'MIN',
+    '_max': 'MAX',
+}
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _connection(table):
+    return getattr(table._cursor, 'connection', table._cursor)
+
+
+def _view_key(table):
+    # A weak reference to a connection never equals one to another once it
+    # is gone. Connections that cannot be weakly referenced are kept until
+    # they are closed, see _prune, so that another cannot take their id.
+    connection = _connection(table)
+    try:
+        connection = weakref.ref(connection)
+    except TypeError:
+        pass
+    return (connection, table._name)
+
+
+def _closed(connection):
+    if isinstance(connection, weakref.ref):
+        connection = connection()
+        if connection is None:
+            return True
+    if not hasattr(connection, 'cursor'):
+        return False
+    try:
+        connection.cursor().close()
+    except Exception:
+        return True
+    return False
+
+
+def _prune():
+    """
+    Forgets the views of connections that were closed. Must be called with
+    _lock held.
+    """
+    for key in [key for key in views if _closed(key[0])]:
+        del views[key]
+
+
+def _is_sqlite(cursor):
+    module = type(cursor).__module__.split('.')[0]
+    return isinstance(dialects.get(module), SqliteDialect)
+
+
+def materialize(query, name, refresh):
+    """
+    Creates the view name of query and returns a PDTable reading from it.
+    """
+    from PDTable import PDTable
+
+    if refresh not in refresh_modes:
+        raise Exception('Unsupported refresh mode: ' + str(refresh))
+    if query._pool is not None or not query._cursor:
+        raise Exception(
+            'Materialized views require a cursor, since temporary tables '
+            'only exist on the connection that created them')
+    if query._is_write():
+        raise Exception('Only SELECT queries can be materialized')
+
+    table = PDTable(name, cursor=query._cursor,
+                    paramstyle=query._paramstyle)
+    key = _view_key(table)
+    with _lock:
+        _prune()
+        if key in views:
+            raise Exception('Materialized view already exists: ' + name)
+        view = views[key] = MaterializedView(query, table, refresh)
+    try:
+        view.create()
+    except Exception:
+        with _lock:
+            del views[key]
+        raise
+    return table
+
+
+def view_for(table):
+    """
+    Returns the MaterializedView table reads from.
+    """
+    view = views.get(_view_key(table))
+    if view is None or len(table._operation_ordering) > 0:
+        raise Exception('Not a materialized view: ' + str(table._name))
+    return view
+
+
+def source_written(table, appended):
+    """
+    Refreshes the views refreshed on write on the connection of table that
+    read from it, incrementally if rows were only appended to it.
+    """
+    connection = _connection(table)
+    if connection is None:
+        return
+    with _lock:
+        written = [view for view in views.values()
+                   if view.refresh_mode == 'on_write'
+                   and _connection(view.table) is connection
+                   and table._name in view.sources]
+    for view in written:
+        view.refresh(full=not appended)
+
+
+class MaterializedView(object):
+    """
+    The results of query, stored in the temporary table of the PDTable
+    table.
+    """
+
+    def __init__(self, query, table, refresh_mode):
+        self.table = table
+        self.refresh_mode = refresh_mode
+        self.sources = table_refs(query)
+        self._lock = threading.Lock()
+
+        # Largest rowid of the source aggregated so far, for incremental
+        # refreshes
+        self.last_rowid = None
+        self.incremental = _incremental_plan(query)
+        self.query = _named(query)
+
+    def _cursor(self):
+        return self.table._cursor.connection.cursor()
+
+    def _bounded(self, low, high):
+        """
+        Returns the query over the source rows with rowid in (low, high].
+        """
+        query = self.query
+        rowid = query.rowid
+        if low is not None:
+            query = query.where(rowid > low)
+        return query.where(rowid <= high)
+
+    def _max_rowid(self, cursor):
+        cursor.execute('SELECT MAX(rowid) FROM {};'.format(
+            _quote(self.query._name)))
+        row = cursor.fetchone()
+        return row[0] if row and row[0] is not None else 0
+
+    def create(self):
+        cursor = self._cursor()
+        try:
+            query = self.query
+            if self.incremental is not None:
+                try:
+                    self.last_rowid = self._max_rowid(cursor)
+                except Exception:
+                    # No rowids, e.g., a WITHOUT ROWID table or a view
+                    self.incremental = None
+            if self.incremental is not None:
+                query = self._bounded(None, self.last_rowid)
+            sql, params = query.compile(params=True)
+            cursor.execute('CREATE TEMP TABLE {} AS {};'.format(
+                _quote(self.table._name), sql.rstrip(';')), params)
+            self.table._cursor.connection.commit()
+        finally:
+            cursor.close()
+
+    def refresh(self, full=False):
+        """
+        Brings the view up to date with its sources, incrementally unless
+        full is True or the view cannot be refreshed incrementally.
+        """
+        from PDTable import result_cache
+
+        with self._lock:
+            connection = self.table._cursor.connection
+            cursor = connection.cursor()
+            try:
+                if full or self.incremental is None:
+                    self._refresh_full(cursor)
+                else:
+                    self._refresh_appended(cursor)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
+        result_cache.invalidate([self.table._name])
+
+    def _refresh_full(self, cursor):
+        query = self.query
+        if self.incremental is not None:
+            self.last_rowid = self._max_rowid(cursor)
+            query = self._bounded(None, self.last_rowid)
+        sql, params = query.compile(params=True)
+        name = _quote(self.table._name)
+        cursor.execute('DELETE FROM {};'.format(name))
+        cursor.execute('INSERT INTO {} {};'.format(name, sql.rstrip(';')),
+                       params)
+
+    def _refresh_appended(self, cursor):
+        last_rowid = self._max_rowid(cursor)
+        if last_rowid <= self.last_rowid:
+            return
+        keys, columns = self.incremental
+        name = _quote(self.table._name)
+        delta = _quote(self.table._name + '_delta')
+
+        # Aggregate the appended rows, add the view's rows for the groups
+        # they touch, and replace those rows by the aggregates of both.
+        sql, params = self._bounded(
+            self.last_rowid, last_rowid).compile(params=True)
+        cursor.execute('DROP TABLE IF EXISTS {};'.format(delta))
+        cursor.execute('CREATE TEMP TABLE {} AS {};'.format(
+            delta, sql.rstrip(';')), params)
+
+        def matches(table):
+            # Rows of table in a group of the appended rows
+            return 'EXISTS ( SELECT 1 FROM {} d WHERE {} )'.format(
+                delta, ' AND '.join(
+                    ['d.{0} IS {1}.{0}'.format(_quote(key), table)
+                     for key in keys] + ['1']))
+
+        try:
+            names = ' , '.join(_quote(column) for column, _ in columns)
+            cursor.execute('INSERT INTO {} ( {} ) SELECT {} FROM {} v '
+                           'WHERE {};'.format(delta, names, names, name,
+                                              matches('v')))
+            cursor.execute('DELETE FROM {} WHERE {};'.format(
+                name, matches(name)))
+            merged = ' , '.join(
+                _quote(column) if merge is None else
+                '{}( {} )'.format(merge, _quote(column))
+                for column, merge in columns)
+            group = ''
+            if keys:
+                group = ' GROUP BY ' + ' , '.join(
+                    _quote(key) for key in keys)
+            cursor.execute('INSERT INTO {} ( {} ) SELECT {} FROM {}{};'.format(
+                name, names, merged, delta, group))
+        except Exception:
+            # Dropping a table commits on some drivers, so the partial
+            # merge is rolled back first
+            cursor.connection.rollback()
+            raise
+        finally:
+            cursor.execute('DROP TABLE IF EXISTS {};'.format(delta))
+        self.last_rowid = last_rowid
+
+    def drop(self):
+        """
+        Drops the view's temporary table.
+        """
+        with _lock:
+            views.pop(_view_key(self.table), None)
+        cursor = self._cursor()
+        try:
+            cursor.execute('DROP TABLE IF EXISTS {};'.format(
+                _quote(self.table._name)))
+        finally:
+            cursor.close()
+
+
+def _select_name(col, idx):
+    if 'name' in col:
+        return col['name']
+    if is_plain_column(col['column']):
+        return col['column'].name
+    return 'column{}'.format(idx + 1)
+
+
+def _named(query):
+    """
+    Returns query with every selected column named, so that they can be
+    referred to in the view: after the column for plain columns, and by
+    position (column1, ...) otherwise.
+    """
+    from PDTable import OperationList
+
+    ops = list(query._operation_ordering)
+    selects = []
+    for op, col in ops:
+        if op == '_select':
+            selects.extend(col)
+    if not selects:
+        return query
+
+    named = []
+    for idx, col in enumerate(selects):
+        name = _select_name(col, idx)
+        if name in [select['name'] for select in named]:
+            raise Exception('Duplicate column name in view: ' + name)
+        named.append({'name': name, 'column': col['column']})
+    ops = [(op, col) for op, col in ops if op != '_select']
+    ops.append(('_select', named))
+    query = query._derive()
+    query._operation_ordering = OperationList.from_iterable(ops)
+    return query
+
+
+def _incremental_plan(query):
+    """
+    Returns (group column names, [(column name, merge function or None for
+    group columns)]) for merging appended rows into the view of query, or
+    None if it cannot be refreshed incrementally.
+    """
+    from PDTable import PDTable
+
+    # Rows are found by rowid, which only SQLite tables have
+    if not _is_sqlite(query._cursor):
+        return None
+    if (not isinstance(query._name, string_types) or query._children
+            or query._distinct or query._limit is not None):
+        return None
+    clauses = {}
+    for op, col in query._operation_ordering:
+        if op == '_select':
+            clauses.setdefault(op, []).extend(col)
+        else:
+            clauses.setdefault(op, []).append(col)
+    if set(clauses) - set(['_select', '_where', '_group']):
+        return None
+    if '_select' not in clauses:
+        return None
+
+    # Subqueries may read tables that change in other ways
+    subqueries = []
+    walk(query, lambda node: subqueries.append(node)
+         if isinstance(node, PDTable) and node is not query else None)
+    if subqueries:
+        return None
+
+    groups = clauses.get('_group', [])
+    if not all(is_plain_column(group) for group in groups):
+        return None
+
+    keys = []
+    columns = []
+    for idx, col in enumerate(clauses['_select']):
+        name = _select_name(col, idx)
+        node = col['column']
+        matched = [group for group in groups if same_column(group, node)]
+        if matched:
+            keys.append(name)
+            columns.append((name, None))
+        elif (isinstance(node, PDColumn) and len(node.ops) == 1
+                and node.ops[0] in merge_map and node.null is None):
+            columns.append((name, merge_map[node.ops[0]]))
+        else:
+            return None
+    if len(keys) != len(groups):
+        # Every group column must be in the view to merge by it
+        return None
+    return keys, columns
@@ -0,0 +1,1060 @@
+"""
+Rule-based rewrites applied to query ASTs before they are compiled.
+
+An Optimizer runs each of its enabled rules at every level of the tree:
+table rules top-down, so rewrites of a query are seen by its subqueries,
+and column rules bottom-up. Rules never modify the tables and columns they
+are given, since those are shared with the caller's queries, and instead
+return rewritten copies.
+
+The compiler uses the shared optimizer in this module. Toggle its rules with
+optimizer.disable(name) and optimizer.enable(name), and set
+optimizer.debug = True to report which rewrites fire on each compile.
+"""
+import copy
+import functools
+import numbers
+import sys
+from collections import namedtuple
+
+from PDColumn import PDColumn
+
+PY3 = sys.version_info[0] >= 3
+string_types = str if PY3 else basestring
+integer_types = (int,) if PY3 else (int, long)
+text_type = str if PY3 else unicode
+
+
+# A rewrite that fired, named by its rule with a description of what it did.
+Rewrite = namedtuple('Rewrite', ['rule', 'detail'])
+
+
+class Rule(object):
+    """
+    A rewrite of table or column nodes. Subclasses set name and override
+    rewrite_table or rewrite_column, which return the rewritten node, or
+    None if the rule does not apply, and append a Rewrite to fired for each
+    rewrite made.
+    """
+
+    name = None
+
+    def rewrite_table(self, node, fired):
+        return None
+
+    def rewrite_column(self, node, fired):
+        return None
+
+
+################################################################
+# AST helpers
+################################################################
+
+# PDTable, imported on first use since PDTable imports this module
+_PDTable = None
+
+
+def _table_class():
+    global _PDTable
+    if _PDTable is None:
+        from PDTable import PDTable
+        _PDTable = PDTable
+    return _PDTable
+
+
+def _is_table(node):
+    return isinstance(node, _PDTable or _table_class())
+
+
+def _is_column(node):
+    return isinstance(node, PDColumn)
+
+
+def is_base_table(table):
+    """
+    Returns True if table reads directly from a database table rather than
+    from a subquery or set operation.
+    """
+    return isinstance(table._name, string_types) and not table._children
+
+
+def same_table(a, b):
+    """
+    Returns True if a and b refer to the same database table under the same
+    alias.
+    """
+    return (a is not None and b is not None and is_base_table(a)
+            and is_base_table(b) and a._name == b._name
+            and a._alias == b._alias)
+
+
+def is_plain_column(col):
+    """
+    Returns True if col is a bare column reference, without any operators,
+    null check or subquery.
+    """
+    return (_is_column(col) and not col._children and not col.ops
+            and col.null is None and col.subquery is None
+            and not col._count)
+
+
+def same_column(a, b):
+    """
+    Returns True if the plain columns a and b refer to the same column of
+    the same table or subquery.
+    """
+    if not (is_plain_column(a) and is_plain_column(b)):
+        return False
+    # Columns of the same table object are interned
+    if a is b:
+        return True
+    if a.name != b.name:
+        return False
+    if a.table is None or b.table is None:
+        return a.table is b.table
+    if same_table(a.table, b.table):
+        return True
+    return (_is_table(a.table._name) and a.table._name is b.table._name
+            and a.table._alias == b.table._alias)
+
+
+def conjuncts(col):
+    """
+    Returns the terms of col if it is an AND of conditions, or [col].
+    """
+    if (_is_column(col) and col._binary_op == '_and' and not col.ops
+            and col.null is None):
+        return conjuncts(col._children[0]) + conjuncts(col._children[1])
+    return [col]
+
+
+def column_refs(node):
+    """
+    Returns the column references in the column or table node, or None if
+    it contains a subquery.
+    """
+    refs = []
+
+    def visit(node):
+        if _is_table(node):
+            return False
+        if not _is_column(node):
+            return True
+        if node.subquery is not None:
+            return False
+        if not node._children:
+            refs.append(node)
+            return True
+        return all(visit(child) for child in node._children)
+
+    if visit(node):
+        return refs
+    return None
+
+
+def table_refs(node):
+    """
+    Returns the set of names of the database tables the table or column
+    node reads from, in FROM, joins, set operations and subqueries.
+    """
+    names = set()
+
+    def visit(child):
+        if _is_table(child) and isinstance(child._name, string_types):
+            names.add(child._name)
+    walk(node, visit)
+    return names
+
+
+def has_aggregate(node):
+    """
+    Returns True if the column node applies an aggregate function anywhere.
+    """
+    if not _is_column(node):
+        return False
+    if any(op in PDColumn.aggregate_list for op in node.ops):
+        return True
+    return any(has_aggregate(child) for child in node._children)
+
+
+def map_children(node, func):
+    """
+    Returns node with each child node (column, table or literal) replaced
+    by func(child), or node itself if func returns every child unchanged.
+    Tables are copied with _derive and columns with copy.copy.
+    """
+    from PDTable import OperationList
+
+    if _is_column(node):
+        children = tuple(func(child) for child in node._children)
+        subquery = node.subquery
+        if subquery is not None:
+            subquery = func(subquery)
+        if (subquery is node.subquery and
+                all(new is old for new, old in zip(children, node._children))):
+            return node
+        node = copy.copy(node)
+        node._children = children
+        node.subquery = subquery
+        return node
+
+    if not _is_table(node):
+        return node
+
+    changed = []
+
+    def mapped(value):
+        new_value = func(value)
+        if new_value is not value:
+            changed.append(True)
+        return new_value
+
+    children = tuple(mapped(child) for child in node._children)
+    name = node._name
+    if _is_table(name):
+        name = mapped(name)
+
+    ops = []
+    for op, col in node._operation_ordering:
+        if op == '_select':
+            new_cols = [dict(select, column=mapped(select['column']))
+                        for select in col]
+            ops.append((op, new_cols))
+        elif op == '_join':
+            cond = col['cond']
+            if cond is not None:
+                cond = mapped(cond)
+            ops.append((op, {'table': mapped(col['table']), 'cond': cond}))
+        elif op == '_update':
+            ops.append((op, [(name_, mapped(value))
+                             for name_, value in col]))
+        elif op == '_delete':
+            ops.append((op, col))
+        else:
+            ops.append((op, mapped(col)))
+
+    if not changed:
+        return node
+    node = node._derive()
+    node._children = children
+    node._name = name
+    node._operation_ordering = OperationList.from_iterable(ops)
+    return node
+
+
+def walk(node, func):
+    """
+    Calls func with node and every column, table and literal below it.
+    """
+    def visit(child):
+        func(child)
+        map_children(child, visit)
+        return child
+    visit(node)
+
+
+def replace_from(node, sub):
+    """
+    Returns node selecting from the subquery sub instead of its current
+    one, with its columns of the current subquery referring to sub.
+    """
+    old = node._name
+    tables = {}
+
+    def retarget(item):
+        if item is old:
+            return sub
+        if (_is_column(item) and not item._children and item.table is not None
+                and item.table._name is old):
+            if id(item.table) not in tables:
+                table = copy.copy(item.table)
+                table._name = sub
+                tables[id(item.table)] = table
+            item = copy.copy(item)
+            item.table = tables[id(item.table)]
+            return item
+        return map_children(item, retarget)
+    return map_children(node, retarget)
+
+
+def _with_operations(node, ops):
+    from PDTable import OperationList
+    node = node._derive()
+    node._operation_ordering = OperationList.from_iterable(ops)
+    return node
+
+
+################################################################
+# Rules
+################################################################
+
+class ConstantFolding(Rule):
+    """
+    Folds chains of integer literal arithmetic, e.g., (col + 1) - 3 to
+    col - 2 and (col * 2) * 3 to col * 6.
+
+    Only literals compiled into the query are folded. Bound parameters are
+    not part of the cached query shape, so their values are left to the
+    database.
+    """
+
+    name = 'constant_folding'
+
+    additive = ('_add', '_sub')
+    symbols = {'_add': '+', '_sub': '-', '_mul': '*'}
+
+    def rewrite_column(self, node, fired):
+        op = node._binary_op
+        if op not in ('_add', '_sub', '_mul') or len(node._children) != 2:
+            return None
+        left, right = node._children
+        if not self._foldable(right):
+            return None
+
+        if self._foldable(left):
+            if node.ops or node.null is not None:
+                return None
+            value = self._apply(op, left, right)
+            fired.append(Rewrite(self.name, '{} {} {} to {}'.format(
+                left, self.symbols[op], right, value)))
+            return value
+
+        if (not _is_column(left) or left.ops or left.null is not None
+                or left.subquery is not None or len(left._children) != 2
+                or not self._foldable(left._children[1])):
+            return None
+        inner = left._binary_op
+        if op == '_mul' and inner == '_mul':
+            new_op = '_mul'
+            value = left._children[1] * right
+        elif op in self.additive and inner in self.additive:
+            value = (self._sign(inner) * left._children[1]
+                     + self._sign(op) * right)
+            new_op = '_sub' if value < 0 else '_add'
+            value = abs(value)
+        else:
+            return None
+
+        new_node = copy.copy(node)
+        new_node._binary_op = new_op
+        new_node._children = (left._children[0], value)
+        fired.append(Rewrite(self.name, '{} {} {} {} to {} {}'.format(
+            self.symbols[inner], left._children[1], self.symbols[op], right,
+            self.symbols[new_op], value)))
+        return new_node
+
+    def _foldable(self, value):
+        return (isinstance(value, numbers.Integral)
+                and not isinstance(value, bool))
+
+    def _sign(self, op):
+        return -1 if op == '_sub' else 1
+
+    def _apply(self, op, left, right):
+        if op == '_add':
+            return left + right
+        if op == '_sub':
+            return left - right
+        return left * right
+
+
+class ExistsToIn(Rule):
+    """
+    Rewrites EXISTS to IN when the following conditions are met:
+        * There is at least one restrictive equality condition on
+          the subquery. E.g., where(subtable.col = 123)
+        * There is an equality correlation between the queries.
+    """
+
+    name = 'exists_to_in'
+
+    def rewrite_table(self, node, fired):
+        if not is_base_table(node) or not node.has_query('_where_exists'):
+            return None
+
+        ops = []
+        in_cols = []
+        for op in node._operation_ordering:
+            if op[0] == '_where_exists':
+                in_col = self._rewrite(node, op[1])
+                if in_col is not None:
+                    in_cols.append(('_where', in_col))
+                    fired.append(Rewrite(self.name, 'EXISTS on {} to IN'
+                                         .format(op[1]._name)))
+                    continue
+            ops.append(op)
+
+        if not in_cols:
+            return None
+        return _with_operations(node, ops + in_cols)
+
+    def _rewrite(self, parent, child):
+        """
+        Returns the IN condition replacing EXISTS child in parent, or None
+        if it cannot be rewritten.
+        """
+        if not is_base_table(child) or child._limit is not None:
+            return None
+        if child.has_query('_group') or child.has_query('_having'):
+            return None
+
+        selective = False
+        correlation_pair = None
+        ops = list(child._operation_ordering)
+        for idx, (op, col) in enumerate(ops):
+            if op != '_where' or not _is_column(col):
+                continue
+            if col._binary_op != '_eq' or col.ops or col.null is not None:
+                continue
+
+            # Check for selectivity
+            c1, c2 = col._children
+            refs_child = any(_is_column(i) and same_table(i.table, child)
+                             for i in (c1, c2))
+            has_literal = any(not (_is_table(i) or _is_column(i))
+                              for i in (c1, c2))
+            selective = selective or (refs_child and has_literal)
+
+            # Check for correlation
+            if is_plain_column(c1) and is_plain_column(c2):
+                if (same_table(c1.table, parent)
+                        and same_table(c2.table, child)):
+                    correlation_pair = (idx, c1, c2)
+                elif (same_table(c1.table, child)
+                        and same_table(c2.table, parent)):
+                    correlation_pair = (idx, c2, c1)
+
+        # A rewrite is only worthwhile if the subquery is selective and is
+        # correlated with the parent.
+        if not (selective and correlation_pair):
+            return None
+
+        # Remove the correlation from the subquery's WHERE clauses and
+        # select the correlated column instead.
+        idx, parent_col, child_col = correlation_pair
+        child = _with_operations(
+            child,
+            [op for op_idx, op in enumerate(ops)
+             if op_idx != idx and op[0] != '_select']
+            + [('_select', [{'column': child_col}])])
+        return parent_col.in_(child)
+
+
+class InToJoin(Rule):
+    """
+    Rewrites col IN (SELECT sub.col FROM sub WHERE ...) in the WHERE clause
+    of a SELECT DISTINCT query to an INNER JOIN on sub.
+
+    The join can match a row more than once, so the rewrite is only safe
+    when DISTINCT removes those duplicates: the query must select plain
+    columns without aggregates, GROUP BY or LIMIT, and the subquery must
+    select one column of a database table with uncorrelated conditions.
+    """
+
+    name = 'in_to_join'
+
+    def rewrite_table(self, node, fired):
+        if not node._distinct or not is_base_table(node):
+            return None
+        if node._limit is not None or node._is_write():
+            return None
+
+        ops = list(node._operation_ordering)
+        tables = [node]
+        for op, col in ops:
+            if op in ('_group', '_having', '_where_exists'):
+                return None
+            if op == '_select':
+                if any(has_aggregate(select['column']) for select in col):
+                    return None
+            elif op == '_join':
+                if not is_base_table(col['table']):
+                    return None
+                tables.append(col['table'])
+        if not node.has_query('_select'):
+            return None
+
+        # Columns without a table are emitted unqualified and could become
+        # ambiguous once another table is joined.
+        for op, col in ops:
+            if op == '_select':
+                items = [select['column'] for select in col]
+            elif op in ('_where', '_order'):
+                items = [col]
+            else:
+                continue
+            for item in items:
+                if any(ref.table is None for ref in column_refs(item) or ()):
+                    return None
+
+        new_ops = []
+        added = []
+        for op, col in ops:
+            if op == '_where':
+                rewritten = self._rewrite(col, tables)
+                if rewritten is not None:
+                    join, conditions = rewritten
+                    tables.append(join['table'])
+                    added.append(('_join', join))
+                    added.extend(('_where', cond) for cond in conditions)
+                    fired.append(Rewrite(self.name, 'IN subquery on {} to JOIN'
+                                         .format(join['table']._name)))
+                    continue
+            new_ops.append((op, col))
+
+        if not added:
+            return None
+        return _with_operations(node, new_ops + added)
+
+    def _rewrite(self, col, tables):
+        """
+        Returns (join, conditions) for the WHERE condition col, or None if
+        it is not an IN subquery that can be joined.
+        """
+        if (not _is_column(col) or col._binary_op != '_in' or col.ops
+                or col.null is not None):
+            return None
+        left, sub = col._children
+        if not _is_table(sub) or not is_base_table(sub):
+            return None
+        if sub._distinct or sub._limit is not None:
+            return None
+        if any(same_table(sub, table) for table in tables):
+            return None
+
+        selected = None
+        conditions = []
+        for op, sub_col in sub._operation_ordering:
+            if op == '_select':
+                if selected is not None or len(sub_col) != 1:
+                    return None
+                selected = sub_col[0]['column']
+            elif op == '_where':
+                refs = column_refs(sub_col)
+                if refs is None or not all(same_table(ref.table, sub)
+                                           for ref in refs):
+                    return None
+                conditions.append(sub_col)
+            elif op != '_order':
+                return None
+
+        if not is_plain_column(selected) or not same_table(selected.table,
+                                                           sub):
+            return None
+
+        from PDTable import PDTable
+        table = PDTable(sub._name, alias=sub._alias)
+        return {'table': table, 'cond': left == selected}, conditions
+
+
+class PredicatePushdown(Rule):
+    """
+    Moves WHERE conditions into the subqueries they filter, so rows are
+    filtered before the subquery's results are built, e.g.,
+
+        SELECT * FROM ( SELECT t.a AS "x" FROM t ) WHERE ( x > 5 )
+
+    becomes SELECT * FROM ( SELECT t.a AS "x" FROM t WHERE ( t.a > 5 ) ).
+
+    Conditions (or the terms of an AND) are pushed into a subquery in FROM
+    when they only refer to its columns, and into a joined subquery when
+    they only refer to the table it selects from, with the expressions the
+    subquery selects for the columns they refer to. A subquery with GROUP BY
+    only takes conditions on its grouping columns, and one with a LIMIT
+    takes none.
+    """
+
+    name = 'predicate_pushdown'
+
+    def rewrite_table(self, node, fired):
+        from_node = self._push_into_from(node, fired)
+        join_node = self._push_into_joins(from_node or node, fired)
+        return join_node or from_node
+
+    def _push_into_from(self, node, fired):
+        if not node.has_query('_where') or not self._pushable(node):
+            return None
+        sub = node._name
+        outputs = self.outputs(sub)
+        if outputs is None:
+            return None
+
+        # Ungrouped subqueries in FROM pass conditions on to their own FROM
+        # subqueries. Conditions of node and of each of them are moved
+        # straight into the innermost one, since moving them a level at a
+        # time would move each again at every level below it.
+        levels = [node]
+        while (self._passes_through(levels[-1]._name)
+               and self._pushable(levels[-1]._name)):
+            levels.append(levels[-1]._name)
+        resolve = self.outputs(levels[-1]._name)
+        while resolve is None:
+            levels.pop()
+            resolve = self.outputs(levels[-1]._name)
+        resolvers = [resolve]
+        for level in reversed(levels[1:]):
+            resolvers.append(self._compose(
+                self.outputs(level), level._name, resolvers[-1]))
+        resolvers.reverse()
+
+        # Conditions of node that cannot reach the innermost subquery are
+        # still moved into sub
+        into_sub = []
+
+        def push(cond):
+            new_cond = self.substitute(cond, sub, resolvers[0])
+            if new_cond is None and len(levels) > 1:
+                new_cond = self.substitute(cond, sub, outputs)
+                if new_cond is not None:
+                    into_sub.append(new_cond)
+            return new_cond
+
+        partitions = []
+        for level, resolve in zip(levels, resolvers):
+            if level is node:
+                ops, pushed = self._partition(level, push)
+                pushed = [cond for cond in pushed
+                          if not any(cond is other for other in into_sub)]
+            else:
+                ops, pushed = self._partition(
+                    level, lambda cond: self.substitute(cond, level._name,
+                                                        resolve))
+            partitions.append((ops, pushed))
+        moved = (sum(len(conds) for _, conds in partitions)
+                 + len(into_sub))
+        if not moved:
+            return None
+        fired.append(Rewrite(
+            self.name,
+            'pushed {} WHERE conditions into subquery'.format(moved)))
+
+        target = levels[-1]._name
+        new_node = _with_operations(
+            target, list(target._operation_ordering)
+            + [('_where', cond)
+               for _, conds in reversed(partitions) for cond in conds])
+        for idx in reversed(range(len(levels))):
+            ops = partitions[idx][0]
+            if idx == 1:
+                ops = ops + [('_where', cond) for cond in into_sub]
+            new_node = replace_from(_with_operations(levels[idx], ops),
+                                    new_node)
+        return new_node
+
+    def _pushable(self, node):
+        """
+        Returns True if node selects from a subquery that its WHERE
+        conditions may be moved into.
+        """
+        sub = node._name
+        return (_is_table(sub) and not node._children and not sub._children
+                and not node.has_query('_join') and sub._limit is None
+                and not sub._is_write())
+
+    def _passes_through(self, sub):
+        """
+        Returns True if sub is an ungrouped subquery, so conditions on its
+        results can be moved into its own FROM.
+        """
+        return _is_table(sub) and self._grouping(sub) is None
+
+    def _compose(self, outputs, sub, inner):
+        """
+        Returns a function mapping a column name to the expression outputs
+        maps it to, with the columns of sub it refers to replaced using
+        inner.
+        """
+        cache = {}
+
+        def output(name):
+            if name not in cache:
+                expr = outputs(name)
+                cache[name] = (None if expr is None
+                               else self.substitute(expr, sub, inner))
+            return cache[name]
+        return output
+
+    def _push_into_joins(self, node, fired):
+        if (not is_base_table(node) or not node.has_query('_join')
+                or not node.has_query('_where')):
+            return None
+
+        joins = [col for op, col in node._operation_ordering if op == '_join']
+        tables = [node] + [join['table'] for join in joins]
+        targets = []
+        for join in joins:
+            table = join['table']
+            if (len(table._operation_ordering) == 0
+                    or not is_base_table(table) or table._limit is not None
+                    or table.has_query('_join')
+                    or len([other for other in tables
+                            if same_table(other, table)]) > 1):
+                targets.append(None)
+            else:
+                targets.append(table)
+
+        pushed = [[] for _ in joins]
+
+        def push(cond):
+            refs = column_refs(cond)
+            if not refs:
+                return None
+            for idx, target in enumerate(targets):
+                if target is None or not all(same_table(ref.table, target)
+                                             for ref in refs):
+                    continue
+                new_cond = self.substitute(cond, target,
+                                           self.outputs(target), joined=True)
+                if new_cond is not None:
+                    pushed[idx].append(new_cond)
+                return new_cond
+            return None
+
+        ops, moved = self._partition(node, push)
+        if not moved:
+            return None
+        fired.append(Rewrite(
+            self.name, 'pushed {} WHERE conditions into joined subqueries'
+            .format(len(moved))))
+
+        join_idx = 0
+        new_ops = []
+        for op, col in ops:
+            if op == '_join':
+                conds = pushed[join_idx]
+                join_idx += 1
+                if conds:
+                    table = col['table']
+                    col = {'table': _with_operations(
+                        table, list(table._operation_ordering)
+                        + [('_where', cond) for cond in conds]),
+                        'cond': col['cond']}
+            new_ops.append((op, col))
+        return _with_operations(node, new_ops)
+
+    def _partition(self, node, push):
+        """
+        Calls push with each term of the AND in each of node's WHERE
+        conditions. Returns node's operations without the terms that push
+        returned a condition for, and the list of those conditions.
+        """
+        ops = []
+        pushed = []
+        for op, col in node._operation_ordering:
+            if op != '_where':
+                ops.append((op, col))
+                continue
+            kept = []
+            for term in conjuncts(col):
+                new_term = push(term)
+                if new_term is None:
+                    kept.append(term)
+                else:
+                    pushed.append(new_term)
+            if len(kept) == len(conjuncts(col)):
+                ops.append((op, col))
+            elif kept:
+                ops.append((op, functools.reduce(lambda a, b: a & b, kept)))
+        return ops, pushed
+
+    def _grouping(self, sub):
+        """
+        Returns the plain columns sub groups by, or None if it is not
+        grouped. sub is grouped if it selects aggregates, even without a
+        GROUP BY, since filtering its rows first would change them.
+        """
+        groups = []
+        aggregated = False
+        for op, col in sub._operation_ordering:
+            if op == '_group':
+                groups.append(col)
+            elif op == '_select':
+                aggregated = aggregated or any(
+                    has_aggregate(select['column']) for select in col)
+        if not groups and not aggregated and not sub.has_query('_having'):
+            return None
+        return [col for col in groups if is_plain_column(col)]
+
+    def outputs(self, sub):
+        """
+        Returns a function mapping a column name of the subquery's results to
+        the expression it selects, or None if the name is ambiguous, not
+        selected, or cannot be filtered on before the subquery's GROUP BY.
+        Returns None if no columns can be mapped.
+        """
+        selects = []
+        for op, col in sub._operation_ordering:
+            if op == '_select':
+                selects.extend(col)
+        groups = self._grouping(sub)
+
+        def filterable(expr):
+            if has_aggregate(expr):
+                return False
+            return groups is None or any(same_column(expr, group)
+                                         for group in groups)
+
+        if not selects:
+            # SELECT * only has unambiguous names from a single table
+            if sub.has_query('_join'):
+                return None
+
+            def output(name):
+                expr = PDColumn(name, sub)
+                return expr if filterable(expr) else None
+            return output
+
+        names = {}
+        for select in selects:
+            if 'name' in select:
+                name = select['name']
+            elif is_plain_column(select['column']):
+                name = select['column'].name
+            else:
+                continue
+            names.setdefault(name, []).append(select['column'])
+
+        def output(name):
+            exprs = names.get(name, ())
+            if len(exprs) == 1 and filterable(exprs[0]):
+                return exprs[0]
+            return None
+        return output
+
+    def substitute(self, col, sub, outputs, joined=False):
+        """
+        Returns col with each reference to a column of sub replaced by the
+        expression sub selects for it, or None if col refers to anything
+        else. If joined is True, sub is a joined subquery, whose columns are
+        referred to as columns of the table it selects from.
+        """
+        refs = column_refs(col)
+        if not refs or not _is_column(col):
+            return None
+
+        replacements = {}
+        for ref in refs:
+            if ref.table is None:
+                return None
+            if joined and not same_table(ref.table, sub):
+                return None
+            if not joined and ref.table._name is not sub:
+                return None
+            expr = outputs(ref.name)
+            if expr is None:
+                return None
+            if is_plain_column(ref):
+                replacements[id(ref)] = expr
+            elif is_plain_column(expr):
+                new_expr = copy.copy(expr)
+                new_expr.ops = tuple(ref.ops)
+                new_expr.unary_op = ref.unary_op
+                new_expr.null = ref.null
+                replacements[id(ref)] = new_expr
+            else:
+                return None
+
+        def replace(node):
+            if id(node) in replacements:
+                return replacements[id(node)]
+            return map_children(node, replace)
+        return replace(col)
+
+
+class ProjectionPruning(Rule):
+    """
+    Narrows SELECT * in a subquery in FROM to the columns the query
+    selecting from it refers to, e.g.,
+
+        SELECT a FROM ( SELECT * FROM t WHERE ( t.b > 1 ) )
+
+    becomes SELECT a FROM ( SELECT t.a FROM t WHERE ( t.b > 1 ) ).
+
+    The subquery must select from a single table without DISTINCT or GROUP
+    BY, and must not be part of a set operation.
+    """
+
+    name = 'projection_pruning'
+
+    def rewrite_table(self, node, fired):
+        sub = node._name
+        if not _is_table(sub) or node._children or sub._children:
+            return None
+        # Without a SELECT, every column of the subquery is in the results
+        if not node.has_query('_select') or node.has_query('_join'):
+            return None
+        if sub._distinct or sub._is_write():
+            return None
+        if (sub.has_query('_select') or sub.has_query('_join')
+                or sub.has_query('_group')):
+            return None
+
+        names = []
+        bare = []
+
+        def collect(item):
+            if (not _is_column(item) or item._children
+                    or item.subquery is not None or item.name == '*'):
+                return
+            if item.table is None:
+                # Columns without a table may be any of the subquery's
+                bare.append(item)
+            elif item.table._name is sub and item.name not in names:
+                names.append(item.name)
+        walk(node, collect)
+
+        if not names or bare:
+            return None
+        fired.append(Rewrite(self.name, 'SELECT * to {} columns'.format(
+            len(names))))
+        return replace_from(node, _with_operations(
+            sub, list(sub._operation_ordering)
+            + [('_select', [{'column': PDColumn(name, sub)}
+                            for name in names])]))
+
+
+################################################################
+# Pass manager
+################################################################
+
+def default_rules():
+    """
+    Returns new instances of the built-in rules, in the order they run.
+    """
+    return [ConstantFolding(), ExistsToIn(), InToJoin(), PredicatePushdown(),
+            ProjectionPruning()]
+
+
+class Optimizer(object):
+    """
+    Runs rules over query ASTs, all of them enabled by default.
+
+    If debug is True, compiling a query bypasses the compiled SQL cache and
+    each rewrite that fires is reported by writing it to stream (stderr by
+    default).
+    """
+
+    # Maximum number of times the table rules are run on a single node
+    max_passes = 10
+
+    def __init__(self, rules=None, debug=False, stream=None):
+        self.rules = list(rules) if rules is not None else default_rules()
+        self.debug = debug
+        self.stream = stream
+        self._enabled = [rule.name for rule in self.rules]
+
+    @property
+    def enabled(self):
+        """
+        Tuple of the names of the enabled rules, in the order they run.
+        """
+        return tuple(self._enabled)
+
+    def _check_rule(self, name):
+        if name not in [rule.name for rule in self.rules]:
+            raise Exception('Unknown optimizer rule: ' + str(name))
+
+    def enable(self, name):
+        """
+        Enables the rule called name.
+        """
+        self._check_rule(name)
+        if name not in self._enabled:
+            self._enabled = [rule.name for rule in self.rules
+                             if rule.name in self._enabled
+                             or rule.name == name]
+
+    def disable(self, name):
+        """
+        Disables the rule called name.
+        """
+        self._check_rule(name)
+        self._enabled = [rule_name for rule_name in self._enabled
+                         if rule_name != name]
+
+    def optimize(self, ast):
+        """
+        Returns (node, rewrites), where node is ast rewritten by the enabled
+        rules and rewrites lists the Rewrites that fired, in order.
+        """
+        rules = [rule for rule in self.rules if rule.name in self._enabled]
+        # Only call the rules that rewrite each kind of node
+        table_rules = [rule for rule in rules
+                       if _overrides(rule, 'rewrite_table')]
+        column_rules = [rule for rule in rules
+                        if _overrides(rule, 'rewrite_column')]
+        fired = []
+        if rules:
+            ast = self._rewrite(ast, table_rules, column_rules, fired)
+        return ast, fired
+
+    def report(self, rewrites):
+        """
+        Writes each of rewrites to stream, one per line.
+        """
+        stream = self.stream or sys.stderr
+        for rewrite in rewrites:
+            stream.write('[{}] {}\n'.format(rewrite.rule, rewrite.detail))
+
+    def _rewrite(self, ast, table_rules, column_rules, fired):
+        """
+        Returns ast rewritten by table_rules top-down and column_rules
+        bottom-up. Nodes are only copied when one of their children is
+        rewritten, and literals are not visited.
+        """
+        table_class = _table_class()
+
+        def visit(node):
+            if isinstance(node, PDColumn):
+                return visit_column(node)
+            if not isinstance(node, table_class):
+                return node
+            for _ in range(self.max_passes):
+                changed = False
+                for rule in table_rules:
+                    new_node = rule.rewrite_table(node, fired)
+                    if new_node is not None:
+                        node = new_node
+                        changed = True
+                if not changed:
+                    break
+            return map_children(node, visit)
+
+        def visit_column(node):
+            children = None
+            for idx, child in enumerate(node._children):
+                if isinstance(child, (PDColumn, table_class)):
+                    new_child = visit(child)
+                    if new_child is not child:
+                        if children is None:
+                            children = list(node._children)
+                        children[idx] = new_child
+            subquery = node.subquery
+            if subquery is not None:
+                subquery = visit(subquery)
+            if children is not None or subquery is not node.subquery:
+                node = copy.copy(node)
+                if children is not None:
+                    node._children = tuple(children)
+                node.subquery = subquery
+
+            for rule in column_rules:
+                new_node = rule.rewrite_column(node, fired)
+                if new_node is not None:
+                    node = new_node
+                    if not isinstance(node, PDColumn):
+                        break
+            return node
+
+        return visit(ast)
+
+
+def _overrides(rule, method):
+    """
+    Returns True if rule implements method rather than inheriting Rule's.
+    """
+    return getattr(type(rule), method) != getattr(Rule, method)
+
+
+# Shared optimizer used by the compiler
+optimizer = Optimizer()
@@ -0,0 +1,251 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+def ping(connection):
+    """
+    Default health check, runs a trivial query on the connection.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+        cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of database connections created by factory.
+
+    Up to size connections are kept open for reuse. When they are all
+    checked out, up to max_overflow extra connections are opened and closed
+    again when returned. Past that, callers wait up to timeout seconds for a
+    connection to be returned.
+
+    Idle connections are checked with health_check (a function taking the
+    connection and raising if it is unusable) before being handed out, and
+    replaced if the check fails. Pass health_check=None to skip it.
+
+    Connections may be used from any thread, so e.g. sqlite3 connections
+    should be created with check_same_thread=False.
+    """
+
+    def __init__(self, factory, size=5, max_overflow=0, timeout=30.0,
+                 health_check=ping):
+        if size < 1:
+            raise Exception('Connection pool size must be at least 1')
+        if max_overflow < 0:
+            raise Exception('Connection pool overflow cannot be negative')
+
+        self._factory = factory
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self._health_check = health_check
+
+        self._idle = []
+        self._open = 0
+        self._checked_out = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+        self.checkouts = 0
+        self.wait_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.health_check_failures = 0
+
+    def acquire(self, timeout=None):
+        """
+        Checks out a connection, waiting up to timeout seconds (the pool's
+        timeout by default) if none are available.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        waited = False
+
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise Exception('Connection pool is closed')
+                if self._idle:
+                    connection = self._idle.pop()
+                    break
+                if self._open < self.size + self.max_overflow:
+                    # Reserve the slot, the connection is opened below
+                    # without holding the lock.
+                    connection = None
+                    self._open += 1
+                    break
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise Exception(
+                        'Timed out waiting for a database connection')
+                waited = True
+                self._condition.wait(remaining)
+            self._checked_out += 1
+
+        try:
+            if connection is not None:
+                connection = self._check(connection)
+            if connection is None:
+                connection = self._factory()
+        except Exception:
+            with self._condition:
+                self._open -= 1
+                self._checked_out -= 1
+                self._condition.notify()
+            raise
+
+        wait = time.time() - start
+        with self._condition:
+            self.checkouts += 1
+            if waited:
+                self.wait_count += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return connection
+
+    def _check(self, connection):
+        """
+        Returns connection if it passes the health check, otherwise closes it
+        and returns None.
+        """
+        if self._health_check is None:
+            return connection
+        try:
+            self._health_check(connection)
+            return connection
+        except Exception:
+            with self._condition:
+                self.health_check_failures += 1
+            self._close_connection(connection)
+            return None
+
+    def release(self, connection, discard=False):
+        """
+        Returns a checked out connection to the pool. If discard is True, or
+        the pool is over its size, the connection is closed instead.
+        """
+        with self._condition:
+            self._checked_out -= 1
+            if discard or self._closed or self._open > self.size:
+                self._open -= 1
+                close = True
+            else:
+                self._idle.append(connection)
+                close = False
+            self._condition.notify()
+        if close:
+            self._close_connection(connection)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager checking out a connection for the duration of the
+        block. The connection is discarded if the block raises.
+        """
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        except Exception:
+            self.release(connection, discard=True)
+            raise
+        self.release(connection)
+
+    def close(self):
+        """
+        Closes every idle connection. Checked out connections are closed when
+        they are returned.
+        """
+        with self._condition:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._open -= len(idle)
+            self._condition.notify_all()
+        for connection in idle:
+            self._close_connection(connection)
+
+    def _close_connection(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        """
+        Returns a dict of the pool's current state and wait time metrics.
+        """
+        with self._condition:
+            return {
+                'size': self.size,
+                'max_overflow': self.max_overflow,
+                'open': self._open,
+                'idle': len(self._idle),
+                'checked_out': self._checked_out,
+                'overflow': max(self._open - self.size, 0),
+                'checkouts': self.checkouts,
+                'wait_count': self.wait_count,
+                'total_wait': self.total_wait,
+                'max_wait': self.max_wait,
+                'health_check_failures': self.health_check_failures,
+            }
+
+
+class PooledCursor(object):
+    """
+    Wraps a cursor on a pooled connection, calling release to return the
+    connection once the results are exhausted or the cursor is closed.
+    """
+
+    def __init__(self, cursor, release):
+        self._cursor = cursor
+        self._release = release
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def fetchone(self):
+        if self._closed:
+            return None
+        row = self._cursor.fetchone()
+        if row is None:
+            self.close()
+        return row
+
+    def fetchmany(self, size=None):
+        if self._closed:
+            return []
+        if size is None:
+            size = self._cursor.arraysize
+        rows = self._cursor.fetchmany(size)
+        if len(rows) < size:
+            self.close()
+        return rows
+
+    def fetchall(self):
+        if self._closed:
+            return []
+        rows = self._cursor.fetchall()
+        self.close()
+        return rows
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._release()
+
+    def __del__(self):
+        self.close()
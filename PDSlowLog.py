@@ -0,0 +1,164 @@
+"""
+Slow query log with EXPLAIN plans, written to a rotating file.
+
+    slow_log = SlowQueryLog('slow_queries.log', threshold=0.5)
+    slow_log.start()
+    ...
+    slow_log.stop()
+
+Queries that take at least threshold seconds to execute are logged with
+their SQL, bound parameters, duration and plan. Only the check against the
+threshold runs on the query's thread: plans are captured and entries
+written by a background worker. A query shape (see PDTable.fingerprint) is
+logged at most once every dedupe_interval seconds, and its entry counts
+the slow executions of it that were left out since.
+"""
+import logging
+import logging.handlers
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from PDExplain import dialect_for
+from PDHooks import add_hook, remove_hook
+
+
+class SlowQueryLog(object):
+    """
+    Logs queries slower than threshold seconds to path, rotated once it
+    reaches max_bytes with backup_count old files kept.
+
+    Plans are read with PDTable.explain, on a connection from the query's
+    table. sqlite3 connections can only be used from the thread that
+    created them unless created with check_same_thread=False, so factory
+    can be given instead: a callable returning a new connection to the same
+    database, which the worker opens once and reads every plan on. If a
+    plan cannot be read, the error is logged in its place.
+
+    At most max_pending queries wait for the worker, and slow queries past
+    that are counted in dropped instead of logged.
+    """
+
+    def __init__(self, path, threshold=1.0, max_bytes=10 * 1024 * 1024,
+                 backup_count=5, dedupe_interval=3600.0, capture_plans=True,
+                 factory=None, max_pending=1000):
+        self.threshold = threshold
+        self.dedupe_interval = dedupe_interval
+        self.capture_plans = capture_plans
+        self.factory = factory
+        self.dropped = 0
+
+        self._handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count)
+        self._handler.setFormatter(
+            logging.Formatter('%(asctime)s %(message)s'))
+        # (time last logged, slow executions since) by fingerprint
+        self._shapes = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(max_pending)
+        self._worker = None
+        self._connection = None
+
+    def start(self):
+        """
+        Starts logging slow queries run through PDTable.
+        """
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work)
+            self._worker.daemon = True
+            self._worker.start()
+        remove_hook('on_execute_end', self._executed)
+        add_hook('on_execute_end', self._executed)
+
+    def stop(self):
+        """
+        Stops logging, writes the entries already queued and closes the
+        log file.
+        """
+        remove_hook('on_execute_end', self._executed)
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+        self._handler.close()
+
+    def flush(self):
+        """
+        Waits until the worker has written every queued entry.
+        """
+        self._queue.join()
+        self._handler.flush()
+
+    def _executed(self, event):
+        if event.execute_time < self.threshold:
+            return
+        try:
+            key = event.fingerprint
+            hash(key)
+        except TypeError:
+            # Unhashable literal in the query shape
+            key = event.sql
+
+        now = time.time()
+        with self._lock:
+            logged, repeats = self._shapes.get(key, (None, 0))
+            if logged is not None and now - logged < self.dedupe_interval:
+                self._shapes[key] = (logged, repeats + 1)
+                return
+            self._shapes[key] = (now, 0)
+        try:
+            self._queue.put_nowait((event, key, repeats))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    # Connections are closed on the thread that opened them
+                    if self._connection is not None:
+                        self._connection.close()
+                        self._connection = None
+                    return
+                self._write(*item)
+            except Exception:
+                # Keep the worker alive, e.g., if the disk is full
+                pass
+            finally:
+                self._queue.task_done()
+
+    def _plan(self, event):
+        try:
+            if self.factory is None:
+                return str(event.table.explain())
+            if self._connection is None:
+                self._connection = self.factory()
+            cursor = self._connection.cursor()
+            try:
+                return str(dialect_for(cursor).explain(
+                    cursor, event.sql, event.params, False))
+            finally:
+                cursor.close()
+        except Exception as e:
+            return 'unavailable: {}: {}'.format(type(e).__name__, e)
+
+    def _write(self, event, key, repeats):
+        lines = ['slow query {:.6f}s (shape {:08x}{})'.format(
+            event.execute_time, hash(key) & 0xffffffff,
+            ', {} more since last logged'.format(repeats) if repeats
+            else '')]
+        lines.append('SQL: ' + event.sql)
+        lines.append('params: {!r}'.format(event.params))
+        if self.capture_plans:
+            lines.append('plan:')
+            lines.extend('  ' + line
+                         for line in self._plan(event).split('\n'))
+        self._handler.handle(logging.makeLogRecord(
+            {'msg': '\n'.join(lines), 'levelno': logging.WARNING,
+             'levelname': 'WARNING'}))
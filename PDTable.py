@@ -1,15 +1,91 @@
 import copy
+import weakref
+from itertools import islice
+
+from PDCache import CachedResult, ResultCache
+from PDColumn import PDColumn, column, scalar_column
+from PDCompiler import (
+    compile_insert, compile_to_sql, fingerprint, placeholder_name)
+from PDAsync import AsyncRowIterator, fetchall_async
+from PDExplain import explain
+from PDExport import export
+from PDMaterialize import materialize, source_written, view_for
+from PDHooks import ObservedCursor, fetched, hooks, observe, row_bytes
+from PDOptimizer import table_refs
+from PDPool import PooledCursor
+from PDVector import execute, fetch_columns, to_records
+
+
+class OperationList(object):
+    """
+    Immutable, structurally shared list of (operation, column) tuples.
+
+    Each node holds a single operation and points at the list it was pushed
+    onto, so deriving a new query from an existing one allocates one node
+    instead of copying every operation before it.
+    """
+
+    __slots__ = ('_op', '_parent', '_length')
+
+    def __init__(self, op=None, parent=None):
+        self._op = op
+        self._parent = parent
+        self._length = parent._length + 1 if parent is not None else 0
+
+    @classmethod
+    def from_iterable(cls, ops):
+        """
+        Builds a list holding the given operations in order.
+        """
+        ops_list = EMPTY_OPERATIONS
+        for op in ops:
+            ops_list = ops_list.push(op)
+        return ops_list
+
+    def push(self, op):
+        """
+        Returns a new list with op appended. This list is left unchanged.
+        """
+        return OperationList(op, self)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        ops = []
+        node = self
+        while node._parent is not None:
+            ops.append(node._op)
+            node = node._parent
+        return reversed(ops)
+
+    def __repr__(self):
+        return repr(list(self))
 
-from PDColumn import PDColumn
-from PDCompiler import compile_to_sql
+
+EMPTY_OPERATIONS = OperationList()
+
+# Process-wide cache of the results of queries built with PDTable.cached.
+# Resize it with result_cache.resize(max_bytes).
+result_cache = ResultCache()
 
 
 class PDTable(object):
 
+    # Tables are derived for every step of building a query, so they have
+    # fixed attributes. Any other attribute is a column, see __getattr__.
+    __slots__ = (
+        '_name', '_alias', '_cursor', '_pool', '_paramstyle',
+        '_operation_ordering', '_reverse_val', '_distinct', '_limit',
+        '_binary_op', '_children', '_compiled', '_query', '_parameterized',
+        '_fingerprint', '_cached', '_cache_ttl'
+    )
+    _attributes = frozenset(__slots__)
+
     # List of valid operations
     operations = (
         '_limit', '_where', '_select', '_group', '_join', '_having', '_order',
-        '_where_exists'
+        '_where_exists', '_update', '_delete'
     )
 
     # Binary operators.
@@ -23,12 +99,24 @@ class PDTable(object):
         '_union', '_intersect', '_except'
     )
 
-    def __init__(self, name, alias=None, cursor=None):
+    # DB-API paramstyle used for placeholders when compiling with
+    # parameters, see PDCompiler.paramstyle_map. sqlite3 uses qmark.
+    default_paramstyle = 'qmark'
+
+    # Number of rows fetched at a time when streaming results.
+    default_batch_size = 1000
+
+    def __init__(self, name, alias=None, cursor=None, paramstyle=None,
+                 pool=None):
         """
         Initializes tables to be empty. Requires name, database cursor optional.
 
         If verbose is True, the compiled SQL query will be printed along with
         the results.
+
+        paramstyle overrides default_paramstyle for queries built from this
+        table. If a PDPool.ConnectionPool is given as pool, queries are run on
+        connections checked out from it instead of on cursor.
         """
         # Can either be a string referencing an actual table or another
         # PDTable referencing a subquery
@@ -36,20 +124,30 @@ class PDTable(object):
         self._alias = alias
         if isinstance(name, PDTable):
             self._cursor = name._cursor
+            self._pool = pool or name._pool
+            self._paramstyle = paramstyle or name._paramstyle
         else:
             self._cursor = cursor
+            self._pool = pool
+            self._paramstyle = paramstyle or PDTable.default_paramstyle
 
-        # List of tuples in order of operation (operation, column)
-        self._operation_ordering = []
+        # Immutable list of tuples in order of operation (operation, column)
+        self._operation_ordering = EMPTY_OPERATIONS
 
         self._reverse_val = False
         self._distinct = False
         self._limit = None
         self._binary_op = None
-        self._children = []
+        self._children = ()
 
         self._compiled = False
         self._query = None
+        self._parameterized = None
+        self._fingerprint = None
+
+        # Whether run() reads results from result_cache, see cached
+        self._cached = False
+        self._cache_ttl = None
 
     def __str__(self):
         """
@@ -110,27 +208,401 @@ class PDTable(object):
                 'Database connector does not have an execute method')
         self._cursor = cursor
 
-    def compile(self):
+    def set_pool(self, pool):
+        """
+        Set the connection pool for this table to check out connections from
+        for executing queries.
+        """
+        self._pool = pool
+
+    def compile(self, params=False):
         """
         Compile the underlying query to SQL, checking first if it was already
         compiled, and return the SQL query.
+
+        If params is True, literals are compiled to placeholders in this
+        table's paramstyle and (query, params) is returned instead.
         """
+        if params:
+            if self._parameterized is None:
+                with observe('compile', self) as event:
+                    self._parameterized = compile_to_sql(
+                        self, paramstyle=self._paramstyle)
+                    event.sql, event.params = self._parameterized
+            return self._parameterized
+
         if not self._compiled:
-            self._query = compile_to_sql(self)
+            with observe('compile', self) as event:
+                self._query = event.sql = compile_to_sql(self)
             self._compiled = True
         return self._query
 
-    def run(self):
+    def fingerprint(self):
         """
-        Compile the query, run it, and return the results.
+        Return the shape of the query with its literals left out, which is
+        the same for queries differing only in their literals.
         """
-        if not self._cursor:
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(self)[0]
+        return self._fingerprint
+
+    def _check_cursor(self):
+        if not self._cursor and self._pool is None:
             raise Exception(
                 'Attempting to execute query without setting database cursor '
                 'first')
 
-        self.compile()
-        return self._cursor.execute(self._query)
+    def _open_cursor(self, pool=None):
+        """
+        Returns a new cursor to run this table's query on, and a function to
+        call once its results are no longer needed.
+
+        With a connection pool, pool or else the table's, the cursor is on a
+        checked out connection that the function returns to the pool.
+        Otherwise, it is on the table cursor's connection if the driver
+        exposes it, or is the table cursor itself.
+        """
+        if pool is None:
+            self._check_cursor()
+            pool = self._pool
+
+        if pool is not None:
+            connection = pool.acquire()
+            try:
+                cursor = connection.cursor()
+            except Exception:
+                pool.release(connection, discard=True)
+                raise
+
+            def release():
+                try:
+                    cursor.close()
+                finally:
+                    pool.release(connection)
+            return cursor, release
+
+        connection = getattr(self._cursor, 'connection', None)
+        if connection is None:
+            return self._cursor, lambda: None
+        cursor = connection.cursor()
+        return cursor, cursor.close
+
+    def run(self):
+        """
+        Compile the query, run it with its literals as bound parameters, and
+        return the results.
+
+        With a connection pool, the results are a PDPool.PooledCursor that
+        returns its connection once they are exhausted or it is closed.
+
+        UPDATE and DELETE queries are run in their own transaction, and the
+        number of rows they changed is returned instead.
+
+        Queries built with cached() return a PDCache.CachedResult of rows
+        read from result_cache when they were run before.
+        """
+        self._check_cursor()
+        query, params = self.compile(params=True)
+        if self._is_write():
+            with observe('execute', self, sql=query, params=params) as event:
+                event.rows = self._transaction(
+                    lambda cursor: cursor.execute(query, params).rowcount)
+            self._written(appended=False)
+            return event.rows
+        if self._cached:
+            return self._run_cached(query, params)
+        if self._pool is None:
+            with observe('execute', self, sql=query, params=params):
+                cursor = self._cursor.execute(query, params)
+            return self._observe_fetches(cursor, query, params)
+
+        cursor, release = self._open_cursor()
+        try:
+            with observe('execute', self, sql=query, params=params):
+                cursor.execute(query, params)
+        except Exception:
+            release()
+            raise
+        return PooledCursor(
+            self._observe_fetches(cursor, query, params), release)
+
+    def _result_key(self, query, params):
+        """
+        Returns the result_cache key of the query run with params on this
+        table's connection (or connection pool), or None if params cannot
+        be hashed.
+        """
+        if self._pool is not None:
+            connection = self._pool
+        else:
+            connection = getattr(self._cursor, 'connection', self._cursor)
+        # A weak reference to a closed connection never equals one to
+        # another, so its results are only evicted. Connections that cannot
+        # be weakly referenced are kept by their results instead, so that
+        # another cannot take their id.
+        try:
+            connection = weakref.ref(connection)
+        except TypeError:
+            pass
+        if isinstance(params, dict):
+            params = tuple(sorted(params.items()))
+        key = (connection, query, tuple(params))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _run_cached(self, query, params):
+        key = self._result_key(query, params)
+        if key is not None:
+            result = result_cache.get(key)
+            if result is not None:
+                return CachedResult(*result)
+
+        # Results read while a table they depend on is written to are not
+        # cached, see ResultCache.put.
+        generation = result_cache.generation
+        cursor, release = self._open_cursor()
+        try:
+            with observe('execute', self, sql=query, params=params):
+                cursor.execute(query, params)
+            rows = cursor.fetchall()
+            description = cursor.description
+        finally:
+            release()
+        fetched(self, query, params, rows)
+
+        if key is not None:
+            result_cache.put(
+                key, (rows, description), row_bytes(rows),
+                tables=table_refs(self), ttl=self._cache_ttl,
+                generation=generation)
+        return CachedResult(rows, description)
+
+    def _observe_fetches(self, cursor, query, params):
+        """
+        Returns cursor wrapped to emit on_fetch if any hooks are registered
+        for it (see PDHooks), otherwise cursor itself.
+        """
+        if hooks['on_fetch']:
+            return ObservedCursor(cursor, self, query, params)
+        return cursor
+
+    def _transaction(self, func):
+        """
+        Calls func with a new cursor (see _open_cursor), then commits on the
+        cursor's connection, or rolls back if func raises, and returns what
+        func returned.
+        """
+        cursor, release = self._open_cursor()
+        connection = getattr(cursor, 'connection', None)
+        try:
+            result = func(cursor)
+            if connection is not None:
+                connection.commit()
+            return result
+        except Exception:
+            if connection is not None:
+                connection.rollback()
+            raise
+        finally:
+            release()
+
+    def _written(self, appended):
+        """
+        Invalidates the results cached from this table and refreshes the
+        materialized views on it that refresh on write, incrementally if
+        rows were only appended.
+        """
+        result_cache.invalidate([self._name])
+        source_written(self, appended)
+
+    def insert_many(self, rows, columns=None, chunk_size=1000):
+        """
+        Insert rows into this table in a single transaction and return the
+        number of rows inserted.
+
+        rows are dicts keyed by column name or sequences of values for
+        columns, which defaults to the first dict's keys. They are read and
+        passed to executemany chunk_size at a time, so rows can be a
+        generator over more rows than fit in memory.
+        """
+        self._check_cursor()
+        self._check_writable('INSERT')
+        if len(self._operation_ordering) > 0:
+            raise Exception('Can only INSERT into tables without queries')
+        if not isinstance(chunk_size, int) or chunk_size < 1:
+            raise Exception('Chunk size must be a positive integer')
+
+        rows = iter(rows)
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return 0
+        if columns is None:
+            if not isinstance(chunk[0], dict):
+                raise Exception(
+                    'Column names are required to INSERT rows of values')
+            columns = sorted(chunk[0])
+        columns = list(columns)
+
+        query = compile_insert(self, columns, self._paramstyle)
+        named = self._paramstyle in ('named', 'pyformat')
+
+        def values(row):
+            if isinstance(row, dict):
+                row = [row[column] for column in columns]
+            elif len(row) != len(columns):
+                raise Exception(
+                    'Expected {} values in row, got {}'.format(
+                        len(columns), len(row)))
+            if named:
+                return dict((placeholder_name(idx + 1), value)
+                            for idx, value in enumerate(row))
+            return tuple(row)
+
+        def insert(cursor):
+            count = 0
+            rows_chunk = chunk
+            while rows_chunk:
+                cursor.executemany(query, [values(row) for row in rows_chunk])
+                count += len(rows_chunk)
+                rows_chunk = list(islice(rows, chunk_size))
+            return count
+
+        count = self._transaction(insert)
+        self._written(appended=True)
+        return count
+
+    def iter_batches(self, batch_size=None):
+        """
+        Run the query and return an iterator over its results as lists of at
+        most batch_size rows (default_batch_size by default). Rows are
+        fetched with fetchmany, so only one batch is held in memory.
+
+        Results are read from a new cursor (see _open_cursor) that is closed
+        once they are exhausted or the iterator is closed early, leaving this
+        table's cursor free.
+        """
+        batch_size = self._batch_size(batch_size)
+        self._check_cursor()
+        return self._fetch_batches(batch_size)
+
+    def _batch_size(self, batch_size):
+        if batch_size is None:
+            return self.default_batch_size
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise Exception('Batch size must be a positive integer')
+        return batch_size
+
+    def _fetch_batches(self, batch_size, described=None):
+        """
+        Runs the query and yields its results batch_size rows at a time.
+        described, if given, is called with the cursor's description once
+        the query has run.
+        """
+        cursor, release = self._open_cursor()
+        try:
+            query, params = self.compile(params=True)
+            with observe('execute', self, sql=query, params=params):
+                cursor.execute(query, params)
+            if described is not None:
+                described(cursor.description)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                fetched(self, query, params, rows)
+                yield rows
+        finally:
+            release()
+
+    def iter_rows(self, batch_size=None):
+        """
+        Run the query and return an iterator over its result rows, fetched
+        batch_size at a time as in iter_batches.
+        """
+        return self._flatten_batches(self.iter_batches(batch_size))
+
+    def _flatten_batches(self, batches):
+        try:
+            for rows in batches:
+                for row in rows:
+                    yield row
+        finally:
+            batches.close()
+
+    def to_columns(self, dtypes=None, batch_size=None):
+        """
+        Run the query and return its results as an OrderedDict of NumPy
+        arrays by column name, fetched batch_size rows at a time as in
+        iter_batches and copied into each column's array as they arrive.
+
+        dtypes gives column dtypes by name in a dict or by position in a
+        sequence. Others are inferred from the select list or the values,
+        see PDVector.fetch_columns. Requires NumPy.
+        """
+        return fetch_columns(self, self._batch_size(batch_size), dtypes)
+
+    def to_numpy(self, dtypes=None, batch_size=None):
+        """
+        Run the query and return its results as a NumPy record array, with
+        columns fetched and typed as in to_columns.
+        """
+        return to_records(self.to_columns(dtypes, batch_size))
+
+    def export(self, path, format='csv', batch_size=None):
+        """
+        Run the query and write its results to path in format, one of
+        'csv', 'columnar', 'arrow' and 'parquet' (see PDExport), and return
+        the number of rows written. Rows are fetched batch_size at a time
+        as in iter_batches and each batch is written before the next is
+        fetched. arrow and parquet require pyarrow.
+        """
+        return export(self, path, format, self._batch_size(batch_size))
+
+    def arun(self, driver=None):
+        """
+        Return an awaitable that runs the query without blocking the event
+        loop and resolves to all of its result rows.
+
+        driver is a PDAsync.AsyncDriver, by default a PDAsync.ThreadedDriver
+        running this table's cursor or connection pool in a thread. UPDATE
+        and DELETE queries are not supported, since they are committed by
+        run().
+        """
+        return fetchall_async(self, driver)
+
+    def astream(self, batch_size=None, driver=None):
+        """
+        Return an asynchronous iterator over the query's result rows, fetched
+        batch_size rows at a time (default_batch_size by default) through
+        driver as in arun. Await its aclose() to stop early.
+        """
+        return AsyncRowIterator(self, self._batch_size(batch_size), driver)
+
+    def run_vectorized(self, data):
+        """
+        Run the query in-process over data, a dict of tables by name, each
+        a dict of NumPy arrays by column name, instead of on the database,
+        and return its result as an OrderedDict of arrays by column name.
+        See PDVector for what is supported. Requires NumPy.
+        """
+        return execute(self, data)
+
+    def explain(self, analyze=False, dialect=None):
+        """
+        Run the database's EXPLAIN for the query and return its plan as a
+        PDExplain.QueryPlan tree, with full table scans, temporary B-trees
+        for sorting and joins that use no index flagged.
+
+        If analyze is True, the query is also run to measure the rows it
+        returns and how long it takes. dialect overrides the EXPLAIN
+        dialect detected from the cursor, either as a dialect object or as
+        the name of a cursor module in PDExplain.dialects, e.g., 'sqlite3'
+        or 'psycopg2'.
+        """
+        return explain(self, analyze, dialect)
 
     ################################################################
     # Query methods
@@ -139,11 +611,27 @@ class PDTable(object):
     def has_query(self, query):
         return query in dict(self._operation_ordering)
 
+    def _is_write(self):
+        return self.has_query('_update') or self.has_query('_delete')
+
+    def _derive(self):
+        """
+        Returns a shallow copy of this table to build a new query from. The
+        operation list is immutable, so it is shared rather than copied.
+        """
+        new_table = copy.copy(self)
+        new_table._compiled = False
+        new_table._query = None
+        new_table._parameterized = None
+        new_table._fingerprint = None
+        return new_table
+
     def _set_query(self, query, column):
         if query not in PDTable.operations:
             raise Exception("Unsupported query: " + query)
-        table_copy = copy.deepcopy(self)
-        table_copy._operation_ordering.append((query, column))
+        table_copy = self._derive()
+        table_copy._operation_ordering = \
+            self._operation_ordering.push((query, column))
         return table_copy
 
     def _check_aggregate(self, column, clause):
@@ -157,7 +645,7 @@ class PDTable(object):
         if self._limit is not None:
             raise Exception('Only one LIMIT clause allowed in queries')
 
-        new_table = copy.deepcopy(self)
+        new_table = self._derive()
         new_table._limit = lim
         return new_table
 
@@ -190,7 +678,7 @@ class PDTable(object):
         return self.reverse()
 
     def reverse(self):
-        new_table = copy.deepcopy(self)
+        new_table = self._derive()
         new_table._reverse_val = not self._reverse_val
         return new_table
 
@@ -201,7 +689,7 @@ class PDTable(object):
         if len(args) == 0:
             return self
 
-        table_copy = copy.deepcopy(self)
+        table_copy = self._derive()
         columns = []
         for column in args:
             if isinstance(column, tuple):
@@ -210,17 +698,94 @@ class PDTable(object):
                 columns.append({'column': column})
 
         operation = ("_select", columns)
-        table_copy._operation_ordering.append(operation)
+        table_copy._operation_ordering = \
+            self._operation_ordering.push(operation)
         return table_copy
 
+    def _check_writable(self, statement):
+        if isinstance(self._name, PDTable) or self._children:
+            raise Exception(
+                '{} is only allowed on database tables'.format(statement))
+
+    def update(self, **assignments):
+        """
+        Returns a query setting each column named in assignments to its value
+        (a PDColumn expression or literal) in the rows matching this table's
+        WHERE clauses. Run it with run().
+        """
+        self._check_writable('UPDATE')
+        if not assignments:
+            raise Exception('UPDATE requires at least one column')
+        for value in assignments.values():
+            self._check_aggregate(value, 'UPDATE')
+        return self._set_query('_update', sorted(assignments.items()))
+
+    def delete(self):
+        """
+        Returns a query deleting the rows matching this table's WHERE
+        clauses. Run it with run().
+        """
+        self._check_writable('DELETE')
+        return self._set_query('_delete', True)
+
+    def cached(self, ttl=None):
+        """
+        Returns this query with its results cached in result_cache by SQL,
+        parameters and connection when run with run(), for ttl seconds
+        (result_cache.default_ttl if None).
+
+        Cached results are invalidated when an UPDATE, DELETE or
+        insert_many through PDTable writes to a table they were read from.
+        Writes made any other way are only seen once results expire.
+        """
+        new_table = self._derive()
+        new_table._cached = True
+        new_table._cache_ttl = ttl
+        return new_table
+
+    def materialize(self, name, refresh='manual'):
+        """
+        Stores the results of this query in the temporary table name and
+        returns a PDTable reading from it, to use like PDTable(query)
+        without recomputing the query every time.
+
+        With refresh='manual' the view is brought up to date by its
+        refresh(), and with 'on_write' also every time UPDATE, DELETE or
+        insert_many through PDTable writes to a table it reads from. See
+        PDMaterialize for which views refresh incrementally. Requires a
+        cursor rather than a connection pool.
+        """
+        return materialize(self, name, refresh)
+
+    def refresh(self, full=False):
+        """
+        Brings the materialized view this table reads from up to date,
+        recomputing it in full if full is True.
+        """
+        view_for(self).refresh(full)
+
+    def drop_view(self):
+        """
+        Drops the materialized view this table reads from.
+        """
+        view_for(self).drop()
+
     def distinct(self):
-        new_table = copy.deepcopy(self)
+        new_table = self._derive()
         new_table._distinct = True
         return new_table
 
     def count(self):
         """Returns a PDColumn equal to COUNT(*)."""
-        return PDColumn('*', self).count()
+        return column('*', self).count()
+
+    def scalar(self):
+        """
+        Returns a PDColumn equal to the single value this query returns,
+        which is compiled inline as a scalar subquery. Its value() method
+        runs the query when the value is needed in Python instead.
+        """
+        return scalar_column(self)
 
     ################################################################
     # Magic methods
@@ -231,19 +796,24 @@ class PDTable(object):
     # since this method is being used to create PDColumns when they aren't
     # found
     def __getattr__(self, name):
-        return PDColumn(name, self)
+        # Only called for attributes that are not found, so an unset slot
+        # or a special method looked up by copy, pickle, etc. would
+        # otherwise silently become a column.
+        if name in PDTable._attributes or name.startswith('__'):
+            raise AttributeError(name)
+        return column(name, self)
 
     def __getitem__(self, key):
         # Getting a column
         if isinstance(key, str):
-            return PDColumn(key, self)
+            return column(key, self)
 
         # Getting the first or last row
         elif isinstance(key, int):
             if key == 0:
                 return self.limit(1)
             elif key == -1:
-                table_copy = copy.deepcopy(self)
+                table_copy = self._derive()
                 table_copy._reverse_val = not self._reverse_val
                 table_copy._limit = 1
                 return table_copy
@@ -257,7 +827,7 @@ class PDTable(object):
             if not key.start and key.stop > 0:
                 return self.limit(key.stop)
             elif key.start < 0 and not key.stop:
-                table_copy = copy.deepcopy(self)
+                table_copy = self._derive()
                 table_copy._reverse_val = not self._reverse_val
                 table_copy._limit = abs(key.start)
                 return table_copy
@@ -270,21 +840,41 @@ class PDTable(object):
             raise Exception("Attempting to get column with non-string key")
 
     def __copy__(self):
-        new_table = PDTable(self._name)
-        new_table.__dict__.update(self.__dict__)
+        new_table = object.__new__(type(self))
+        new_table._name = self._name
+        new_table._alias = self._alias
+        new_table._cursor = self._cursor
+        new_table._pool = self._pool
+        new_table._paramstyle = self._paramstyle
+        new_table._operation_ordering = self._operation_ordering
+        new_table._reverse_val = self._reverse_val
+        new_table._distinct = self._distinct
+        new_table._limit = self._limit
+        new_table._binary_op = self._binary_op
+        new_table._children = self._children
+        new_table._compiled = self._compiled
+        new_table._query = self._query
+        new_table._parameterized = self._parameterized
+        new_table._fingerprint = self._fingerprint
+        new_table._cached = self._cached
+        new_table._cache_ttl = self._cache_ttl
         return new_table
 
     def __deepcopy__(self, memo):
         new_table = PDTable(self._name)
         new_table._reverse_val = copy.copy(self._reverse_val)
         new_table._distinct = copy.copy(self._distinct)
-        new_table._operation_ordering = copy.copy(self._operation_ordering)
+        new_table._operation_ordering = self._operation_ordering
         new_table._cursor = self._cursor
+        new_table._pool = self._pool
+        new_table._paramstyle = self._paramstyle
         new_table._compiled = False
         new_table._binary_op = copy.copy(self._binary_op)
         new_table._children = copy.copy(self._children)
         new_table._limit = copy.copy(self._limit)
         new_table._alias = copy.copy(self._alias)
+        new_table._cached = self._cached
+        new_table._cache_ttl = self._cache_ttl
         return new_table
 
     def __nonzero__(self):
@@ -316,15 +906,10 @@ class PDTable(object):
             raise Exception('Attempting to assign invalid binary function')
 
         else:
-            new_table = PDTable(self._name)
+            new_table = PDTable(self._name, cursor=self._cursor,
+                                paramstyle=self._paramstyle, pool=self._pool)
             new_table._binary_op = op
-            setattr(new_table, op, True)
-
-            t1 = copy.copy(self)
-            t2 = copy.copy(other)
-
-            new_table._children.append(t1)
-            new_table._children.append(t2)
+            new_table._children = (copy.copy(self), copy.copy(other))
             return new_table
 
     def _check_table(self, table, clause):
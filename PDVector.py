@@ -0,0 +1,732 @@
+"""
+In-process vectorized execution of PDTable queries over columnar data.
+
+    data = {'counties': {'name': names, 'statecode': codes, ...}}
+    result = execute(c.group(c.statecode).select(c.statecode, c.count()),
+                     data)
+
+Instead of compiling a query to SQL, execute interprets its tree directly
+over NumPy arrays, one per column: WHERE and HAVING clauses are evaluated
+to boolean masks, GROUP BY sorts the rows by group once and reduces each
+aggregate over the groups with ufunc.reduceat, ORDER BY is a lexsort, and
+a LIMIT on a single numeric sort key only partitions the rows it keeps.
+
+fetch_columns reads a query's results from the database into the same
+columnar form, see PDTable.to_columns.
+
+Requires NumPy. Queries are single-table SELECTs, possibly from a
+subquery, with scalar and IN subqueries over the same data. JOIN, WHERE
+EXISTS, set operations, correlated subqueries and writes are not
+supported. NULLs are NaN in float columns and None in object columns, and
+arithmetic follows NumPy rather than the database.
+"""
+import operator
+import re
+from collections import OrderedDict
+
+from PDColumn import PDColumn
+from PDCompiler import unary_map
+from PDOptimizer import has_aggregate, integer_types, string_types
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Exception('The vectorized executor requires NumPy')
+    return numpy
+
+
+def execute(table, data):
+    """
+    Runs the query table over data, a dict of tables by name, each a dict
+    of equal length arrays (or sequences) by column name. Returns the
+    result as an OrderedDict of NumPy arrays by column name, named as in
+    select((name, column)), by the column's name for plain columns, and by
+    the position of the column (column1, ...) otherwise.
+    """
+    np = _numpy()
+    from PDTable import PDTable
+
+    if len(table._children) > 0:
+        raise Exception(
+            'Set operations are not supported by the vectorized executor')
+
+    clauses = dict((op, []) for op in PDTable.operations)
+    for op, col in table._operation_ordering:
+        if op == '_select':
+            clauses[op].extend(col)
+        else:
+            clauses[op].append(col)
+    if clauses['_update'] or clauses['_delete']:
+        raise Exception('Only SELECT queries can be run on columnar data')
+    if clauses['_join'] or clauses['_where_exists']:
+        raise Exception(
+            'JOIN and WHERE EXISTS are not supported by the vectorized '
+            'executor')
+    if clauses['_having'] and not clauses['_group']:
+        raise Exception('Must have a GROUP BY clause if using HAVING')
+
+    selects = clauses['_select']
+    scope = _source(table, data)
+
+    if clauses['_where']:
+        mask = np.ones(scope.size, dtype=bool)
+        for cond in clauses['_where']:
+            mask &= _mask(cond, scope, data)
+        scope = scope.take(np.flatnonzero(mask))
+
+    if clauses['_group'] or any(has_aggregate(col['column'])
+                                for col in selects):
+        keys = [_select_position(key, selects)
+                for key in clauses['_group']]
+        scope = Groups(scope, _group_ids(keys, scope, data))
+        for cond in clauses['_having']:
+            scope = scope.take(np.flatnonzero(_mask(cond, scope, data)))
+
+    if table._distinct:
+        # Groups and rows are reduced to the first of each distinct result
+        # row, which is then ordered and limited as usual.
+        values = _project(scope, selects, data).values()
+        ids = _ids([_full(value, scope.size) for value in values],
+                   scope.size)
+        keep = np.sort(np.unique(ids, return_index=True)[1])
+        scope = scope.take(keep)
+
+    keys = [_full(_evaluate(_select_position(key, selects), scope, data),
+                  scope.size)
+            for key in clauses['_order'] if isinstance(key, (PDColumn, int))]
+    scope = _arrange(scope, keys, table._reverse_val, table._limit)
+    return _project(scope, selects, data)
+
+
+def _source(table, data):
+    """
+    Returns the Rows of the table the query table reads from.
+    """
+    from PDTable import PDTable
+
+    name = table._name
+    if isinstance(name, PDTable):
+        result = execute(name, data)
+        size = len(next(iter(result.values()))) if result else 0
+        return Rows(name, result, size)
+
+    try:
+        columns = data[name]
+    except KeyError:
+        raise Exception('No columnar data for table: ' + name)
+    size = len(next(iter(columns.values()))) if columns else 0
+    return Rows(name, columns, size)
+
+
+class Rows(object):
+    """
+    The rows at index (all if None) of a table's columns. Columns are
+    converted to arrays and indexed the first time they are used.
+    """
+
+    grouped = False
+
+    def __init__(self, table, columns, size, index=None):
+        self.table = table
+        self.columns = columns
+        self.size = size if index is None else len(index)
+        self.index = index
+        self._arrays = {}
+
+    def column(self, node):
+        """
+        Returns the values of the column node in these rows.
+        """
+        name = node.table._name if node.table is not None else self.table
+        if name is not self.table and not (
+                isinstance(name, string_types)
+                and isinstance(self.table, string_types)
+                and name == self.table):
+            raise Exception(
+                'Correlated column {} is not supported by the vectorized '
+                'executor'.format(node.name))
+        return self.named(node.name)
+
+    def named(self, name):
+        values = self._arrays.get(name)
+        if values is None:
+            np = _numpy()
+            try:
+                values = np.asarray(self.columns[name])
+            except KeyError:
+                raise Exception('Unknown column: ' + name)
+            if self.index is not None:
+                values = values[self.index]
+            self._arrays[name] = values
+        return values
+
+    def names(self):
+        return list(self.columns)
+
+    def take(self, positions):
+        """
+        Returns the rows at positions of these rows.
+        """
+        index = positions if self.index is None else self.index[positions]
+        return Rows(self.table, self.columns, len(index), index)
+
+
+class Groups(object):
+    """
+    rows split into groups by ids, an array of each row's group number, or
+    in a single group if ids is None. Groups are numbered in the order of
+    their keys, and are held sorted so that each is a contiguous slice
+    starting at starts of the rows in order.
+    """
+
+    grouped = True
+
+    def __init__(self, rows, ids):
+        np = _numpy()
+        self.rows = rows
+        self.selection = None
+        if ids is None:
+            self.order = np.arange(rows.size)
+            self.starts = np.zeros(1, dtype=np.intp)
+        else:
+            # A stable sort keeps each group's rows in their original order,
+            # for first and last.
+            self.order = np.argsort(ids, kind='mergesort')
+            ids = ids[self.order]
+            boundaries = np.ones(len(ids), dtype=bool)
+            boundaries[1:] = ids[1:] != ids[:-1]
+            self.starts = np.flatnonzero(boundaries)
+        self.counts = np.diff(np.append(self.starts, rows.size))
+        self.size = len(self.starts)
+
+    def take(self, positions):
+        """
+        Returns the groups at positions of these groups.
+        """
+        groups = object.__new__(Groups)
+        groups.__dict__.update(self.__dict__)
+        groups.selection = (positions if self.selection is None
+                            else self.selection[positions])
+        groups.size = len(positions)
+        return groups
+
+    def _select(self, values):
+        if self.selection is None:
+            return values
+        return values[self.selection]
+
+    def lift(self, values):
+        """
+        Returns the value of each group for values of the rows, which is
+        that of the group's first row as in SQLite.
+        """
+        np = _numpy()
+        if np.ndim(values) == 0:
+            return values
+        if self.rows.size == 0:
+            # The single group of an aggregate over no rows
+            return self._select(np.array([None] * len(self.starts)))
+        return self._select(values[self.order[self.starts]])
+
+    def reduce(self, agg, values):
+        """
+        Returns the aggregate agg of values of the rows for each group.
+        NULLs are left out, and the aggregate of a group without values is
+        NULL, except for COUNT.
+        """
+        np = _numpy()
+        if np.ndim(values) == 0:
+            # COUNT(*) or an aggregate of a literal
+            values = _full(values, self.rows.size)
+        nulls = _isnull(values)
+        if self.rows.size:
+            counts = np.add.reduceat(
+                (~nulls[self.order]).astype(np.int64), self.starts)
+        else:
+            counts = np.zeros(len(self.starts), dtype=np.int64)
+        if agg == '_count':
+            return self._select(counts)
+        if self.rows.size == 0:
+            return self._select(np.array([None] * len(self.starts)))
+
+        values = values[self.order]
+        nulls = nulls[self.order]
+        if agg in ('_sum', '_avg'):
+            if nulls.any():
+                values = np.where(nulls, 0, values)
+            result = np.add.reduceat(values, self.starts)
+            if agg == '_avg':
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    result = np.true_divide(result, counts)
+        elif agg in ('_min', '_max'):
+            if values.dtype.kind == 'f':
+                ufunc = np.fmin if agg == '_min' else np.fmax
+            else:
+                ufunc = np.minimum if agg == '_min' else np.maximum
+            result = ufunc.reduceat(values, self.starts)
+        elif agg == '_first':
+            result = values[self.starts]
+        else:
+            result = values[self.starts + self.counts - 1]
+
+        if agg not in ('_first', '_last') and (counts == 0).any():
+            result = _with_nulls(result, counts == 0)
+        return self._select(result)
+
+
+def _with_nulls(values, nulls):
+    """
+    Returns a copy of values with NULL at the positions where nulls is True.
+    """
+    np = _numpy()
+    if values.dtype.kind == 'f':
+        values = values.copy()
+        values[nulls] = np.nan
+    else:
+        values = values.astype(object)
+        values[nulls] = None
+    return values
+
+
+def _isnull(values):
+    """
+    Returns a boolean array of which values are NULL.
+    """
+    np = _numpy()
+    if values.dtype.kind == 'f':
+        return np.isnan(values)
+    if values.dtype.kind == 'O':
+        return np.frompyfunc(lambda value: value is None, 1, 1)(
+            values).astype(bool)
+    return np.zeros(len(values), dtype=bool)
+
+
+def _full(value, size):
+    """
+    Returns value as an array of size values, repeating a scalar.
+    """
+    np = _numpy()
+    if np.ndim(value) == 0:
+        return np.full(size, value)
+    return value
+
+
+def _select_position(key, selects):
+    """
+    Returns the selected column at the position of a literal in GROUP BY or
+    ORDER BY (starting at 1), as in SQL, or key itself.
+    """
+    if isinstance(key, int) and not isinstance(key, bool):
+        if not 1 <= key <= len(selects):
+            raise Exception(
+                'Column position out of range: {}'.format(key))
+        return selects[key - 1]['column']
+    return key
+
+
+def _ids(keys, size):
+    """
+    Returns the number of each row's distinct combination of values of the
+    arrays keys, numbered in their sort order.
+    """
+    np = _numpy()
+    ids = np.zeros(size, dtype=np.intp)
+    for key in keys:
+        values, inverse = np.unique(key, return_inverse=True)
+        ids = ids * len(values) + inverse
+        if len(keys) > 1:
+            # Renumber to keep ids below the number of rows
+            ids = np.unique(ids, return_inverse=True)[1]
+    return ids
+
+
+def _group_ids(keys, rows, data):
+    if not keys:
+        return None
+    return _ids([_full(_evaluate(key, rows, data), rows.size)
+                 for key in keys], rows.size)
+
+
+def _arrange(scope, keys, reverse, limit):
+    """
+    Returns scope ordered by the arrays keys and limited to limit rows or
+    groups. As in the compiled ORDER BY, reverse makes only the last key
+    descending.
+    """
+    np = _numpy()
+    if limit is not None and limit >= scope.size:
+        limit = None
+
+    if not keys:
+        if limit is None:
+            return scope
+        return scope.take(np.arange(limit))
+
+    if (limit is not None and len(keys) == 1
+            and keys[0].dtype.kind in 'if' and limit > 0):
+        # Partition off the first limit values, and only sort those
+        key = -keys[0] if reverse else keys[0]
+        positions = np.argpartition(key, limit - 1)[:limit]
+        positions = positions[np.argsort(key[positions], kind='mergesort')]
+        return scope.take(positions)
+
+    ranks = [np.unique(key, return_inverse=True)[1] for key in keys]
+    if reverse:
+        ranks[-1] = -ranks[-1]
+    positions = np.lexsort(ranks[::-1])
+    if limit is not None:
+        positions = positions[:limit]
+    return scope.take(positions)
+
+
+def _project(scope, selects, data):
+    """
+    Returns the values of selects (every column of the table if empty) for
+    scope as an OrderedDict by column name.
+    """
+    result = OrderedDict()
+    if not selects:
+        rows = scope.rows if scope.grouped else scope
+        for name in rows.names():
+            values = rows.named(name)
+            result[name] = scope.lift(values) if scope.grouped else values
+        return result
+
+    for idx, col in enumerate(selects):
+        name = col.get('name') or _column_name(col['column'], idx)
+        if name in result:
+            raise Exception('Duplicate column name in result: ' + name)
+        result[name] = _full(_evaluate(col['column'], scope, data),
+                             scope.size)
+    return result
+
+
+def _column_name(node, idx):
+    if (isinstance(node, PDColumn) and len(node._children) == 0
+            and node.subquery is None):
+        name = node.name
+        for op in node.ops:
+            name = '{}({})'.format(unary_map[op], name)
+        return name
+    return 'column{}'.format(idx + 1)
+
+
+def _mask(cond, scope, data):
+    np = _numpy()
+    values = _evaluate(cond, scope, data)
+    if np.ndim(values) == 0:
+        return np.full(scope.size, bool(values))
+    return np.asarray(values).astype(bool)
+
+
+def _subquery_values(table, data):
+    """
+    Returns the first column of the results of the subquery table.
+    """
+    result = execute(table, data)
+    if not result:
+        raise Exception('Subquery returns no columns')
+    return next(iter(result.values()))
+
+
+def _scalar(table, data):
+    values = _subquery_values(table, data)
+    return values[0] if len(values) else None
+
+
+def _evaluate(node, scope, data):
+    """
+    Returns the value of node for each row or group of scope, or a scalar
+    if it is the same for all of them.
+    """
+    from PDTable import PDTable
+
+    if isinstance(node, PDTable):
+        return _scalar(node, data)
+    if not isinstance(node, PDColumn):
+        return node
+
+    if scope.grouped and not has_aggregate(node):
+        return scope.lift(_evaluate(node, scope.rows, data))
+
+    ops = node.ops
+    aggregates = [idx for idx, op in enumerate(ops)
+                  if op in PDColumn.aggregate_list]
+    if aggregates and not scope.grouped:
+        raise Exception('Aggregate {} outside of a group'.format(
+            unary_map[ops[aggregates[0]]]))
+
+    # Operators before an aggregate apply to the group's rows, and those
+    # after it to the aggregate.
+    split = aggregates[0] if aggregates else len(ops)
+    values = _evaluate_base(
+        node, scope.rows if aggregates else scope, data)
+    for op in ops[:split]:
+        values = _unary(op, values)
+    if aggregates:
+        values = scope.reduce(ops[split], values)
+        for op in ops[split + 1:]:
+            values = _unary(op, values)
+
+    if node.null is not None:
+        np = _numpy()
+        nulls = _isnull(np.asarray(_full(values, scope.size)))
+        values = nulls if node.null else ~nulls
+    return values
+
+
+def _evaluate_base(node, scope, data):
+    """
+    Returns the value of node without its operators and null check.
+    """
+    if node.subquery is not None:
+        return _scalar(node.subquery, data)
+    if len(node._children) == 0:
+        if node.name == '*':
+            return 1
+        return scope.column(node)
+    return _binary(node, scope, data)
+
+
+def _binary(node, scope, data):
+    from PDTable import PDTable
+
+    np = _numpy()
+    op = node._binary_op
+    left = _evaluate(node._children[0], scope, data)
+    right = node._children[1]
+
+    if op == '_in':
+        if isinstance(right, PDTable):
+            right = _subquery_values(right, data)
+        return np.in1d(_full(left, scope.size), list(right))
+    if op == '_between':
+        low, high = right
+        return np.logical_and(np.greater_equal(left, low),
+                              np.less_equal(left, high))
+
+    right = _evaluate(right, scope, data)
+    if op == '_like':
+        pattern = _like_pattern(right)
+        return np.frompyfunc(
+            lambda value: value is not None
+            and pattern.match(value) is not None, 1, 1)(left).astype(bool)
+    if op == '_concat':
+        return np.frompyfunc(
+            lambda a, b: u'{}{}'.format(a, b), 2, 1)(left, right)
+    if op == '_div':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.true_divide(left, right)
+            if (np.asarray(left).dtype.kind in 'iu'
+                    and np.asarray(right).dtype.kind in 'iu'):
+                # Integer division truncates in SQL
+                values = np.fix(values)
+        return values
+    if op in binary_ufuncs:
+        return getattr(np, binary_ufuncs[op])(left, right)
+    # Operators rather than ufuncs, which do not compare strings
+    return binary_operators[op](left, right)
+
+
+def _like_pattern(pattern):
+    """
+    Returns a regular expression matching what the LIKE pattern does, case
+    insensitively as in SQLite.
+    """
+    regex = ''.join(
+        '.*' if char == '%' else '.' if char == '_' else re.escape(char)
+        for char in pattern)
+    return re.compile(regex + r'\Z', re.IGNORECASE | re.DOTALL)
+
+
+def _unary(op, values):
+    return getattr(_numpy(), unary_ufuncs[op])(values)
+
+
+# NumPy functions for the operators, by name since NumPy is imported lazily
+binary_ufuncs = {
+    '_mod': 'fmod',
+    '_or': 'logical_or',
+    '_and': 'logical_and',
+}
+
+binary_operators = {
+    '_add': operator.add,
+    '_sub': operator.sub,
+    '_mul': operator.mul,
+    '_eq': operator.eq,
+    '_ne': operator.ne,
+    '_lt': operator.lt,
+    '_gt': operator.gt,
+    '_le': operator.le,
+    '_ge': operator.ge,
+}
+
+unary_ufuncs = {
+    '_abs': 'abs',
+    '_ceil': 'ceil',
+    '_floor': 'floor',
+    '_round': 'round',
+    '_not': 'logical_not',
+}
+
+
+def fetch_columns(table, batch_size, dtypes=None):
+    """
+    Runs the query table on its database and returns the results as an
+    OrderedDict of arrays by column name, filled one batch_size batch of
+    rows at a time.
+
+    dtypes gives the NumPy dtype of the columns, by name in a dict or by
+    position in a sequence. Other columns take theirs from the selected
+    column if it is a COUNT (int64) or AVG (float64), and otherwise from
+    the values fetched: bool, int64 or float64 when all values are, with
+    NULLs as NaN, and object for anything else. A column is converted
+    when a later batch has values that do not fit its dtype.
+    """
+    # Fail before running the query if NumPy is missing
+    _numpy()
+    names = []
+    table._check_cursor()
+    batches = table._fetch_batches(
+        batch_size, lambda description: names.extend(
+            column[0] for column in description))
+
+    buffers = None
+    try:
+        for rows in batches:
+            if buffers is None:
+                buffers = [
+                    ColumnBuffer(dtype, batch_size)
+                    for dtype in _declared_dtypes(table, names, dtypes)]
+            for buf, values in zip(buffers, zip(*rows)):
+                buf.extend(values)
+    finally:
+        batches.close()
+
+    result = OrderedDict()
+    if buffers is None:
+        buffers = [ColumnBuffer(dtype or object, 0)
+                   for dtype in _declared_dtypes(table, names, dtypes)]
+    for name, buf in zip(names, buffers):
+        if name in result:
+            raise Exception('Duplicate column name in result: ' + name)
+        result[name] = buf.finish()
+    return result
+
+
+def to_records(columns):
+    """
+    Returns the OrderedDict of arrays columns as a NumPy record array.
+    """
+    np = _numpy()
+    return np.rec.fromarrays(list(columns.values()), names=list(columns))
+
+
+def _declared_dtypes(table, names, dtypes):
+    """
+    Returns the dtype of each result column given by dtypes or implied by
+    the select list, or None to infer it from the values.
+    """
+    np = _numpy()
+    selects = []
+    for op, col in table._operation_ordering:
+        if op == '_select':
+            selects.extend(col)
+    if len(selects) != len(names):
+        selects = [None] * len(names)
+
+    declared = []
+    for idx, (name, col) in enumerate(zip(names, selects)):
+        if isinstance(dtypes, dict):
+            dtype = dtypes.get(name)
+        elif dtypes is not None:
+            dtype = dtypes[idx] if idx < len(dtypes) else None
+        else:
+            dtype = None
+        if dtype is None and col is not None:
+            node = col['column']
+            if isinstance(node, PDColumn) and node.ops \
+                    and node.null is None:
+                dtype = {'_count': np.int64, '_avg': np.float64}.get(
+                    node.ops[-1])
+        declared.append(np.dtype(dtype) if dtype is not None else None)
+    return declared
+
+
+def _infer_dtype(values, nulls=False):
+    """
+    Returns the narrowest of bool, int64, float64 and object holding
+    values, with None as NaN, or None if values are all None. nulls is True
+    if the column already holds None values.
+    """
+    np = _numpy()
+    kinds = set(type(value) for value in values)
+    if type(None) in kinds:
+        nulls = True
+        kinds.discard(type(None))
+    if not kinds:
+        return None
+    if kinds <= set([bool]) and not nulls:
+        return np.dtype(bool)
+    if kinds <= set((bool,) + integer_types) and not nulls:
+        return np.dtype(np.int64)
+    if kinds <= set((bool, float) + integer_types):
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+class ColumnBuffer(object):
+    """
+    Growable array of a result column's values, of dtype or of the dtype
+    of the values it is extended with if None. Until the first value that
+    is not None, which decides the dtype, values are held as None.
+    """
+
+    def __init__(self, dtype, capacity):
+        self.fixed = dtype is not None
+        self.values = _numpy().empty(capacity, dtype=dtype or object)
+        self.size = 0
+        # True until a value other than None is added
+        self.only_nulls = True
+
+    def extend(self, values):
+        np = _numpy()
+        if not self.fixed:
+            only_nulls = self.only_nulls
+            dtype = _infer_dtype(values, nulls=only_nulls and self.size > 0)
+            if dtype is None:
+                dtype = (np.dtype(object) if only_nulls
+                         else np.dtype(np.float64))
+            else:
+                self.only_nulls = False
+            if self.size and not only_nulls:
+                dtype = np.promote_types(self.values.dtype, dtype)
+            if dtype != self.values.dtype:
+                self._resize(len(self.values), dtype)
+
+        end = self.size + len(values)
+        if end > len(self.values):
+            # Grow geometrically so that extending is amortized O(1)
+            self._resize(max(end, 2 * len(self.values)), self.values.dtype)
+        self.values[self.size:end] = values
+        self.size = end
+
+    def _resize(self, capacity, dtype):
+        values = _numpy().empty(capacity, dtype=dtype)
+        values[:self.size] = self.values[:self.size]
+        self.values = values
+
+    def finish(self):
+        """
+        Returns the column's values, without the unused capacity. A column
+        of only NULLs is float64, all NaN.
+        """
+        np = _numpy()
+        if not self.fixed and self.only_nulls and self.size:
+            self._resize(self.size, np.dtype(np.float64))
+        if self.size < len(self.values):
+            self.values = self.values[:self.size].copy()
+        return self.values
@@ -1,2 +1,3 @@
+from PDBatch import ScalarResult, execute_many
 
-__all__ = ["PDColumn", "PDTable"]
+__all__ = ["PDColumn", "PDTable", "ScalarResult", "execute_many"]
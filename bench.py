@@ -0,0 +1,548 @@
+"""
+Benchmarks for building, compiling and running PDSQL queries.
+
+Run with `python -m PDSQL.bench` from the directory containing PDSQL, or
+`python bench.py` from the repository root. Options:
+
+    --scenarios build,compile,execute,demo
+        Groups of benchmarks to run, all by default.
+    --rows 10000,1000000,10000000
+        Sizes of the generated sqlite datasets the demo queries run on,
+        10000 by default. Larger datasets take a while to generate.
+    --json PATH
+        Also write the results to PATH as JSON.
+    --compare PATH
+        Compare the results with those of an earlier run saved with --json.
+    --no-memory
+        Skip measuring allocations, which slows down each benchmark.
+
+Each benchmark reports operations per second, mean and p99 latency, and
+the peak memory allocated by one operation as traced by tracemalloc, which
+is only available on Python 3.4+.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+
+from PDCompiler import sql_cache
+from PDHooks import percentile
+from PDOptimizer import optimizer
+from PDColumn import PDColumn
+from PDTable import OperationList, PDTable
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+database = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'tests', 'db.sqlite3')
+
+
+class Result(object):
+    """
+    Timings of number runs of a benchmark, in seconds, and the peak bytes
+    allocated by one run (None if not measured).
+    """
+
+    def __init__(self, group, name, times, peak_bytes, size_bytes=None):
+        self.group = group
+        self.name = name
+        self.times = sorted(times)
+        self.peak_bytes = peak_bytes
+        self.size_bytes = size_bytes
+
+    @property
+    def ops_per_sec(self):
+        return len(self.times) / sum(self.times) if sum(self.times) else None
+
+    def to_dict(self):
+        return {
+            'group': self.group,
+            'name': self.name,
+            'number': len(self.times),
+            'ops_per_sec': self.ops_per_sec,
+            'mean_us': sum(self.times) / len(self.times) * 1e6,
+            'p50_us': percentile(self.times, 50) * 1e6,
+            'p99_us': percentile(self.times, 99) * 1e6,
+            'peak_bytes': self.peak_bytes,
+            'size_bytes': self.size_bytes,
+        }
+
+
+class Runner(object):
+    """
+    Runs benchmarks and collects their Results.
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory and tracemalloc is not None
+        self.results = []
+
+    def measure(self, group, name, func, number, size=False):
+        """
+        Times number calls of func, after one call to warm up caches, and
+        prints and returns the Result. With size, the size in memory of the
+        query func returns is also measured, see query_size.
+        """
+        func()
+        times = []
+        for _ in range(number):
+            start = timeit.default_timer()
+            func()
+            times.append(timeit.default_timer() - start)
+
+        peak_bytes = None
+        if self.memory:
+            tracemalloc.start()
+            try:
+                baseline = tracemalloc.get_traced_memory()[0]
+                func()
+                peak_bytes = tracemalloc.get_traced_memory()[1] - baseline
+            finally:
+                tracemalloc.stop()
+
+        result = Result(group, name, times, peak_bytes,
+                        query_size(func()) if size else None)
+        self.results.append(result)
+        stats = result.to_dict()
+        print('{:<9} {:<40} {:>12.1f} ops/s {:>10.1f} us {:>10.1f} us p99'
+              '{}{}'.format(group, name, stats['ops_per_sec'] or 0,
+                            stats['mean_us'], stats['p99_us'],
+                            '' if peak_bytes is None else
+                            ' {:>10.1f} KiB'.format(peak_bytes / 1024.0),
+                            '' if result.size_bytes is None else
+                            ' {:>10.1f} KiB size'.format(
+                                result.size_bytes / 1024.0)))
+        return result
+
+
+def query_size(node):
+    """
+    Returns the bytes taken by the columns and tables of the query node and
+    the containers holding them, as counted by sys.getsizeof. Literals and
+    names are left out.
+    """
+    seen = set()
+    size = 0
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, (PDColumn, PDTable)):
+            size += sys.getsizeof(node)
+            if hasattr(node, '__dict__'):
+                size += sys.getsizeof(node.__dict__)
+                nodes.extend(node.__dict__.values())
+            for slot in getattr(type(node), '__slots__', ()):
+                nodes.append(getattr(node, slot, None))
+        elif isinstance(node, OperationList):
+            size += sys.getsizeof(node)
+            nodes.extend((node._op, node._parent))
+        elif isinstance(node, (list, tuple)):
+            size += sys.getsizeof(node)
+            nodes.extend(node)
+        elif isinstance(node, dict):
+            size += sys.getsizeof(node)
+            nodes.extend(node.values())
+    return size
+
+
+def nested_in(depth):
+    """
+    Builds a query with depth levels of IN subqueries.
+    """
+    tables = [PDTable('t{}'.format(i)) for i in range(depth + 1)]
+    query = tables[-1].select(tables[-1].col)
+    for table in reversed(tables[:-1]):
+        query = table.where(table.col.in_(query)).select(table.col)
+    return query
+
+
+def nested_exists(depth):
+    """
+    Builds a query with depth levels of correlated EXISTS subqueries.
+    """
+    tables = [PDTable('t{}'.format(i)) for i in range(depth + 1)]
+    query = tables[-1].where(tables[-1].val == 1)
+    for idx in reversed(range(depth)):
+        table = tables[idx]
+        inner = tables[idx + 1]
+        query = table.where_exists(
+            query.where(inner.id == table.id))
+    return query
+
+
+def nested_from(depth):
+    """
+    Builds a query with depth levels of FROM subqueries.
+    """
+    query = PDTable('t')
+    query = query.where(query.col > 0).select(query.col, query.val)
+    for _ in range(depth):
+        query = PDTable(query)
+        query = query.where(query.col > 0).select(query.col, query.val)
+    return query
+
+
+def nested_filters(depth):
+    """
+    Builds a query with depth levels of FROM subqueries that each filter
+    every column of the one below, which the optimizer pushes down into the
+    innermost query.
+    """
+    query = PDTable('t')
+    query = query.where(query.col > 0)
+    for idx in range(depth):
+        query = PDTable(query)
+        query = query.where(query.col > idx)
+    return query
+
+
+def set_operations(depth):
+    """
+    Builds a balanced tree of UNION, INTERSECT and EXCEPT queries with
+    2 ** depth leaves.
+    """
+    ops = ('union', 'intersect', 'except_')
+    counter = [0]
+
+    def build(level):
+        if level == 0:
+            counter[0] += 1
+            table = PDTable('t{}'.format(counter[0]))
+            return table.where(table.col > counter[0]).select(table.col)
+        left, right = build(level - 1), build(level - 1)
+        return getattr(left, ops[level % len(ops)])(right)
+
+    return build(depth)
+
+
+def long_predicate(terms, op='_and'):
+    """
+    Builds a query whose WHERE clause joins terms comparisons with op.
+    """
+    table = PDTable('t')
+    predicate = table.col0 == 0
+    for i in range(1, terms):
+        term = getattr(table, 'col{}'.format(i)) == i
+        if op == '_and':
+            predicate = predicate & term
+        else:
+            predicate = predicate | term
+    return table.where(predicate)
+
+
+def in_lists(terms):
+    """
+    Builds a query whose WHERE clause ORs terms IN comparisons.
+    """
+    table = PDTable('t')
+    predicate = table.col.in_((0, 1))
+    for i in range(1, terms):
+        predicate = predicate | table.col.in_((i * 2, i * 2 + 1))
+    return table.where(predicate)
+
+
+def builder_chain(length):
+    """
+    Builds a query from length calls of where, join and select in turn.
+    """
+    table = PDTable('t')
+    query = table
+    for i in range(length):
+        step = i % 3
+        if step == 0:
+            query = query.where(table.col > i)
+        elif step == 1:
+            other = PDTable('u{}'.format(i))
+            query = query.join(other, cond=other.id == table.id)
+        else:
+            query = query.select(table.col, table.val)
+    return query
+
+
+def bench_build(runner):
+    for length in (5, 20, 100):
+        runner.measure('build', 'builder chain length {}'.format(length),
+                       lambda: builder_chain(length), 200, size=True)
+    for terms in (1000, 10000):
+        runner.measure('build', '{}-term OR predicate'.format(terms),
+                       lambda: long_predicate(terms, '_or'), 10, size=True)
+    runner.measure('build', '1000 IN lists',
+                   lambda: in_lists(1000), 10, size=True)
+
+
+def bench_compile(runner, name, query, number=200, params=False):
+    """
+    Times compiling query number times. With params, repeated compiles hit
+    the shared SQL cache, otherwise it is cleared before each compile.
+    """
+    # compile() caches on the instance, so time fresh copies of the query.
+    def compile_query():
+        if not params:
+            sql_cache.clear()
+        return query._derive().compile(params=params)
+    runner.measure('compile', name, compile_query, number)
+
+
+def bench_compiles(runner):
+    for depth in (5, 20, 50):
+        bench_compile(runner, 'nested IN depth {}'.format(depth),
+                      nested_in(depth))
+    for depth in (5, 20, 50):
+        bench_compile(runner, 'nested EXISTS depth {}'.format(depth),
+                      nested_exists(depth))
+    for depth in (5, 10, 20):
+        bench_compile(runner, 'nested FROM depth {}'.format(depth),
+                      nested_from(depth), number=50)
+    for depth in (10, 40, 80):
+        bench_compile(runner, 'nested filters depth {}'.format(depth),
+                      nested_filters(depth), number=50)
+    for depth in (2, 4, 6):
+        bench_compile(runner, 'set operations depth {}'.format(depth),
+                      set_operations(depth))
+    bench_compile(runner, '100-term AND predicate',
+                  long_predicate(100, '_and'))
+    bench_compile(runner, '100-term OR predicate',
+                  long_predicate(100, '_or'))
+    bench_compile(runner, 'nested IN depth 50 cached', nested_in(50),
+                  params=True)
+    bench_compile(runner, '100-term AND predicate cached',
+                  long_predicate(100, '_and'), params=True)
+
+
+def bench_lookups(runner, cursor, number=2000):
+    """
+    Times population lookups with distinct thresholds, with literals
+    inlined in the SQL and with bound parameters.
+    """
+    states = PDTable('states', cursor=cursor)
+    counter = [0]
+
+    def lookup():
+        counter[0] += 1
+        return states.where(states.population_2010 > counter[0] * 1000) \
+                     .select(states.statecode)
+
+    runner.measure('execute', 'lookups inlined',
+                   lambda: cursor.execute(lookup().compile()).fetchall(),
+                   number)
+    runner.measure('execute', 'lookups bound',
+                   lambda: lookup().run().fetchall(), number)
+
+
+def bench_pushdown(runner, cursor, number=200):
+    """
+    Times running queries that filter a grouped subquery and a joined
+    subquery, with and without predicate pushdown.
+    """
+    counties = PDTable('counties', cursor=cursor)
+    states = PDTable('states', cursor=cursor)
+    grouped = PDTable(counties.group(counties.statecode)
+                              .select(counties.statecode,
+                                      ('num_counties', counties.count())))
+    queries = (
+        ('grouped subquery', grouped.where(grouped.statecode == 'CA')),
+        ('joined subquery',
+         states.join(counties.where(counties.population_2010 > 100000),
+                     cond=states.statecode == counties.statecode)
+               .where(counties.statecode == 'CA')
+               .select(states.name, counties.name)),
+    )
+
+    try:
+        for name, query in queries:
+            for enabled in (True, False):
+                if enabled:
+                    optimizer.enable('predicate_pushdown')
+                else:
+                    optimizer.disable('predicate_pushdown')
+                label = '{} {}'.format(
+                    name, 'pushed down' if enabled else 'not pushed')
+                runner.measure('execute', label,
+                               lambda: query._derive().run().fetchall(),
+                               number)
+    finally:
+        optimizer.enable('predicate_pushdown')
+
+
+def bench_execute(runner):
+    connection = sqlite3.connect(database)
+    try:
+        bench_lookups(runner, connection.cursor())
+        bench_pushdown(runner, connection.cursor())
+    finally:
+        connection.close()
+
+
+def generate_dataset(path, rows, seed=164):
+    """
+    Creates a sqlite database at path with the states and counties tables
+    of tests/db.sqlite3, holding rows counties spread over rows // 50 (at
+    least 50) states.
+    """
+    generator = random.Random(seed)
+    num_states = max(50, rows // 50)
+    connection = sqlite3.connect(path)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            'CREATE TABLE states (statecode text primary key, '
+            'population_2010 integer, population_1950 integer, name text)')
+        cursor.execute(
+            'CREATE TABLE counties (name text, statecode text, '
+            'population_1950 integer, population_2010 integer)')
+        cursor.execute(
+            'CREATE INDEX counties_statecode ON counties (statecode)')
+
+        counties = [(generator.randint(1000, 3000000),
+                     generator.randint(1000, 3000000))
+                    for _ in range(rows)]
+        totals = [0] * num_states
+        for idx, (_, population_2010) in enumerate(counties):
+            totals[idx % num_states] += population_2010
+        # Every tenth state's population differs from its counties' total
+        cursor.executemany(
+            'INSERT INTO states VALUES (?, ?, ?, ?)',
+            (('S{}'.format(idx), total + (idx % 10 == 0),
+              generator.randint(1000, 3000000), 'State {}'.format(idx))
+             for idx, total in enumerate(totals)))
+        cursor.executemany(
+            'INSERT INTO counties VALUES (?, ?, ?, ?)',
+            (('County {}'.format(idx), 'S{}'.format(idx % num_states),
+              population_1950, population_2010)
+             for idx, (population_1950, population_2010)
+             in enumerate(counties)))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def demo_queries(cursor):
+    """
+    Returns (name, query) for the queries of demo.py on the states and
+    counties tables.
+    """
+    s = PDTable('states', cursor=cursor)
+    c = PDTable('counties', cursor=cursor)
+
+    nc = PDTable(c.group(c.statecode).select(('num_counties', c.count())))
+    pop_sums = c.where(c.statecode == s.statecode) \
+                .select(c.population_2010.sum())
+    return (
+        ('large counties', reversed(
+            c.where(c.population_2010 > 2900000)
+             .select(c.statecode, c.name, c.population_2010)
+             .order(c.population_2010))),
+        ('counties per state', c.group(c.statecode)
+                                .select(c.statecode, c.count())
+                                .order(c.count())),
+        ('average counties per state', nc.select(nc.num_counties.avg())),
+        ('states not matching counties', s.where(s.population_2010 !=
+                                                 pop_sums)
+                                          .select(s.statecode)),
+        ('shrinking counties in a state',
+         c.join(s, cond=s.statecode == c.statecode)
+          .where((s.statecode == 'S1')
+                 & (c.population_1950 > c.population_2010))
+          .select(c.name, c.population_1950 - c.population_2010)),
+    )
+
+
+def bench_demo(runner, rows):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'bench.sqlite3')
+        start = time.time()
+        generate_dataset(path, rows)
+        print('generated {} rows in {:.1f}s'.format(
+            rows, time.time() - start))
+
+        connection = sqlite3.connect(path)
+        try:
+            number = max(3, min(50, 500000 // rows))
+            for name, query in demo_queries(connection.cursor()):
+                runner.measure('demo', '{} ({} rows)'.format(name, rows),
+                               lambda: query.run().fetchall(), number)
+        finally:
+            connection.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def compare(results, path):
+    """
+    Prints the change in operations per second and p99 latency of each
+    result from the same benchmark in the JSON results at path.
+    """
+    with open(path) as results_file:
+        previous = dict((result['name'], result)
+                        for result in json.load(results_file)['results'])
+
+    print('')
+    print('{:<50} {:>10} {:>10}'.format('compared to ' + path, 'ops/s',
+                                        'p99'))
+    for result in results:
+        stats = result.to_dict()
+        old = previous.get(result.name)
+        if old is None or not old['ops_per_sec'] or not old['p99_us']:
+            continue
+        print('{:<50} {:>+9.1f}% {:>+9.1f}%'.format(
+            result.name,
+            (stats['ops_per_sec'] / old['ops_per_sec'] - 1) * 100,
+            (stats['p99_us'] / old['p99_us'] - 1) * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark building, compiling and running queries.')
+    parser.add_argument('--scenarios', default='build,compile,execute,demo')
+    parser.add_argument('--rows', default='10000')
+    parser.add_argument('--json', dest='json_path')
+    parser.add_argument('--compare')
+    parser.add_argument('--no-memory', action='store_true')
+    args = parser.parse_args(argv)
+
+    scenarios = args.scenarios.split(',')
+    unknown = set(scenarios) - set(['build', 'compile', 'execute', 'demo'])
+    if unknown:
+        parser.error('unknown scenarios: ' + ', '.join(sorted(unknown)))
+
+    runner = Runner(memory=not args.no_memory)
+    if 'build' in scenarios:
+        bench_build(runner)
+    if 'compile' in scenarios:
+        bench_compiles(runner)
+    if 'execute' in scenarios:
+        bench_execute(runner)
+    if 'demo' in scenarios:
+        for rows in args.rows.split(','):
+            bench_demo(runner, int(rows))
+
+    if args.compare:
+        compare(runner.results, args.compare)
+    if args.json_path:
+        with open(args.json_path, 'w') as results_file:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'sqlite': sqlite3.sqlite_version,
+                'time': time.time(),
+                'results': [result.to_dict() for result in runner.results],
+            }, results_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -32,7 +32,7 @@ print(avg_num_counties)
 
 nc = PDTable(c.group(c.statecode).select(('num_counties', c.count())))
 avg_num_counties = nc.select(nc.num_counties.avg())
-avg_nc = avg_num_counties.run().fetchall()[0][0]
+avg_nc = avg_num_counties.scalar()
 st = PDTable(c.group(c.statecode)
               .having(c.count() > avg_nc)
               .select(('num_states', c.statecode)))
@@ -60,7 +60,7 @@ print(counties)
 chairmen = se.join(co, cond=co.chairman == se.name) \
              .group(se.statecode)
 nc = PDTable(chairmen.select(('num_chairmen', se.count())))
-max_chairmen = nc.select(nc.num_chairmen.max()).run().fetchall()[0][0]
+max_chairmen = nc.select(nc.num_chairmen.max()).scalar()
 statecodes = chairmen.having(se.count() == max_chairmen) \
                      .select(se.statecode)
 print(statecodes.compile())
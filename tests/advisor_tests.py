@@ -0,0 +1,86 @@
+import sqlite3
+import unittest
+
+from PDSQL.PDAdvisor import IndexAdvisor, column_usage
+from PDSQL.PDHooks import hooks
+from PDSQL.PDTable import PDTable
+
+
+class TestColumnUsage(unittest.TestCase):
+    def test_usage(self):
+        t1 = PDTable('t1')
+        t2 = PDTable('t2')
+        query = t1.join(t2, cond=t1.k == t2.k) \
+                  .where(t1.a == 1).where(t2.b > 2) \
+                  .group(t1.c).select(t1.c, t2.d.sum())
+        usage = column_usage(query)
+        self.assertEqual(usage['t1'].equality, ['a'])
+        self.assertEqual(usage['t1'].join, ['k'])
+        self.assertEqual(usage['t1'].group, ['c'])
+        self.assertEqual(usage['t2'].range, ['b'])
+        self.assertEqual(usage['t2'].selected, ['d'])
+        self.assertFalse(usage['t2'].all_selected)
+        self.assertTrue(column_usage(t1.where(t1.a == 1))['t1'].all_selected)
+
+
+class TestIndexAdvisor(unittest.TestCase):
+    def setUp(self):
+        self.t1 = PDTable('t1')
+
+    def test_recommend(self):
+        t1 = self.t1
+        advisor = IndexAdvisor(max_columns=3)
+        for value in range(3):
+            advisor.record(t1.where(t1.a == value).where(t1.b > 2)
+                             .select(t1.c), elapsed=0.001)
+        advisor.record(t1.where(t1.a == 1), elapsed=0.0)
+        advisor.record(t1.order(t1.x))
+        recommendations = advisor.recommend()
+        self.assertEqual(
+            [(r.table, r.columns, r.covering) for r in recommendations],
+            [('t1', ('a', 'b', 'c'), True), ('t1', ('x',), False)])
+        # Three executions plus 3ms, and the merged prefix ('a',)
+        self.assertAlmostEqual(recommendations[0].weight, 7.0)
+        self.assertEqual(
+            recommendations[0].sql,
+            'CREATE INDEX pdsql_t1_a_b_c ON t1 ( a , b , c );')
+        self.assertEqual(len(advisor.recommend(limit=1)), 1)
+
+    def test_record_and_verify(self):
+        connection = sqlite3.connect('tests/db.sqlite3')
+        cursor = connection.cursor()
+        c = PDTable('counties', cursor=cursor)
+        st = PDTable('states', cursor=cursor)
+        advisor = IndexAdvisor()
+        advisor.start()
+        try:
+            for code in ('CA', 'NV'):
+                c.where(c.statecode == code).select(c.name).run().fetchall()
+            list(c.where(c.statecode == 'TX').select(c.name).iter_rows())
+            # Served by the primary key
+            st.where(st.statecode == 'CA').run().fetchall()
+        finally:
+            advisor.stop()
+        self.assertNotIn(advisor._executed, hooks['on_execute_end'])
+
+        recommendations = advisor.recommend(connection)
+        self.assertEqual(
+            [(r.table, r.columns) for r in recommendations],
+            [('counties', ('statecode', 'name'))])
+        self.assertTrue(recommendations[0].weight >= 3)
+
+        verification, = advisor.verify(recommendations, connection)
+        self.assertTrue(verification.improved)
+        self.assertEqual(
+            [node.detail for node in verification.after[0].walk()],
+            ['SEARCH counties USING COVERING INDEX '
+             'pdsql_counties_statecode_name (statecode=?)'])
+        # The database itself is left unchanged
+        self.assertEqual(
+            cursor.execute("SELECT COUNT( * ) FROM sqlite_master WHERE "
+                           "name LIKE 'pdsql_%'").fetchall(), [(0,)])
+        connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+import sqlite3
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from PDSQL.PDAsync import (AsyncRowIterator, StopAsyncIteration,
+                           ThreadedDriver, fetchall_async)
+from PDSQL.PDHooks import add_hook, clear_hooks
+from PDSQL.PDPool import ConnectionPool
+from PDSQL.PDTable import PDTable
+
+
+def connect():
+    return sqlite3.connect('tests/db.sqlite3', check_same_thread=False)
+
+
+class Future(object):
+    """
+    Minimal future calling its callbacks as soon as it is done.
+    """
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def cancelled(self):
+        return False
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def add_done_callback(self, callback):
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _finish(self):
+        self._done = True
+        for callback in self._callbacks:
+            callback(self)
+        self._callbacks = []
+
+
+class ImmediateLoop(object):
+    """
+    Event loop stand-in running executor calls on the calling thread.
+    """
+
+    def create_future(self):
+        return Future()
+
+    def run_in_executor(self, executor, func):
+        future = Future()
+        try:
+            future.set_result(func())
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class TestFutureChaining(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = ImmediateLoop()
+        self.driver = ThreadedDriver(loop=self.loop)
+        self.pool = ConnectionPool(connect, size=1)
+        self.states = PDTable('states', pool=self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def collect(self, rows):
+        results = []
+        while True:
+            future = rows.__anext__()
+            self.assertTrue(future.done())
+            if isinstance(future.exception(), StopAsyncIteration):
+                return results
+            results.append(future.result())
+
+    def test_fetchall(self):
+        st = self.states
+        query = st.select(st.name).where(st.statecode == 'CA')
+        self.assertEqual(fetchall_async(query, self.driver).result(),
+                         [('California',)])
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+
+    def test_iterate(self):
+        st = self.states
+        query = st.select(st.statecode).order(st.statecode)
+        rows = AsyncRowIterator(query, 7, self.driver, loop=self.loop)
+        self.assertEqual(self.collect(rows), query.run().fetchall())
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+        self.assertEqual(self.collect(rows), [])
+
+    def test_aclose(self):
+        st = self.states
+        rows = AsyncRowIterator(st.select(st.statecode), 3, self.driver,
+                                loop=self.loop)
+        self.assertEqual(rows.__anext__().result(), ('AK',))
+        self.assertEqual(self.pool.stats()['checked_out'], 1)
+        self.assertTrue(rows.aclose().done())
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+        self.assertEqual(self.collect(rows), [])
+
+    def test_errors(self):
+        st = self.states
+        rows = AsyncRowIterator(st.select(st.missing), 3, self.driver,
+                                loop=self.loop)
+        self.assertIsInstance(rows.__anext__().exception(),
+                              sqlite3.OperationalError)
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+        self.assertEqual(self.collect(rows), [])
+
+    def test_fetch_hooks(self):
+        fetches = []
+        add_hook('on_fetch', fetches.append)
+        try:
+            st = self.states
+            rows = AsyncRowIterator(st.select(st.statecode), 20,
+                                    self.driver, loop=self.loop)
+            count = len(self.collect(rows))
+            fetchall_async(st.select(st.name), self.driver).result()
+        finally:
+            clear_hooks()
+        self.assertEqual([event.rows for event in fetches],
+                         [20, 20, count - 40, 0, count])
+
+    def test_writes(self):
+        st = self.states
+        write = st.where(st.statecode == 'CA').update(name='Calif')
+        self.assertRaises(Exception, fetchall_async, write, self.driver)
+        self.assertRaises(Exception, AsyncRowIterator, st.delete(), 3,
+                          self.driver, loop=self.loop)
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class TestAsyncQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.connection = connect()
+        self.states = PDTable('states', cursor=self.connection.cursor())
+
+    def tearDown(self):
+        self.connection.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def collect(self, rows):
+        results = []
+        while True:
+            try:
+                results.append(self.loop.run_until_complete(rows.__anext__()))
+            except StopAsyncIteration:
+                return results
+
+    def test_arun(self):
+        st = self.states
+        query = st.select(st.name).where(st.statecode == 'CA')
+        self.assertEqual(
+            self.loop.run_until_complete(query.arun()), [('California',)])
+
+    def test_concurrent(self):
+        st = self.states
+        queries = [st.select(st.statecode).where(st.statecode == code).arun()
+                   for code in ('CA', 'NV', 'WV')]
+        self.assertEqual(
+            self.loop.run_until_complete(asyncio.gather(*queries)),
+            [[('CA',)], [('NV',)], [('WV',)]])
+
+    def test_astream(self):
+        st = self.states
+        query = st.select(st.statecode).order(st.statecode)
+        rows = self.collect(query.astream(batch_size=7))
+        self.assertEqual(rows, query.run().fetchall())
+
+    def test_astream_pool(self):
+        pool = ConnectionPool(connect, size=1)
+        st = PDTable('states', pool=pool)
+        rows = st.select(st.statecode).astream(batch_size=3)
+        self.assertEqual(
+            self.loop.run_until_complete(rows.__anext__()), ('AK',))
+        self.assertEqual(pool.stats()['checked_out'], 1)
+        self.loop.run_until_complete(rows.aclose())
+        self.assertEqual(pool.stats()['checked_out'], 0)
+        self.assertEqual(self.collect(rows), [])
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import sqlite3
+import unittest
+
+from PDSQL import ScalarResult, execute_many
+from PDSQL.PDPool import ConnectionPool
+from PDSQL.PDTable import PDTable
+
+
+def connect():
+    return sqlite3.connect('tests/db.sqlite3', check_same_thread=False)
+
+
+class TestExecuteMany(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool(connect, size=3)
+        self.counties = PDTable('counties', pool=self.pool)
+        self.states = PDTable('states', pool=self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_independent(self):
+        st = self.states
+        queries = [st.select(st.name).where(st.statecode == code)
+                   for code in ('CA', 'NV', 'WV', 'TX')]
+        self.assertEqual(
+            execute_many(queries, workers=3),
+            [[('California',)], [('Nevada',)], [('West Virginia',)],
+             [('Texas',)]])
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+
+    def test_scalar_dependency(self):
+        c = self.counties
+        nc = PDTable(c.group(c.statecode).select(('num_counties', c.count())))
+        avg_num_counties = nc.select(nc.num_counties.avg())
+        st = PDTable(c.group(c.statecode)
+                      .having(c.count() > ScalarResult(0))
+                      .select(('num_states', c.statecode)))
+        num_states = st.select(st.num_states.count())
+
+        avg_nc = avg_num_counties.run().fetchall()[0][0]
+        st = PDTable(c.group(c.statecode)
+                      .having(c.count() > avg_nc)
+                      .select(('num_states', c.statecode)))
+        expected = st.select(st.num_states.count()).run().fetchall()
+
+        for workers in (1, 4):
+            results = execute_many(
+                [avg_num_counties, num_states, self.states.select(
+                    self.states.statecode).where(
+                        self.states.statecode == 'CA')],
+                workers=workers)
+            self.assertEqual(results[0], [(avg_nc,)])
+            self.assertEqual(results[1], expected)
+            self.assertEqual(results[2], [('CA',)])
+
+    def test_without_pool(self):
+        connection = connect()
+        st = PDTable('states', cursor=connection.cursor())
+        results = execute_many(
+            [st.select(st.population_2010).where(st.statecode == 'CA'),
+             st.select(st.statecode)
+               .where(st.population_2010 >= ScalarResult(0))],
+            workers=4)
+        self.assertEqual(results[1], [('CA',)])
+        connection.close()
+
+    def test_errors(self):
+        st = self.states
+        self.assertRaises(
+            Exception, execute_many,
+            [st.where(st.statecode == ScalarResult(1)), st])
+        self.assertRaises(
+            sqlite3.OperationalError, execute_many,
+            [st.select(st.missing), st.select(st.statecode)], workers=2)
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+
+    def test_cursor_errors(self):
+        class BrokenConnection(object):
+            def cursor(self):
+                raise sqlite3.OperationalError('no cursors')
+
+            def close(self):
+                pass
+
+        pool = ConnectionPool(BrokenConnection, size=2, health_check=None)
+        st = self.states
+        self.assertRaises(
+            sqlite3.OperationalError, execute_many,
+            [st.select(st.statecode), st.select(st.name)], workers=2,
+            pool=pool)
+        self.assertEqual(pool.stats()['checked_out'], 0)
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
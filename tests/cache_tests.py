@@ -0,0 +1,247 @@
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from PDSQL.PDCache import LRUCache, ResultCache
+from PDSQL.PDCompiler import fingerprint, sql_cache
+from PDSQL.PDTable import PDTable, result_cache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(
+            cache.stats(),
+            {'hits': 3, 'misses': 1, 'evictions': 1, 'size': 2,
+             'max_size': 2})
+
+    def test_resize(self):
+        cache = LRUCache(max_size=3)
+        for key in 'abc':
+            cache.put(key, key)
+        cache.resize(1)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get('c'), 'c')
+        cache.resize(0)
+        cache.put('d', 'd')
+        self.assertEqual(len(cache), 0)
+        cache.clear()
+        self.assertEqual(cache.evictions, 0)
+
+
+class TestCompiledSQLCache(unittest.TestCase):
+
+    def setUp(self):
+        sql_cache.clear()
+
+    def queries(self, a, b, c):
+        t1 = PDTable('t1')
+        t2 = PDTable('t2')
+        nt = PDTable(t2.group(t2.k).having(t2.k.count() > a)
+                       .select(('n', t2.k.count())))
+        return [
+            t1.where(t1.x == a).where(t1.y.in_((b, c))).select(t1.z),
+            t1.where(t1.x == t2.where(t2.y == b).select(t2.x.max()))
+              .where(t1.z > c),
+            nt.where(nt.n < b).select(nt.n.avg()),
+            t1.where(t1.x > t2.where(t2.y == a).select(t2.x.max()).scalar()
+                     + b).where(t1.z < c),
+            t1.join(t2.where(t2.v == a), cond=t1.k == t2.k)
+              .group(t1.k).having(t1.k.count() > b).order(t1.k + c),
+            t1.where_exists(t2.where(t2.x == t1.y).where(t2.z == a))
+              .where(t1.q > b),
+            t1.order(t1.q).where_exists(
+                t2.select(1).where(t2.x == t1.y).where(t2.z == a))
+              .where(t1.q > b),
+            t1.where(t1.a == a).union(t2.where(t2.b == b)),
+        ]
+
+    def test_hits_reuse_sql(self):
+        for paramstyle in ('qmark', 'named'):
+            PDTable.default_paramstyle = paramstyle
+            try:
+                first = [q.compile(params=True)
+                         for q in self.queries(1, 'b', 3)]
+                misses = sql_cache.misses
+                second = [q.compile(params=True)
+                          for q in self.queries(4, 'e', 6)]
+                self.assertEqual(sql_cache.misses, misses)
+            finally:
+                PDTable.default_paramstyle = 'qmark'
+            for (sql1, params1), (sql2, params2) in zip(first, second):
+                self.assertEqual(sql1, sql2)
+                self.assertEqual(len(params1), len(params2))
+                self.assertEqual(type(params1), type(params2))
+        self.assertEqual(sql_cache.misses, 2 * len(first))
+
+    def test_hit_params_match_fresh_compile(self):
+        for query in self.queries(1, 'b', 3):
+            query.compile(params=True)
+        cached = [q.compile(params=True) for q in self.queries(7, 'h', 9)]
+        sql_cache.resize(0)
+        try:
+            fresh = [q.compile(params=True)
+                     for q in self.queries(7, 'h', 9)]
+        finally:
+            sql_cache.resize(1024)
+        self.assertEqual(cached, fresh)
+        self.assertEqual(
+            fresh[-2],
+            ('SELECT * FROM t1 WHERE ( ( t1.q > ? ) ) AND ( ( t1.y IN ( '
+             'SELECT t2.x FROM t2 WHERE ( ( t2.z = ? ) ) ) ) ) '
+             'ORDER BY t1.q ASC;', ['h', 7]))
+
+    def test_expression_shape_memoized(self):
+        t1, t2 = PDTable('t1'), PDTable('t2')
+        cond = (t1.x == 1) & (t1.y.in_(('a', 'b')))
+        key, literals = fingerprint(t1.where(cond).select(t1.z))
+        self.assertEqual(cond._shape[1], (1, 'a', 'b'))
+        self.assertIsNone((t1.x == 1)._shape)
+        self.assertEqual(
+            fingerprint(t1.where(cond).select(t1.z)), (key, literals))
+        self.assertEqual(
+            t1.where(cond).compile(params=True),
+            ('SELECT * FROM t1 WHERE ( ( ( t1.x = ? ) AND ( t1.y IN '
+             '(?,?) ) ) );', [1, 'a', 'b']))
+
+        # Expressions containing subqueries are walked every time
+        sub = t1.x.in_(t2.where(t2.y == 2).select(t2.x))
+        fingerprint(t1.where(sub))
+        self.assertIsNone(sub._shape)
+
+    def test_inlined_literals_in_key(self):
+        t1 = PDTable('t1')
+        self.assertEqual(
+            t1.order(1).compile(params=True)[0],
+            'SELECT * FROM t1 ORDER BY 1 ASC;')
+        self.assertEqual(
+            t1.order(2).compile(params=True)[0],
+            'SELECT * FROM t1 ORDER BY 2 ASC;')
+        self.assertEqual(
+            t1.limit(2).compile(params=True)[0],
+            'SELECT * FROM t1 LIMIT 2;')
+        self.assertEqual(
+            t1.limit(3).compile(params=True)[0],
+            'SELECT * FROM t1 LIMIT 3;')
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_bytes(self):
+        cache = ResultCache(max_bytes=10)
+        cache.put('a', 1, 4, tables=['t'])
+        cache.put('b', 2, 4, tables=['u'])
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3, 4)
+        self.assertEqual(cache.get('b'), None)
+        cache.put('d', 4, 11)
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(cache.bytes, 8)
+
+        self.assertEqual(cache.invalidate(['t', 'v']), 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+        generation = cache.generation
+        cache.invalidate(['t'])
+        cache.put('e', 5, 1, generation=generation)
+        self.assertEqual(cache.get('e'), None)
+
+    def test_ttl(self):
+        cache = ResultCache(default_ttl=60)
+        cache.put('a', 1, 1)
+        cache.put('b', 2, 1, ttl=0)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+
+class TestCachedQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = self.directory + '/db.sqlite3'
+        shutil.copy('tests/db.sqlite3', path)
+        self.connection = sqlite3.connect(path)
+        cursor = self.connection.cursor()
+        self.counties = PDTable('counties', cursor=cursor)
+        self.states = PDTable('states', cursor=cursor)
+        result_cache.clear()
+
+    def tearDown(self):
+        result_cache.clear()
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+    def test_hits(self):
+        c = self.counties
+        query = c.group(c.statecode).select(c.statecode, c.count()).cached()
+        first = query.run().fetchall()
+        self.assertEqual(first, c.group(c.statecode)
+                         .select(c.statecode, c.count()).run().fetchall())
+        result = query.run()
+        self.assertEqual(result.description[0][0], 'statecode')
+        self.assertEqual(result.fetchone(), first[0])
+        self.assertEqual(list(result), first[1:])
+        self.assertEqual(result_cache.stats()['hits'], 1)
+
+        # Same SQL and parameters from a separately built query
+        c.group(c.statecode).select(c.statecode, c.count()).cached().run()
+        self.assertEqual(result_cache.stats()['hits'], 2)
+
+    def test_invalidation(self):
+        c, s = self.counties, self.states
+        query = s.where(s.statecode.in_(
+            c.where(c.population_2010 > 6000000).select(c.statecode))) \
+            .select(s.name).cached()
+        self.assertEqual(query.run().fetchall(), [(u'California',)])
+        self.assertEqual(len(result_cache), 1)
+
+        se = PDTable('senators', cursor=self.connection.cursor())
+        se.where(se.statecode == 'CA').update(born=0).run()
+        self.assertEqual(len(result_cache), 1)
+        c.where((c.name == 'Cook') & (c.statecode == 'IL')) \
+            .update(population_2010=7000000).run()
+        self.assertEqual(len(result_cache), 0)
+        self.assertEqual(sorted(query.run().fetchall()),
+                         [(u'California',), (u'Illinois',)])
+
+        c.insert_many([{'name': 'New', 'statecode': 'NV',
+                        'population_1950': 0, 'population_2010': 9000000}])
+        self.assertEqual(len(query.run().fetchall()), 3)
+
+    def test_connections(self):
+        # Each connection has its own results, even once closed ones' ids
+        # are reused
+        for value in (1, 2, 3):
+            connection = sqlite3.connect(':memory:')
+            connection.execute('CREATE TABLE t (a integer)')
+            connection.execute('INSERT INTO t VALUES (?)', (value,))
+            t = PDTable('t', cursor=connection.cursor())
+            self.assertEqual(t.select(t.a).cached().run().fetchall(),
+                             [(value,)])
+            connection.close()
+
+    def test_ttl(self):
+        s = self.states
+        query = s.where(s.statecode == 'CA').select(s.name).cached(ttl=0.05)
+        query.run()
+        self.connection.execute(
+            "UPDATE states SET name = 'CA' WHERE statecode = 'CA'")
+        self.assertEqual(query.run().fetchall(), [(u'California',)])
+        time.sleep(0.06)
+        self.assertEqual(query.run().fetchall(), [(u'CA',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
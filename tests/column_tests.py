@@ -22,5 +22,24 @@ class TestUnaryOps(unittest.TestCase):
     def test_repr(self):
         print repr(self.c1+(self.c2-self.c2.sum()))
 
+    def test_immutable(self):
+        c = self.c1.abs()
+        total = c.sum()
+        self.assertEqual(c.ops, ('_abs',))
+        self.assertEqual(total.ops, ('_abs', '_sum'))
+        self.assertEqual(self.c1.ops, ())
+        self.assertTrue(self.c1.count()._count)
+        self.assertFalse(self.c1._count)
+
+        values = [1, 2]
+        col = self.c1.in_(values)
+        values.append(3)
+        self.assertIs(col._children[0], self.c1)
+        self.assertEqual(col._children[1], [1, 2])
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.c1, '__dict__'))
+        self.assertRaises(AttributeError, setattr, self.c1, '_eq', True)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,109 @@
+import sqlite3
+import unittest
+
+from PDSQL.PDExplain import PostgresDialect, SqliteDialect
+from PDSQL.PDTable import PDTable
+
+
+class TestSqliteExplain(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect('tests/db.sqlite3')
+        self.cursor = self.connection.cursor()
+        self.states = PDTable('states', cursor=self.cursor)
+        self.counties = PDTable('counties', cursor=self.cursor)
+        self.senators = PDTable('senators', cursor=self.cursor)
+
+    def test_flags(self):
+        s, c = self.states, self.counties
+        plan = s.join(c, cond=s.statecode == c.statecode) \
+                .order(c.name).explain()
+        self.assertEqual([node.table for node in plan.flagged('full_scan')],
+                         ['counties'])
+        self.assertEqual(
+            [node.detail for node in plan.flagged('temp_btree')],
+            ['USE TEMP B-TREE FOR ORDER BY'])
+        self.assertEqual(plan.flagged('missing_join_index'), [])
+        self.assertEqual(plan.rows, None)
+
+        plan = s.where(s.statecode == 'CA').explain()
+        self.assertEqual(plan.issues, [])
+        self.assertEqual(plan.nodes[0].access, 'search')
+
+    def test_missing_join_index(self):
+        se, c = self.senators, self.counties
+        plan = se.join(c, cond=se.statecode == c.statecode) \
+                 .select(se.name, c.name).explain()
+        nodes = plan.flagged('missing_join_index')
+        self.assertEqual([node.table for node in nodes], ['counties'])
+        self.assertIn('consider an index on counties(statecode)',
+                      [message for flag, node, message in plan.issues
+                       if flag == 'missing_join_index'][0])
+
+    def test_analyze(self):
+        c = self.counties
+        plan = c.where(c.statecode == 'CA').explain(analyze=True)
+        self.assertEqual(plan.rows, 58)
+        self.assertTrue(plan.elapsed >= 0)
+        self.assertIn('rows: 58', str(plan))
+        self.assertRaises(Exception, c.delete().explain, True)
+
+    def test_dialect(self):
+        s = self.states
+        plan = s.explain(dialect='sqlite3')
+        self.assertEqual(plan.flagged('full_scan'), plan.nodes)
+        self.assertRaises(Exception, s.explain, dialect='missing')
+
+        plan = SqliteDialect().explain(
+            self.cursor, 'SELECT 1 UNION SELECT ( SELECT 2 );', [], False)
+        self.assertEqual([node.table for node in plan.walk()
+                          if node.table], [])
+        self.assertEqual(plan.flagged('full_scan'), [])
+
+    def tearDown(self):
+        self.connection.close()
+
+
+class FakeCursor(object):
+    def __init__(self, lines):
+        self.lines = lines
+        self.executed = []
+
+    def execute(self, query, params):
+        self.executed.append(query)
+
+    def fetchall(self):
+        return [(line,) for line in self.lines]
+
+
+class TestPostgresExplain(unittest.TestCase):
+    def test_plan_tree(self):
+        cursor = FakeCursor([
+            'Sort  (cost=10.1..10.2 rows=5 width=8) '
+            '(actual time=0.1..0.1 rows=3 loops=1)',
+            '  Sort Key: t1.a',
+            '  ->  Hash Join  (cost=1.1..9.9 rows=5 width=8)',
+            '        Hash Cond: (t1.k = t2.k)',
+            '        ->  Seq Scan on t1  (cost=0.0..5.0 rows=100 width=8)',
+            '        ->  Hash  (cost=1.0..1.0 rows=5 width=4)',
+            '              ->  Index Scan using t2_pkey on t2  '
+            '(cost=0.1..1.0 rows=5 width=4)',
+        ])
+        t1 = PDTable('t1', cursor=cursor)
+        t2 = PDTable('t2', cursor=cursor)
+        plan = t1.join(t2, cond=t1.k == t2.k).order(t1.a) \
+                 .explain(analyze=True, dialect=PostgresDialect())
+        self.assertTrue(cursor.executed[0].startswith('EXPLAIN ANALYZE '))
+        self.assertEqual(len(plan.nodes), 1)
+        join = plan.nodes[0].children[0]
+        self.assertEqual([node.table for node in join.walk()
+                          if node.table], ['t1', 't2'])
+        self.assertEqual(join.children[1].children[0].index, 't2_pkey')
+        self.assertEqual([node.table for node in plan.flagged('full_scan')],
+                         ['t1'])
+        self.assertEqual(plan.flagged('temp_btree'), [plan.nodes[0]])
+        self.assertEqual(plan.flagged('missing_join_index'), [])
+        self.assertEqual(plan.rows, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import csv
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from PDSQL.PDExport import iter_columnar, read_columnar
+from PDSQL.PDTable import PDTable
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.connection = sqlite3.connect('tests/db.sqlite3')
+        c = PDTable('counties', cursor=self.connection.cursor())
+        self.query = c.where(c.statecode == 'CA').select(
+            c.name, c.population_2010, c.population_2010 / 1000.0)
+        self.rows = self.query.run().fetchall()
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_csv(self):
+        path = self.path('counties.csv')
+        self.assertEqual(self.query.export(path, batch_size=10),
+                         len(self.rows))
+        with open(path) as csv_file:
+            rows = list(csv.reader(csv_file))
+        self.assertEqual(rows[0][:2], ['name', 'population_2010'])
+        self.assertEqual(rows[1:], [[str(value) for value in row]
+                                    for row in self.rows])
+
+    def test_columnar(self):
+        path = self.path('counties.col')
+        self.assertEqual(
+            self.query.export(path, format='columnar', batch_size=10),
+            len(self.rows))
+        self.assertEqual(len(list(iter_columnar(path))), 6)
+        columns = read_columnar(path, arrays=False)
+        self.assertEqual(zip(*columns.values()), self.rows)
+
+        if numpy is not None:
+            columns = read_columnar(path)
+            self.assertEqual(columns['population_2010'].dtype, numpy.int64)
+            self.assertEqual(zip(*[values.tolist()
+                                   for values in columns.values()]),
+                             self.rows)
+
+    def test_columnar_nulls(self):
+        path = self.path('nulls.col')
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE t (a integer, b text, c blob)')
+        rows = [(1, u'caf\xe9', buffer(b'\x00\x01')), (None, None, None),
+                (3, u'', buffer(b''))]
+        connection.executemany('INSERT INTO t VALUES (?, ?, ?)', rows)
+        t = PDTable('t', cursor=connection.cursor())
+        self.assertEqual(t.export(path, format='columnar'), 3)
+        columns = read_columnar(path, arrays=False)
+        self.assertEqual(columns['a'], [1, None, 3])
+        self.assertEqual(columns['b'], [u'caf\xe9', None, u''])
+        self.assertEqual(columns['c'],
+                         [bytearray(b'\x00\x01'), None, bytearray()])
+
+        t.where(t.a > 5).export(path, format='columnar')
+        self.assertEqual(read_columnar(path, arrays=False),
+                         {'a': [], 'b': [], 'c': []})
+        connection.close()
+
+    def test_format(self):
+        self.assertRaises(Exception, self.query.export, self.path('x'),
+                          format='xml')
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not available')
+    def test_arrow(self):
+        path = self.path('counties.arrow')
+        self.query.export(path, format='arrow', batch_size=10)
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(path))
+        self.assertEqual(reader.num_record_batches, 6)
+        table = reader.read_all()
+        self.assertEqual(table.column(1).to_pylist(),
+                         [row[1] for row in self.rows])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not available')
+    def test_arrow_nulls(self):
+        path = self.path('nulls.arrow')
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE t (a integer, b text)')
+        rows = [(idx, None if idx < 4 else str(idx)) for idx in range(6)]
+        connection.executemany('INSERT INTO t VALUES (?, ?)', rows)
+        t = PDTable('t', cursor=connection.cursor())
+        # b only has values from the third batch on
+        self.assertEqual(t.export(path, format='arrow', batch_size=2), 6)
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(path))
+        self.assertEqual(reader.num_record_batches, 3)
+        self.assertEqual(reader.schema.field('b').type, pyarrow.string())
+        self.assertEqual(reader.read_all().column(1).to_pylist(),
+                         [None] * 4 + ['4', '5'])
+        connection.close()
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not available')
+    def test_parquet(self):
+        import pyarrow.parquet as parquet
+        path = self.path('counties.parquet')
+        self.query.export(path, format='parquet', batch_size=10)
+        parquet_file = parquet.ParquetFile(path)
+        self.assertEqual(parquet_file.num_row_groups, 6)
+        self.assertEqual(
+            parquet_file.read().column(0).to_pylist(),
+            [row[0] for row in self.rows])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import sqlite3
+import unittest
+
+from PDSQL.PDHooks import QueryStats, add_hook, clear_hooks, percentile
+from PDSQL.PDTable import PDTable
+
+
+class TestHooks(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect('tests/db.sqlite3')
+        self.cursor = self.connection.cursor()
+        self.events = []
+        for event in ('on_compile_start', 'on_compile_end',
+                      'on_execute_start', 'on_execute_end', 'on_fetch',
+                      'on_error'):
+            add_hook(event, self.events.append)
+
+    def tearDown(self):
+        clear_hooks()
+        self.connection.close()
+
+    def test_events(self):
+        s = PDTable('states', cursor=self.cursor)
+        query = s.where(s.statecode == 'CA').select(s.name)
+        self.assertEqual(query.run().fetchall(), [('California',)])
+        self.assertEqual(
+            [event.event for event in self.events],
+            ['on_compile_start', 'on_compile_end', 'on_execute_start',
+             'on_execute_end', 'on_fetch'])
+
+        compiled, executed, fetched = self.events[1], self.events[3], \
+            self.events[4]
+        self.assertEqual(compiled.sql, query.compile(params=True)[0])
+        self.assertTrue(compiled.compile_time >= 0)
+        self.assertEqual(list(executed.params), ['CA'])
+        self.assertTrue(executed.execute_time >= 0)
+        self.assertEqual((fetched.rows, fetched.bytes), (1, 10))
+        self.assertEqual(
+            executed.fingerprint,
+            s.where(s.statecode == 'NV').select(s.name).fingerprint())
+
+    def test_batches(self):
+        c = PDTable('counties', cursor=self.cursor)
+        batches = list(c.where(c.statecode == 'CA').select(c.name)
+                       .iter_batches(20))
+        fetches = [event for event in self.events
+                   if event.event == 'on_fetch']
+        self.assertEqual([event.rows for event in fetches],
+                         [len(rows) for rows in batches])
+
+    def test_error(self):
+        t = PDTable('missing', cursor=self.cursor)
+        self.assertRaises(sqlite3.OperationalError, t.run)
+        self.assertEqual(
+            [event.event for event in self.events][-2:],
+            ['on_execute_start', 'on_error'])
+        self.assertIsInstance(self.events[-1].error,
+                              sqlite3.OperationalError)
+
+
+class TestQueryStats(unittest.TestCase):
+    def test_percentile(self):
+        samples = list(range(1, 101))
+        self.assertEqual(percentile(samples, 50), 50)
+        self.assertEqual(percentile(samples, 99), 99)
+        self.assertEqual(percentile([3], 95), 3)
+        self.assertEqual(percentile([], 50), None)
+
+    def test_summary(self):
+        connection = sqlite3.connect('tests/db.sqlite3')
+        s = PDTable('states', cursor=connection.cursor())
+        stats = QueryStats()
+        stats.start()
+        try:
+            for code in ('CA', 'NV', 'TX'):
+                s.where(s.statecode == code).run().fetchall()
+            s.select(s.name).run().fetchall()
+            missing = PDTable('missing', cursor=connection.cursor())
+            self.assertRaises(sqlite3.OperationalError, missing.run)
+        finally:
+            stats.stop()
+            connection.close()
+        s.select(s.name).compile()
+
+        summary = stats.summary()
+        self.assertEqual(len(summary), 3)
+        # Queries that only failed have no times and are listed last
+        failed = summary.pop()
+        self.assertEqual((failed['errors'], failed['p99']), (1, None))
+        counts = dict((entry['sql'], entry['count']) for entry in summary)
+        self.assertEqual(counts[s.where(s.statecode == 'CA').compile(
+            params=True)[0]], 3)
+        for entry in summary:
+            self.assertTrue(entry['p50'] <= entry['p95'] <= entry['p99']
+                            <= entry['max'])
+            self.assertEqual(entry['errors'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from PDSQL.PDMaterialize import _incremental_plan, views
+from PDSQL.PDTable import PDTable
+
+
+class TestMaterialize(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = self.directory + '/db.sqlite3'
+        shutil.copy('tests/db.sqlite3', path)
+        self.connection = sqlite3.connect(path)
+        self.counties = PDTable('counties', cursor=self.connection.cursor())
+
+    def tearDown(self):
+        views.clear()
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+    def aggregates(self):
+        c = self.counties
+        return c.where(c.population_2010 > 0).group(c.statecode).select(
+            c.statecode, ('num_counties', c.count()),
+            ('total', c.population_2010.sum()),
+            ('smallest', c.population_2010.min()),
+            c.population_1950.max())
+
+    def rows(self, table):
+        return sorted(table.run().fetchall())
+
+    def insert(self, *rows):
+        self.counties.insert_many(
+            [{'name': name, 'statecode': statecode, 'population_1950': 0,
+              'population_2010': population}
+             for name, statecode, population in rows])
+
+    def test_materialize(self):
+        query = self.aggregates()
+        nc = query.materialize('num_counties')
+        self.assertEqual(self.rows(nc), self.rows(query))
+        self.assertEqual(
+            nc.select(nc.num_counties.avg()).compile(),
+            'SELECT AVG( num_counties.num_counties ) FROM num_counties;')
+        self.assertEqual(
+            nc.select(nc.column5).where(nc.statecode == 'CA')
+            .run().fetchall(), [(4151687,)])
+        self.assertRaises(Exception, query.materialize, 'num_counties')
+
+    def test_manual_refresh(self):
+        query = self.aggregates()
+        nc = query.materialize('num_counties')
+        before = self.rows(nc)
+        self.insert(('New', 'NV', 5), ('Newer', 'XX', 10), ('Empty', 'NV', 0))
+        self.assertEqual(self.rows(nc), before)
+        nc.refresh()
+        self.assertEqual(self.rows(nc), self.rows(query))
+        self.assertEqual(views.values()[0].last_rowid,
+                         self.connection.execute(
+                             'SELECT MAX(rowid) FROM counties').fetchone()[0])
+
+        c = self.counties
+        c.where(c.statecode == 'XX').delete().run()
+        nc.refresh(full=True)
+        self.assertEqual(self.rows(nc), self.rows(query))
+
+    def test_on_write(self):
+        c = self.counties
+        query = c.group(c.statecode).select(c.statecode, c.count())
+        nc = query.materialize('num_counties', refresh='on_write')
+        self.insert(('New', 'NV', 5))
+        self.assertEqual(self.rows(nc), self.rows(query))
+        c.where(c.name == 'New').delete().run()
+        self.assertEqual(self.rows(nc), self.rows(query))
+
+    def test_full_only(self):
+        c = self.counties
+        query = c.group(c.statecode).select(
+            c.statecode, ('average', c.population_2010.avg()))
+        nc = query.materialize('averages', refresh='on_write')
+        self.assertEqual(views.values()[0].incremental, None)
+        self.insert(('New', 'NV', 5))
+        self.assertEqual(self.rows(nc), self.rows(query))
+        nc.drop_view()
+        self.assertEqual(len(views), 0)
+        self.assertRaises(Exception, nc.refresh)
+
+        # Only SQLite tables with rowids are refreshed incrementally
+        class Cursor(object):
+            pass
+        self.assertEqual(_incremental_plan(
+            PDTable('counties', cursor=Cursor()).group(c.statecode)
+            .select(c.statecode, c.count())), None)
+        self.connection.execute(
+            'CREATE TABLE w (k text PRIMARY KEY, v integer) WITHOUT ROWID')
+        w = PDTable('w', cursor=self.connection.cursor())
+        query = w.select(w.v.sum())
+        total = query.materialize('total', refresh='on_write')
+        self.assertEqual(views.values()[0].incremental, None)
+        w.insert_many([('a', 1), ('b', 2)], columns=['k', 'v'])
+        self.assertEqual(self.rows(total), [(3,)])
+
+    def test_filtered_appends(self):
+        query = self.aggregates()
+        nc = query.materialize('num_counties', refresh='on_write')
+        before = self.rows(nc)
+        # The WHERE clause drops every appended row
+        self.insert(('Empty', 'NV', 0), ('Empty', 'XX', 0))
+        self.assertEqual(self.rows(nc), before)
+        self.assertEqual(self.rows(nc), self.rows(query))
+
+    def test_ungrouped(self):
+        c = self.counties
+        query = c.where(c.population_2010 > 0).select(
+            ('n', c.count()), ('total', c.population_2010.sum()),
+            ('smallest', c.population_2010.min()))
+        totals = query.materialize('totals', refresh='on_write')
+        self.assertNotEqual(views.values()[0].incremental, None)
+        self.insert(('Empty', 'NV', 0))
+        self.assertEqual(self.rows(totals), self.rows(query))
+        self.insert(('New', 'NV', 5), ('Newer', 'XX', 10))
+        self.assertEqual(self.rows(totals), self.rows(query))
+        self.assertEqual(self.rows(totals)[0][2], 5)
+
+    def test_connections(self):
+        other = sqlite3.connect(self.directory + '/db.sqlite3')
+        c = PDTable('counties', cursor=other.cursor())
+        nc = c.group(c.statecode).select(c.statecode, c.count()) \
+              .materialize('num_counties', refresh='on_write')
+        # Views on another connection are not refreshed by its writes
+        nevada = nc.where(nc.statecode == 'NV')
+        before = nevada.run().fetchall()
+        self.insert(('New', 'NV', 5))
+        self.assertEqual(nevada._derive().run().fetchall(), before)
+
+        # Nor once it is closed, when the name can be used again
+        other.close()
+        self.insert(('Newer', 'NV', 5))
+        query = self.aggregates()
+        nc = query.materialize('num_counties', refresh='on_write')
+        self.assertEqual(len(views), 1)
+        self.insert(('Newest', 'NV', 5))
+        self.assertEqual(self.rows(nc), self.rows(query))
+
+
+if __name__ == '__main__':
+    unittest.main()
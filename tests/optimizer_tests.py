@@ -0,0 +1,357 @@
+import sqlite3
+import unittest
+from StringIO import StringIO
+
+from PDSQL.PDColumn import PDColumn
+from PDSQL.PDOptimizer import Optimizer, optimizer, walk
+from PDSQL.PDTable import PDTable
+
+
+class TestRules(unittest.TestCase):
+    def setUp(self):
+        self.t1 = PDTable('t1')
+        self.t2 = PDTable('t2')
+        self.t3 = PDTable('t3')
+
+    def test_exists_to_in(self):
+        t1, t2, t3 = self.t1, self.t2, self.t3
+        query = t1.where_exists(t2.where(t2.x == t1.y).where(t2.z == 3)) \
+                  .where_exists(t3.where(t3.x == t1.y).where(t3.k == 'a'))
+        self.assertEqual(
+            query.compile(params=True),
+            ('SELECT * FROM t1 WHERE ( ( t1.y IN ( SELECT t2.x FROM t2 '
+             'WHERE ( ( t2.z = ? ) ) ) ) ) AND ( ( t1.y IN ( SELECT t3.x '
+             'FROM t3 WHERE ( ( t3.k = ? ) ) ) ) );', [3, 'a']))
+
+        # Not selective
+        query = t1.where_exists(t2.where(t2.x == t1.y))
+        self.assertEqual(
+            query.compile(),
+            'SELECT * FROM t1 WHERE EXISTS ( ( SELECT * FROM t2 WHERE ( ( '
+            't2.x = t1.y ) ) ) );')
+
+    def test_nested_exists_to_in(self):
+        t1, t2, t3 = self.t1, self.t2, self.t3
+        inner = t2.where_exists(t3.where(t3.id == t2.id).where(t3.v == 1))
+        query = t1.where(t1.a.in_(inner.select(t2.a)))
+        self.assertEqual(
+            query.compile(),
+            'SELECT * FROM t1 WHERE ( ( t1.a IN ( SELECT t2.a FROM t2 WHERE '
+            '( ( t2.id IN ( SELECT t3.id FROM t3 WHERE ( ( t3.v = 1 ) ) ) ) '
+            ') ) ) );')
+
+    def test_in_to_join(self):
+        t1, t2 = self.t1, self.t2
+        sub = t2.where(t2.b > 3).select(t2.a)
+        query = t1.where(t1.a.in_(sub)).select(t1.x)
+        self.assertEqual(
+            query.distinct().compile(params=True),
+            ('SELECT DISTINCT t1.x FROM ( t1 INNER JOIN t2 ON ( t1.a = t2.a '
+             ') ) WHERE ( ( t2.b > ? ) );', [3]))
+
+        # Without DISTINCT, joining could duplicate rows
+        self.assertEqual(
+            query.compile(),
+            'SELECT t1.x FROM t1 WHERE ( ( t1.a IN ( SELECT t2.a FROM t2 '
+            'WHERE ( ( t2.b > 3 ) ) ) ) );')
+        # Aggregates would count the joined rows
+        query = t1.where(t1.a.in_(sub)).select(t1.x.count()).distinct()
+        self.assertIn('IN', query.compile())
+
+    def test_predicate_pushdown(self):
+        t1 = self.t1
+        sub = PDTable(t1.select(('x', t1.a), t1.b))
+        query = sub.where(sub.x > 5).where(sub.b.is_null()).select(sub.x)
+        self.assertEqual(
+            query.compile(params=True),
+            ('SELECT x FROM ( ( SELECT t1.a AS "x" , t1.b FROM t1 WHERE ( ( '
+             't1.a > ? ) ) AND ( t1.b IS NULL ) ) );', [5]))
+
+        # Filtering before a LIMIT would change the results
+        sub = PDTable(t1.select(('x', t1.a)).limit(3))
+        self.assertEqual(
+            sub.where(sub.x > 5).compile(),
+            'SELECT * FROM ( ( SELECT t1.a AS "x" FROM t1 LIMIT 3 ) ) '
+            'WHERE ( ( x > 5 ) );')
+
+    def test_predicate_pushdown_grouped(self):
+        c = PDTable('counties')
+        nc = PDTable(c.group(c.statecode)
+                      .select(c.statecode, ('num_counties', c.count())))
+        query = nc.where((nc.statecode == 'CA') & (nc.num_counties > 5))
+        self.assertEqual(
+            query.compile(params=True),
+            ('SELECT * FROM ( ( SELECT counties.statecode , COUNT( * ) AS '
+             '"num_counties" FROM counties WHERE ( ( counties.statecode = ? '
+             ') ) GROUP BY counties.statecode ) ) WHERE ( ( num_counties > ? '
+             ') );', ['CA', 5]))
+
+        # Aggregates without GROUP BY are over every row of the subquery
+        t1 = self.t1
+        sub = PDTable(t1.select(t1.b, ('s', t1.a.sum())))
+        self.assertEqual(
+            sub.where(sub.b > 1).compile(),
+            'SELECT * FROM ( ( SELECT t1.b , SUM( t1.a ) AS "s" FROM t1 ) ) '
+            'WHERE ( ( b > 1 ) );')
+
+    def test_predicate_pushdown_join(self):
+        t1, t2 = self.t1, self.t2
+        query = t1.join(t2.where(t2.k == 'a'), cond=t1.k == t2.k) \
+                  .where((t2.b > 3) & (t1.c < 2)).select(t1.a)
+        self.assertEqual(
+            query.compile(),
+            'SELECT t1.a FROM ( t1 INNER JOIN ( SELECT * FROM t2 WHERE ( ( '
+            't2.k = "a" ) ) AND ( ( t2.b > 3 ) ) ) t2 ON ( t1.k = t2.k ) ) '
+            'WHERE ( ( t1.c < 2 ) );')
+
+        # Only conditions on grouping columns are pushed into GROUP BY
+        query = t1.join(t2.group(t2.k).select(t2.k, t2.v.sum()),
+                        cond=t1.k == t2.k) \
+                  .where(t2.k == 1).where(t2.v > 3)
+        self.assertEqual(
+            query.compile(),
+            'SELECT * FROM ( t1 INNER JOIN ( SELECT t2.k , SUM( t2.v ) FROM '
+            't2 WHERE ( ( t2.k = 1 ) ) GROUP BY t2.k ) t2 ON ( t1.k = t2.k ) '
+            ') WHERE ( ( t2.v > 3 ) );')
+
+    def test_projection_pruning(self):
+        t1, t2 = self.t1, self.t2
+        sub = PDTable(t1.where(t1.a > 1))
+        self.assertEqual(
+            sub.select(sub.b, sub.count()).where(sub.c == 2).order(sub.d)
+               .compile(),
+            'SELECT b , COUNT( * ) FROM ( ( SELECT t1.b , t1.d FROM t1 WHERE '
+            '( ( t1.a > 1 ) ) AND ( ( t1.c = 2 ) ) ) ) ORDER BY d ASC;')
+
+        # Columns referred to from a nested subquery are kept
+        query = sub.select(sub.b).where(
+            sub.b > t2.where(t2.x == sub.e).select(t2.y.max()))
+        self.assertEqual(
+            query.compile(),
+            'SELECT b FROM ( ( SELECT t1.b , t1.e FROM t1 WHERE ( ( t1.a > 1 '
+            ') ) ) ) WHERE ( ( b > ( SELECT MAX( t2.y ) FROM t2 WHERE ( ( '
+            't2.x = e ) ) ) ) );')
+
+        # Nor with columns that could be any of the subquery's
+        self.assertEqual(
+            sub.select(sub.b).where(PDColumn('c') > 1).compile(),
+            'SELECT b FROM ( ( SELECT * FROM t1 WHERE ( ( t1.a > 1 ) ) ) ) '
+            'WHERE ( ( c > 1 ) );')
+
+        # Not without a SELECT, or with DISTINCT or a set operation
+        self.assertEqual(
+            sub.compile(),
+            'SELECT * FROM ( ( SELECT * FROM t1 WHERE ( ( t1.a > 1 ) ) ) );')
+        sub = PDTable(t1.distinct())
+        self.assertEqual(
+            sub.select(sub.b).compile(),
+            'SELECT b FROM ( ( SELECT DISTINCT * FROM t1 ) );')
+        sub = PDTable(t1.union(t2))
+        self.assertEqual(
+            sub.select(sub.b).compile(),
+            'SELECT b FROM ( SELECT * FROM t1 UNION SELECT * FROM t2 );')
+
+    def test_constant_folding(self):
+        t1 = self.t1
+        query = t1.where(t1.a + 1 + 2 > t1.b * 2 * 3).where(t1.c - 5 + 2 == 1)
+        self.assertEqual(
+            query.compile(),
+            'SELECT * FROM t1 WHERE ( ( ( t1.a + 3 ) > ( t1.b * 6 ) ) ) AND '
+            '( ( ( t1.c - 3 ) = 1 ) );')
+        node = Optimizer().optimize(query)[0]
+        folded = [col for op, col in node._operation_ordering
+                  if op == '_where'][1]._children[0]
+        self.assertEqual(folded._children, (folded._children[0], 3))
+        # Bound parameters are left alone
+        self.assertEqual(
+            t1.where(t1.a + 1 + 2 > 4).compile(params=True),
+            ('SELECT * FROM t1 WHERE ( ( ( ( t1.a + ? ) + ? ) > ? ) );',
+             [1, 2, 4]))
+
+
+class TestOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.t1 = PDTable('t1')
+        self.t2 = PDTable('t2')
+
+    def tearDown(self):
+        optimizer.enable('exists_to_in')
+        optimizer.debug = False
+        optimizer.stream = None
+
+    def test_toggle(self):
+        t1, t2 = self.t1, self.t2
+        query = t1.where_exists(t2.where(t2.x == t1.y).where(t2.z == 3))
+        self.assertIn('IN', query.compile(params=True)[0])
+        optimizer.disable('exists_to_in')
+        self.assertNotIn('exists_to_in', optimizer.enabled)
+        self.assertIn('EXISTS', query._derive().compile(params=True)[0])
+        optimizer.enable('exists_to_in')
+        self.assertIn('IN', query._derive().compile(params=True)[0])
+        self.assertRaises(Exception, optimizer.disable, 'missing')
+
+    def test_optimize(self):
+        t1, t2 = self.t1, self.t2
+        query = t1.where_exists(t2.where(t2.x == t1.y).where(t2.z == 3))
+        node, rewrites = Optimizer().optimize(query)
+        self.assertEqual([rewrite.rule for rewrite in rewrites],
+                         ['exists_to_in'])
+        self.assertFalse(node.has_query('_where_exists'))
+        self.assertTrue(query.has_query('_where_exists'))
+
+        node, rewrites = Optimizer(rules=[]).optimize(query)
+        self.assertIs(node, query)
+        self.assertEqual(rewrites, [])
+
+        # Rewritten nodes keep their children in tuples
+        sub = PDTable(t1.select(('x', t1.a + 1), t1.b))
+        node, rewrites = Optimizer().optimize(
+            sub.where((sub.x > 5) & (sub.b < 2)).select(sub.x))
+        self.assertEqual([rewrite.rule for rewrite in rewrites],
+                         ['predicate_pushdown'])
+        children = []
+        walk(node, lambda item: children.append(item._children)
+             if hasattr(item, '_children') else None)
+        self.assertTrue(all(isinstance(item, tuple) for item in children))
+
+    def test_pushdown_results(self):
+        connection = sqlite3.connect('tests/db.sqlite3')
+        cursor = connection.cursor()
+        c = PDTable('counties', cursor=cursor)
+        s = PDTable('states', cursor=cursor)
+        nc = PDTable(c.group(c.statecode)
+                      .select(c.statecode, ('num_counties', c.count())))
+        queries = [
+            nc.where(nc.statecode == 'CA').where(nc.num_counties > 5),
+            s.join(c.where(c.population_2010 > 1000000),
+                   cond=s.statecode == c.statecode)
+             .where(c.statecode == 'CA').select(s.name, c.name)
+             .order(c.name),
+        ]
+        pushed = [query.run().fetchall() for query in queries]
+        optimizer.disable('predicate_pushdown')
+        try:
+            self.assertEqual(
+                [query._derive().run().fetchall() for query in queries],
+                pushed)
+        finally:
+            optimizer.enable('predicate_pushdown')
+            connection.close()
+        self.assertEqual(pushed[0], [('CA', 58)])
+
+    def test_pushdown_join_alias_results(self):
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE t1 (id integer, a integer)')
+        connection.execute('CREATE TABLE t2 (id integer, x integer, '
+                           'y integer)')
+        connection.executemany('INSERT INTO t1 VALUES (?, ?)',
+                               [(1, 1), (2, 2), (3, 3)])
+        connection.executemany('INSERT INTO t2 VALUES (?, ?, ?)',
+                               [(1, 20, 5), (2, 5, 20), (3, 30, 30)])
+        cursor = connection.cursor()
+        t1 = PDTable('t1', cursor=cursor)
+        t2 = PDTable('t2', cursor=cursor)
+        # x is the joined subquery's alias for t2.y, not t2.x
+        sub = t2.select(t2.id, ('x', t2.y))
+        query = t1.join(sub, cond=t1.id == t2.id).where(t2.x > 10) \
+                  .select(t1.a).order(t1.a)
+        self.assertIn('FROM t2 WHERE ( ( t2.y > 10 ) )', query.compile())
+        pushed = query.run().fetchall()
+        optimizer.disable('predicate_pushdown')
+        try:
+            self.assertEqual(query._derive().run().fetchall(), pushed)
+        finally:
+            optimizer.enable('predicate_pushdown')
+            connection.close()
+        self.assertEqual(pushed, [(2,), (3,)])
+
+    def test_pushdown_nested_results(self):
+        connection = sqlite3.connect('tests/db.sqlite3')
+        cursor = connection.cursor()
+        st = PDTable('states', cursor=cursor)
+        c = PDTable('counties', cursor=cursor)
+        inner = PDTable(st.select(('pop', st.population_2010), st.name))
+        middle = PDTable(inner.where(inner.pop > 1000000)
+                         .select(('n', inner.name), inner.pop))
+        nc = PDTable(c.group(c.statecode)
+                      .select(c.statecode, ('num', c.count())))
+        renamed = PDTable(nc.select(('code', nc.statecode), ('k', nc.num)))
+        queries = [
+            middle.where(middle.pop < 5000000).where(middle.n > 'M')
+                  .order(middle.n),
+            renamed.where(renamed.k > 100).where(renamed.code < 'M')
+                   .order(renamed.code),
+        ]
+        # Conditions go through both levels at once, or as far as they can
+        self.assertIn(
+            'FROM states WHERE ( ( states.population_2010 > 1000000 ) ) AND '
+            '( ( states.population_2010 < 5000000 ) ) AND ( ( states.name > '
+            '"M" ) )', queries[0].compile())
+        self.assertIn(
+            'FROM counties WHERE ( ( counties.statecode < "M" ) ) GROUP BY '
+            'counties.statecode ) ) WHERE ( ( num > 100 ) )',
+            queries[1].compile())
+        pushed = [query.run().fetchall() for query in queries]
+        optimizer.disable('predicate_pushdown')
+        try:
+            self.assertEqual(
+                [query._derive().run().fetchall() for query in queries],
+                pushed)
+        finally:
+            optimizer.enable('predicate_pushdown')
+            connection.close()
+        self.assertEqual(pushed[1][0], ('GA', 159))
+
+    def test_pushdown_aggregate_results(self):
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE t (a integer, b integer)')
+        connection.executemany('INSERT INTO t VALUES (?, ?)',
+                               [(1, 1), (2, 1), (3, 2)])
+        t = PDTable('t', cursor=connection.cursor())
+        sub = PDTable(t.select(t.b, ('s', t.a.sum())))
+        # The single row's b is from any row, but its sum is over them all
+        rows = sub.where(sub.b > 1).run().fetchall() \
+            + sub.where(sub.b <= 1).run().fetchall()
+        self.assertEqual([row[1] for row in rows], [6])
+        connection.close()
+
+    def test_pruning_results(self):
+        connection = sqlite3.connect('tests/db.sqlite3')
+        st = PDTable('states', cursor=connection.cursor())
+        sub = PDTable(st.where(st.population_2010 > 10000000))
+        query = sub.select(sub.name).where(sub.landarea > 100000) \
+                   .order(sub.name)
+        self.assertIn('SELECT states.name FROM states', query.compile())
+        pruned = query.run().fetchall()
+        optimizer.disable('projection_pruning')
+        try:
+            self.assertEqual(query._derive().run().fetchall(), pruned)
+        finally:
+            optimizer.enable('projection_pruning')
+            connection.close()
+        self.assertEqual(pruned, [('California',), ('Texas',)])
+
+        connection = sqlite3.connect('tests/db.sqlite3')
+        st = PDTable('states', cursor=connection.cursor())
+        sub = PDTable(st.where(st.population_2010 > 10000000))
+        query = sub.select(sub.name).where(PDColumn('landarea') > 100000)
+        self.assertEqual(sorted(query.run().fetchall()),
+                         [('California',), ('Texas',)])
+        connection.close()
+
+    def test_debug(self):
+        t1 = self.t1
+        stream = StringIO()
+        optimizer.debug = True
+        optimizer.stream = stream
+        sub = PDTable(t1.select(('x', t1.a)))
+        for _ in range(2):
+            sub.where(sub.x + 1 + 2 > 5).compile(params=True)
+        self.assertEqual(
+            stream.getvalue(),
+            '[predicate_pushdown] pushed 1 WHERE conditions into subquery\n'
+            * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import sqlite3
+import threading
+import unittest
+
+from PDSQL.PDPool import ConnectionPool
+from PDSQL.PDTable import PDTable
+
+
+def connect():
+    return sqlite3.connect('tests/db.sqlite3', check_same_thread=False)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool(connect, size=2, timeout=0.05)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_reuse(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+        self.assertIs(self.pool.acquire(), connection)
+        stats = self.pool.stats()
+        self.assertEqual(stats['open'], 1)
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+
+    def test_timeout(self):
+        self.pool.acquire()
+        self.pool.acquire()
+        self.assertRaises(Exception, self.pool.acquire)
+        self.assertEqual(self.pool.stats()['open'], 2)
+
+    def test_overflow(self):
+        pool = ConnectionPool(connect, size=1, max_overflow=1, timeout=0.05)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertEqual(pool.stats()['overflow'], 1)
+        self.assertRaises(Exception, pool.acquire)
+        pool.release(second)
+        self.assertEqual(pool.stats()['open'], 1)
+        self.assertRaises(sqlite3.ProgrammingError, second.cursor)
+        pool.release(first)
+        pool.close()
+
+    def test_wait_metrics(self):
+        connection = self.pool.acquire()
+        self.pool.acquire()
+        timer = threading.Timer(0.01, self.pool.release, (connection,))
+        timer.start()
+        self.assertIs(self.pool.acquire(timeout=1), connection)
+        stats = self.pool.stats()
+        self.assertEqual(stats['wait_count'], 1)
+        self.assertTrue(stats['max_wait'] > 0)
+
+    def test_health_check(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+        connection.close()
+        replacement = self.pool.acquire()
+        self.assertIsNot(replacement, connection)
+        self.assertEqual(self.pool.stats()['health_check_failures'], 1)
+        self.assertEqual(self.pool.stats()['open'], 1)
+
+    def test_discard_on_error(self):
+        try:
+            with self.pool.connection() as connection:
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.pool.stats()['open'], 0)
+
+
+class TestPooledQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool(connect, size=2)
+        self.states = PDTable('states', pool=self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_run(self):
+        st = self.states
+        query = st.select(st.name).where(st.statecode == 'CA')
+        self.assertEqual(query.run().fetchall(), [('California',)])
+        results = query.run()
+        self.assertEqual(self.pool.stats()['checked_out'], 1)
+        self.assertEqual(list(results), [('California',)])
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+        results = query.run()
+        results.close()
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+        self.assertEqual(len(list(st.select(st.statecode).iter_rows(7))), 50)
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+
+    def test_subqueries_and_set_operations(self):
+        st = self.states
+        nested = PDTable(st.select(('code', st.statecode)))
+        self.assertEqual(len(nested.select(nested.code).run().fetchall()), 50)
+        union = st.where(st.statecode == 'CA').select(st.statecode) \
+                  .union(st.where(st.statecode == 'NV').select(st.statecode))
+        self.assertEqual(sorted(union.run().fetchall()), [('CA',), ('NV',)])
+
+    def test_threads(self):
+        st = self.states
+        results = []
+
+        def worker(code):
+            query = st.select(st.statecode).where(st.statecode == code)
+            results.append(query.run().fetchall())
+
+        threads = [threading.Thread(target=worker, args=(code,))
+                   for code in ('CA', 'NV', 'WV', 'TX') * 5]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 20)
+        self.assertTrue(self.pool.stats()['open'] <= 2)
+        self.assertEqual(self.pool.stats()['checked_out'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
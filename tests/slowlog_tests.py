@@ -0,0 +1,76 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from PDSQL.PDSlowLog import SlowQueryLog
+from PDSQL.PDTable import PDTable
+
+
+class TestSlowQueryLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'slow.log')
+        self.connection = sqlite3.connect('tests/db.sqlite3',
+                                          check_same_thread=False)
+        self.counties = PDTable('counties', cursor=self.connection.cursor())
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        with open(self.path) as log_file:
+            return log_file.read()
+
+    def run_queries(self, slow_log, codes):
+        c = self.counties
+        slow_log.start()
+        try:
+            for code in codes:
+                c.where(c.statecode == code).select(c.name).run().fetchall()
+            slow_log.flush()
+        finally:
+            slow_log.stop()
+
+    def test_dedupe(self):
+        slow_log = SlowQueryLog(self.path, threshold=0)
+        self.run_queries(slow_log, ('CA', 'NV', 'TX'))
+        log = self.read()
+        self.assertEqual(log.count('slow query '), 1)
+        self.assertIn('SQL: SELECT counties.name FROM counties WHERE', log)
+        self.assertIn("params: ['CA']", log)
+        self.assertIn('SCAN counties  [full_scan]', log)
+
+    def test_repeats(self):
+        slow_log = SlowQueryLog(self.path, threshold=0, dedupe_interval=0,
+                                capture_plans=False)
+        self.run_queries(slow_log, ('CA', 'NV'))
+        log = self.read()
+        self.assertEqual(log.count('slow query '), 2)
+        self.assertNotIn('plan:', log)
+
+    def test_threshold(self):
+        slow_log = SlowQueryLog(self.path, threshold=60)
+        self.run_queries(slow_log, ('CA',))
+        self.assertEqual(self.read(), '')
+
+    def test_factory(self):
+        slow_log = SlowQueryLog(
+            self.path, threshold=0,
+            factory=lambda: sqlite3.connect('tests/db.sqlite3'))
+        self.run_queries(slow_log, ('CA',))
+        self.assertIn('SCAN counties  [full_scan]', self.read())
+
+    def test_rotation(self):
+        slow_log = SlowQueryLog(self.path, threshold=0, max_bytes=200,
+                                backup_count=2, dedupe_interval=0)
+        self.run_queries(slow_log, ('CA', 'NV', 'TX'))
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        self.assertTrue(os.path.exists(self.path + '.2'))
+        self.assertFalse(os.path.exists(self.path + '.3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
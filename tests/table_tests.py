@@ -1,8 +1,12 @@
+import copy
+import os
+import shutil
 import sqlite3
+import tempfile
 import unittest
 
 from PDSQL.PDTable import PDTable
-from PDSQL.PDColumn import PDColumn
+from PDSQL.PDColumn import PDColumn, interned, scalar_values
 
 
 class TestTableComposition(unittest.TestCase):
@@ -42,6 +46,55 @@ class TestTableComposition(unittest.TestCase):
         self.assertFalse(t.has_query("_join"))
         self.assertFalse(self.t2.has_query("_join"))
 
+    def test_shared_operations(self):
+        t1 = self.t1
+        base = t1.where(t1.c1 == 1)
+        q1 = base.order(t1.c1)
+        q2 = base.select(t1.c2)
+        self.assertEqual(len(base._operation_ordering), 1)
+        self.assertIs(q1._operation_ordering._parent,
+                      base._operation_ordering)
+        self.assertIs(q2._operation_ordering._parent,
+                      base._operation_ordering)
+        self.assertFalse(base.has_query('_order'))
+        self.assertEqual(
+            base.compile(), 'SELECT * FROM t1 WHERE ( ( t1.c1 = 1 ) );')
+        self.assertEqual(
+            q2.compile(), 'SELECT t1.c2 FROM t1 WHERE ( ( t1.c1 = 1 ) );')
+
+    def test_attributes(self):
+        t1 = self.t1
+        self.assertFalse(hasattr(t1, '__dict__'))
+        self.assertIsInstance(t1.col, PDColumn)
+        self.assertIsInstance(t1._limit_value, PDColumn)
+        self.assertRaises(AttributeError, getattr, t1, '__length_hint__')
+
+        # An unset attribute is an error rather than a column
+        table = object.__new__(PDTable)
+        self.assertRaises(AttributeError, getattr, table, '_name')
+
+        q = t1.where(t1.c1 == 1).union(self.t2)
+        q_copy = copy.copy(q)
+        self.assertIsNot(q_copy, q)
+        self.assertEqual(q_copy.compile(), q.compile())
+
+    def test_interning(self):
+        t1, t2 = self.t1, self.t2
+        self.assertIs(t1.c1, t1.c1)
+        self.assertIs(t1['c1'], t1.c1)
+        self.assertIsNot(t1.c1, t2.c1)
+        self.assertIs(t1.count(), t1.count())
+        self.assertIs(t1.c1.sum().abs(), t1.c1.sum().abs())
+        self.assertIs(t1.c1.is_null(), t1.c1.is_null())
+        self.assertIs(t1.c1 + t2.c1, t1.c1 + t2.c1)
+        self.assertIs(t1.c1 == t2.c1, t1.c1 == t2.c1)
+        self.assertIsNot(t1.c1 == t2.c1, t2.c1 == t1.c1)
+        self.assertIs((t1.c1 == 1)._children[0], t1.c1)
+
+        key = ('c', 'unused', id(t1))
+        t1.unused
+        self.assertNotIn(key, interned)
+
     def test_limiting(self):
         query = self.t1.select(self.t1.c).order(self.t1.c)
         self.assertEqual(
@@ -138,7 +191,7 @@ class TestTableComposition(unittest.TestCase):
         self.assertEqual(
             t1.join(t2.where(t2.col == 1)).compile(),
             'SELECT * FROM ( t1 INNER JOIN '
-            '( SELECT * FROM t2 WHERE ( ( t2.col = 1 ) ) ) );')
+            '( SELECT * FROM t2 WHERE ( ( t2.col = 1 ) ) ) t2 );')
         self.assertEqual(
             t1.join(t2.join(t3)).compile(),
             'SELECT * FROM ( t1 INNER JOIN ( SELECT * FROM '
@@ -222,6 +275,101 @@ class TestCompilerRewrites(unittest.TestCase):
             'AND ( ( t2.val2 IN ("a") ) ) ) ) );')
 
 
+class TestParameters(unittest.TestCase):
+    def setUp(self):
+        self.t1 = PDTable('t1')
+        self.t2 = PDTable('t2')
+
+    def test_paramstyles(self):
+        t1 = self.t1
+        query = t1.where(t1.col1 == 'a').where(t1.col2.in_((1, 2)))
+        self.assertEqual(
+            query.compile(params=True),
+            ('SELECT * FROM t1 WHERE ( ( t1.col1 = ? ) ) '
+             'AND ( ( t1.col2 IN (?,?) ) );', ['a', 1, 2]))
+        t1 = PDTable('t1', paramstyle='named')
+        self.assertEqual(
+            t1.where(t1.col1 > 5).compile(params=True),
+            ('SELECT * FROM t1 WHERE ( ( t1.col1 > :p1 ) );', {'p1': 5}))
+        t1 = PDTable('t1', paramstyle='format')
+        self.assertEqual(
+            t1.where(t1.col1 > 5).compile(params=True)[0],
+            'SELECT * FROM t1 WHERE ( ( t1.col1 > %s ) );')
+        t1 = PDTable('t1', paramstyle='numeric')
+        self.assertEqual(
+            t1.where(t1.col1.between((1, 2))).compile(params=True),
+            ('SELECT * FROM t1 WHERE ( ( t1.col1 BETWEEN (:1,:2) ) );',
+             [1, 2]))
+        t1 = PDTable('t1', paramstyle='pyformat')
+        self.assertEqual(
+            t1.where(t1.col1 > 5).compile(params=True),
+            ('SELECT * FROM t1 WHERE ( ( t1.col1 > %(p1)s ) );', {'p1': 5}))
+        t1 = PDTable('t1', paramstyle='test')
+        self.assertRaises(Exception, t1.where(t1.col1 > 5).compile, True)
+
+    def test_subquery_params(self):
+        t1 = self.t1
+        t2 = self.t2
+        query = t1.where(t1.col == t2.where(t2.x == 3).select(t2.col.max())) \
+                  .where(t1.y < 4)
+        self.assertEqual(
+            query.compile(params=True),
+            ('SELECT * FROM t1 WHERE ( ( t1.col = ( SELECT MAX( t2.col ) '
+             'FROM t2 WHERE ( ( t2.x = ? ) ) ) ) ) AND ( ( t1.y < ? ) );',
+             [3, 4]))
+
+    def test_order_literals_inlined(self):
+        t1 = self.t1
+        self.assertEqual(
+            t1.order(1).compile(params=True),
+            ('SELECT * FROM t1 ORDER BY 1 ASC;', []))
+
+
+class TestWriteQueries(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(':memory:')
+        self.cursor = self.connection.cursor()
+        self.cursor.execute('CREATE TABLE t1 ( a INTEGER, b TEXT )')
+        self.t1 = PDTable('t1', cursor=self.cursor)
+
+    def test_compile(self):
+        t1 = self.t1
+        query = t1.where(t1.a > 2).update(a=t1.a + 1, b='x')
+        self.assertEqual(
+            query.compile(params=True),
+            ('UPDATE t1 SET a = ( t1.a + ? ) , b = ? '
+             'WHERE ( ( t1.a > ? ) );', [1, 'x', 2]))
+        self.assertEqual(
+            t1.where(t1.b == 'y').delete().compile(params=True),
+            ('DELETE FROM t1 WHERE ( ( t1.b = ? ) );', ['y']))
+        self.assertRaises(Exception, t1.update)
+        self.assertRaises(Exception, t1.update(a=1).select(t1.a).compile)
+        self.assertRaises(Exception, PDTable(t1).delete)
+
+    def test_run(self):
+        t1 = self.t1
+        self.assertEqual(
+            t1.insert_many(({'a': i, 'b': str(i)} for i in range(10)),
+                           chunk_size=3), 10)
+        self.assertEqual(t1.insert_many([(10, '10')], columns=('a', 'b')), 1)
+        self.assertEqual(t1.where(t1.a >= 8).update(b='big').run(), 3)
+        self.assertEqual(t1.where(t1.a < 5).delete().run(), 5)
+        self.assertEqual(
+            t1.select(t1.a, t1.b).order(t1.a).run().fetchall(),
+            [(5, '5'), (6, '6'), (7, '7'), (8, 'big'), (9, 'big'),
+             (10, 'big')])
+
+    def test_insert_rollback(self):
+        t1 = self.t1
+        self.assertRaises(
+            Exception, t1.insert_many, [(1, 'a'), (2,)], ('a', 'b'))
+        self.assertRaises(Exception, t1.insert_many, [(1, 'a')])
+        self.assertEqual(t1.select(t1.a.count()).run().fetchall(), [(0,)])
+
+    def tearDown(self):
+        self.connection.close()
+
+
 class TestDatabaseQuery(unittest.TestCase):
     def setUp(self):
         self.connection = sqlite3.connect('tests/db.sqlite3')
@@ -236,6 +384,111 @@ class TestDatabaseQuery(unittest.TestCase):
             .where((st.statecode == 'CA') | (st.statecode == 'NV')) \
             .order(st.landarea)
         self.assertEqual(query.run().fetchall(), [(2700551,), (37253956,)])
+        query = st.select(st.statecode) \
+                  .where(st.population_2010 > 30000000)
+        self.assertEqual(query.run().fetchall(), [('CA',)])
+
+    def test_scalar(self):
+        c = PDTable('counties', cursor=self.cursor)
+        nc = PDTable(c.group(c.statecode).select(('num_counties', c.count())))
+        avg_num_counties = nc.select(nc.num_counties.avg())
+        avg_nc = avg_num_counties.scalar()
+        # Interned per subquery
+        self.assertIs(avg_num_counties.scalar(), avg_nc)
+        self.assertIs(avg_nc.subquery, avg_num_counties)
+        self.assertIsNot(nc.select(nc.num_counties.max()).scalar(), avg_nc)
+        st = PDTable(c.group(c.statecode)
+                      .having(c.count() > avg_nc)
+                      .select(('num_states', c.statecode)))
+        num_states = st.select(st.num_states.count())
+        self.assertEqual(
+            num_states.compile(),
+            'SELECT COUNT( num_states ) FROM ( ( SELECT counties.statecode '
+            'AS "num_states" FROM counties GROUP BY counties.statecode '
+            'HAVING ( ( COUNT( * ) > ( SELECT AVG( num_counties ) FROM ( ( '
+            'SELECT COUNT( * ) AS "num_counties" FROM counties GROUP BY '
+            'counties.statecode ) ) ) ) ) ) );')
+
+        value = avg_num_counties.run().fetchall()[0][0]
+        two_step = PDTable(c.group(c.statecode)
+                            .having(c.count() > value)
+                            .select(('num_states', c.statecode)))
+        self.assertEqual(
+            num_states.run().fetchall(),
+            two_step.select(two_step.num_states.count()).run().fetchall())
+        self.assertEqual(avg_nc.value(), value)
+
+    def test_scalar_value_memoized(self):
+        st = self.states
+        population = st.select(st.population_2010) \
+                       .where(st.statecode == 'CA').scalar()
+        self.assertEqual(population.value(memoize=True), 37253956)
+        values = scalar_values(self.connection)
+        hits = values.hits
+        self.assertEqual(population.value(memoize=True), 37253956)
+        self.assertEqual(values.hits, hits + 1)
+        self.assertEqual(population.value(), 37253956)
+        self.assertEqual(values.hits, hits + 1)
+        self.assertEqual(
+            st.select(st.name).where(st.statecode == 'XX').scalar()
+              .value(memoize=True),
+            None)
+
+    def test_scalar_value_connections(self):
+        # Each connection has its own values, even once closed ones'
+        # objects are reused
+        for value in (1, 2, 3):
+            connection = sqlite3.connect(':memory:')
+            connection.execute('CREATE TABLE t (a integer)')
+            connection.execute('INSERT INTO t VALUES (?)', (value,))
+            t = PDTable('t', cursor=connection.cursor())
+            self.assertEqual(t.select(t.a.max()).scalar().value(memoize=True),
+                             value)
+            connection.close()
+
+        # Other connections' writes are seen unless values are memoized
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'db.sqlite3')
+            connection = sqlite3.connect(path)
+            connection.execute('CREATE TABLE t (a integer)')
+            connection.execute('INSERT INTO t VALUES (1)')
+            connection.commit()
+            t = PDTable('t', cursor=connection.cursor())
+            total = t.select(t.a.sum()).scalar()
+            self.assertEqual(total.value(memoize=True), 1)
+
+            other = sqlite3.connect(path)
+            other.execute('INSERT INTO t VALUES (5)')
+            other.commit()
+            other.close()
+            self.assertEqual(total.value(), 6)
+            self.assertEqual(total.value(memoize=True), 1)
+            connection.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_streaming(self):
+        c = PDTable('counties', cursor=self.cursor)
+        query = c.select(c.name).order(c.name)
+        rows = query.run().fetchall()
+        batches = list(query.iter_batches(batch_size=1000))
+        self.assertEqual([len(batch) for batch in batches[:-1]],
+                         [1000] * (len(batches) - 1))
+        self.assertEqual([row for batch in batches for row in batch], rows)
+        self.assertEqual(list(query.iter_rows(batch_size=7)), rows)
+        self.assertRaises(Exception, query.iter_batches, 0)
+
+    def test_streaming_early_termination(self):
+        st = self.states
+        query = st.select(st.statecode).order(st.statecode)
+        rows = query.iter_rows(batch_size=2)
+        self.assertEqual(next(rows), ('AK',))
+        rows.close()
+        self.assertEqual(query.run().fetchone(), ('AK',))
+        for row in query.iter_rows(batch_size=2):
+            break
+        self.assertEqual(self.cursor.execute('SELECT 1').fetchall(), [(1,)])
 
     def tearDown(self):
         self.connection.close()
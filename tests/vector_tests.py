@@ -0,0 +1,209 @@
+import sqlite3
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from PDSQL.PDTable import PDTable
+
+
+def load(cursor, name):
+    """
+    Returns the columns of the table name as a dict of arrays.
+    """
+    cursor.execute('SELECT * FROM ' + name)
+    names = [description[0] for description in cursor.description]
+    columns = zip(*cursor.fetchall())
+    return dict((column, numpy.array(values))
+                for column, values in zip(names, columns))
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not available')
+class TestVectorized(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlite3.connect('tests/db.sqlite3')
+        self.cursor = self.connection.cursor()
+        self.data = {'counties': load(self.cursor, 'counties'),
+                     'states': load(self.cursor, 'states')}
+        self.counties = PDTable('counties', cursor=self.cursor)
+        self.states = PDTable('states', cursor=self.cursor)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def rows(self, query):
+        result = query.run_vectorized(self.data)
+        return [tuple(row) for row in
+                zip(*[values.tolist() for values in result.values()])]
+
+    def assertSameRows(self, query, ordered=True):
+        expected = query.run().fetchall()
+        rows = self.rows(query)
+        if not ordered:
+            expected, rows = sorted(expected), sorted(rows)
+        self.assertEqual(rows, expected)
+
+    def test_where(self):
+        c = self.counties
+        self.assertSameRows(
+            c.where((c.population_2010 > 500000) & (c.statecode != 'CA'))
+             .select(c.name, c.population_2010 - c.population_1950),
+            ordered=False)
+        self.assertSameRows(
+            c.where(c.statecode.in_(('NV', 'WV')))
+             .where(c.name.like('%son%')).select(c.name), ordered=False)
+
+    def test_order_limit(self):
+        c = self.counties
+        self.assertSameRows(
+            reversed(c.where(c.population_2010 > 2000000)
+                      .select(c.statecode, c.name, c.population_2010)
+                      .order(c.population_2010)))
+        self.assertSameRows(
+            c.select(c.name).order(c.population_2010).limit(5))
+        self.assertSameRows(
+            reversed(c.select(c.name, c.statecode)
+                      .order(c.statecode).order(c.population_2010))
+            .limit(20))
+
+    def test_group(self):
+        c = self.counties
+        query = c.group(c.statecode).select(
+            c.statecode, c.count(), c.population_2010.sum(),
+            c.population_2010.max(), c.population_1950.min())
+        self.assertSameRows(query)
+        self.assertEqual(list(query.run_vectorized(self.data)),
+                         ['statecode', 'COUNT(*)', 'SUM(population_2010)',
+                          'MAX(population_2010)', 'MIN(population_1950)'])
+        self.assertSameRows(
+            c.group(c.statecode).order(c.count())
+             .select(('n', c.count()), ('pop', c.population_2010.avg())),
+            ordered=False)
+
+    def test_aggregate(self):
+        c = self.counties
+        self.assertSameRows(c.select(c.count(), c.population_2010.sum()))
+        self.assertSameRows(
+            c.where(c.statecode == 'XX').select(c.count()))
+
+    def test_subqueries(self):
+        c = self.counties
+        nc = PDTable(c.group(c.statecode).select(('num_counties', c.count())))
+        avg_nc = nc.select(nc.num_counties.avg()).scalar()
+        st = PDTable(c.group(c.statecode)
+                      .having(c.count() > avg_nc)
+                      .select(('num_states', c.statecode)))
+        self.assertSameRows(st.select(st.num_states.count()))
+
+        s = self.states
+        self.assertSameRows(
+            c.where(c.statecode.in_(
+                s.where(s.landarea > 100000).select(s.statecode)))
+             .select(c.name), ordered=False)
+
+    def test_distinct(self):
+        c = self.counties
+        self.assertSameRows(
+            c.select(c.statecode).distinct().order(c.statecode))
+
+    def test_unsupported(self):
+        c, s = self.counties, self.states
+        self.assertRaises(Exception, c.join(s).run_vectorized, self.data)
+        self.assertRaises(
+            Exception, c.where(c.statecode == s.statecode).run_vectorized,
+            self.data)
+        self.assertRaises(Exception, PDTable('missing').run_vectorized,
+                          self.data)
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not available')
+class TestColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlite3.connect('tests/db.sqlite3')
+        self.counties = PDTable('counties', cursor=self.connection.cursor())
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_to_columns(self):
+        c = self.counties
+        query = c.where(c.statecode == 'CA').select(
+            c.name, c.population_2010, c.population_2010 / 1000.0)
+        columns = query.to_columns(batch_size=7)
+        self.assertEqual(list(columns),
+                         ['name', 'population_2010',
+                          '( counties.population_2010 / ? )'])
+        rows = query.run().fetchall()
+        self.assertEqual(zip(*[values.tolist()
+                               for values in columns.values()]), rows)
+        self.assertEqual(
+            [values.dtype.kind for values in columns.values()],
+            ['O', 'i', 'f'])
+
+    def test_dtypes(self):
+        c = self.counties
+        query = c.group(c.statecode).select(
+            c.statecode, ('n', c.count()), ('avg', c.population_2010.avg()),
+            ('total', c.population_1950.sum()))
+        columns = query.to_columns(dtypes={'total': numpy.float32})
+        self.assertEqual(
+            [values.dtype for values in columns.values()],
+            [numpy.dtype(object), numpy.dtype(numpy.int64),
+             numpy.dtype(numpy.float64), numpy.dtype(numpy.float32)])
+
+        records = query.to_numpy(dtypes=['U2'])
+        self.assertEqual(records.dtype.names, ('statecode', 'n', 'avg',
+                                               'total'))
+        self.assertEqual(records.statecode[0], 'AK')
+        self.assertEqual(records.n.sum(), 3145)
+
+    def test_promotion(self):
+        c = self.counties
+        query = c.select(c.population_2010, c.population_2010.is_null())
+        columns = query.where(c.statecode == 'XX').to_columns()
+        self.assertEqual([len(values) for values in columns.values()],
+                         [0, 0])
+
+        from PDSQL.PDVector import ColumnBuffer
+        buf = ColumnBuffer(None, 2)
+        buf.extend((1, 2))
+        self.assertEqual(buf.values.dtype, numpy.int64)
+        buf.extend((3, None))
+        buf.extend((4.5,))
+        values = buf.finish()
+        self.assertEqual(values.dtype, numpy.float64)
+        self.assertEqual(values[:3].tolist(), [1.0, 2.0, 3.0])
+        self.assertTrue(numpy.isnan(values[3]))
+        self.assertEqual(len(values), 5)
+
+        # Leading NULLs do not decide the dtype
+        buf = ColumnBuffer(None, 2)
+        buf.extend((None, None))
+        buf.extend(('a', None))
+        values = buf.finish()
+        self.assertEqual(values.dtype, numpy.dtype(object))
+        self.assertEqual(values.tolist(), [None, None, 'a', None])
+        buf = ColumnBuffer(None, 2)
+        buf.extend((None,))
+        buf.extend((1, 2))
+        values = buf.finish()
+        self.assertEqual(values.dtype, numpy.float64)
+        self.assertTrue(numpy.isnan(values[0]))
+        self.assertEqual(values[1:].tolist(), [1.0, 2.0])
+        buf = ColumnBuffer(None, 2)
+        buf.extend((None, None))
+        values = buf.finish()
+        self.assertEqual(values.dtype, numpy.float64)
+        self.assertTrue(numpy.isnan(values).all())
+        buf = ColumnBuffer(None, 2)
+        buf.extend((True, False))
+        buf.extend((None,))
+        self.assertEqual(buf.finish().dtype, numpy.float64)
+
+
+if __name__ == '__main__':
+    unittest.main()